@@ -0,0 +1,422 @@
+# fakelooker.py
+# stand-in for the parts of the Looker API 3.0 that henry uses, serving a
+# synthetic instance generated at a given scale. i__looker history queries
+# are evaluated in memory, including the filters, pivots, sorts and limits
+# henry relies on
+import datetime
+import gzip
+import json
+import os
+import random
+import re
+import ssl
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+
+MEASURES = {'history.query_run_count', 'history.min_runtime',
+            'history.max_runtime', 'history.average_runtime',
+            'history.total_runtime', 'scheduled_job.count'}
+TOKEN = 'benchmark'
+
+
+# builds a synthetic instance with the given number of projects, models per
+# project, explores per model, fields per explore, i__looker history rows
+# and database connections. usage is drawn from 80% of the explores so that
+# there is something to vacuum
+def build_instance(projects=2, models=3, explores=5, fields=30, history=400,
+                   connections=4, seed=0):
+    rnd = random.Random(seed)
+    instance = {'projects': {}, 'models': {}, 'explores': {}, 'history': [],
+                'connections': ['connection_%d' % i
+                                for i in range(connections)]}
+    for p in range(projects):
+        project = 'project_%d' % p
+        files = []
+        instance['projects'][project] = {
+            'id': project,
+            'pull_request_mode': 'off',
+            'validation_required': True,
+            'git_remote_url': 'git@example.com:%s.git' % project,
+            'files': files}
+        for m in range(models):
+            model = 'model_%d_%d' % (p, m)
+            files.append({'type': 'model', 'id': model})
+            stubs = []
+            for e in range(explores):
+                name = 'explore_%d' % e
+                views = [name] + ['view_%d' % v for v in range(3)]
+                explore = {'name': name, 'model_name': model,
+                           'hidden': e % 4 == 0, 'description': None,
+                           'scopes': views,
+                           'fields': {'dimensions': [], 'measures': [],
+                                      'filters': []}}
+                for f in range(fields):
+                    kind = 'dimensions' if f % 3 else 'measures'
+                    explore['fields'][kind].append({
+                        'name': '%s.field_%d' % (views[f % len(views)], f),
+                        'hidden': f % 7 == 0,
+                        'label': 'Field %d' % f,
+                        'sql': '${TABLE}.field_%d' % f})
+                instance['explores'][(model, name)] = explore
+                stubs.append({'name': name, 'hidden': explore['hidden'],
+                              'description': None, 'label': name})
+            instance['models'][model] = {'name': model,
+                                         'project_name': project,
+                                         'has_content': True,
+                                         'explores': stubs}
+        for v in range(5):
+            files.append({'type': 'view', 'id': 'view_%d' % v})
+
+    used = list(instance['explores'])
+    used = used[:max(1, int(len(used) * 0.8))]
+    for i in range(history if used else 0):
+        model, name = rnd.choice(used)
+        explore = instance['explores'][(model, name)]
+        names = [f['name'] for kind in ('dimensions', 'measures')
+                 for f in explore['fields'][kind]]
+        query_fields = rnd.sample(names, min(3, len(names)))
+        instance['history'].append({
+            'history.id': i + 1,
+            'query.id': 1000 + i,
+            'query.model': model,
+            'query.view': name,
+            'query.formatted_fields': json.dumps(query_fields),
+            'query.formatted_filters': json.dumps(
+                                    {query_fields[0]: '7 days'}
+                                    if query_fields else {}),
+            'query.sorts': json.dumps([query_fields[-1] + ' desc']
+                                      if query_fields else []),
+            'query.formatted_pivots': None,
+            # number of days ago
+            'history.created_date': rnd.randint(0, 120),
+            'history.query_run_count': rnd.randint(1, 5),
+            'history.total_runtime': rnd.random() * 10,
+            'history.status': rnd.choice(['complete', 'complete', 'error']),
+        })
+    return instance
+
+
+# evaluates a Looker string filter expression, e.g. "-i^_^_looker" or
+# "model^_a,model^_b"
+def _match_filter(expr, value):
+    if not expr:
+        return True
+    value = str(value)
+    include, exclude = [], []
+    for part in expr.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if part.startswith('-'):
+            exclude.append(part[1:].replace('^_', '_'))
+        else:
+            include.append(part.replace('^_', '_'))
+    for e in exclude:
+        if e == 'NULL':
+            if value == 'None':
+                return False
+        elif e == value:
+            return False
+    if include:
+        return value in include
+    return True
+
+
+# evaluates "N days" and "N days ago for M days" against a number of days ago
+def _match_days(expr, days_ago):
+    m = re.match(r'^(\d+) days? ago for (\d+) days?$', expr)
+    if m:
+        start = int(m.group(1))
+        return start - int(m.group(2)) < days_ago <= start
+    m = re.match(r'^(\d+) days?$', expr)
+    if m:
+        return days_ago < int(m.group(1))
+    return True
+
+
+def _match_number(expr, value):
+    m = re.match(r'^(>=|>|<=|<)?\s*([\d.]+)$', expr)
+    if not m:
+        return True
+    op, number = m.group(1) or '=', float(m.group(2))
+    return {'>=': value >= number, '>': value > number,
+            '<=': value <= number, '<': value < number,
+            '=': value == number}[op]
+
+
+def run_query(instance, body):
+    filters = body.get('filters') or {}
+    rows = []
+    for h in instance['history']:
+        for k, v in filters.items():
+            if k in MEASURES or k == 'history.result_source':
+                continue
+            if k == 'history.created_date':
+                ok = _match_days(v, h[k])
+            elif k in ('history.id', 'query.id'):
+                ok = v == 'NOT NULL' or _match_number(v, h[k])
+            else:
+                ok = _match_filter(v, h.get(k))
+            if not ok:
+                break
+        else:
+            rows.append(h)
+
+    dimensions = [f for f in body['fields'] if f not in MEASURES]
+    groups = defaultdict(list)
+    for h in rows:
+        groups[tuple(str(h[d]) for d in dimensions)].append(h)
+    result = []
+    for group in groups.values():
+        r = {d: group[0][d] for d in dimensions}
+        runtimes = [h['history.total_runtime'] for h in group]
+        for f in body['fields']:
+            if f == 'history.query_run_count':
+                r[f] = sum(h[f] for h in group)
+            elif f == 'history.min_runtime':
+                r[f] = min(runtimes)
+            elif f == 'history.max_runtime':
+                r[f] = max(runtimes)
+            elif f == 'history.average_runtime':
+                r[f] = sum(runtimes) / len(runtimes)
+            elif f == 'history.total_runtime':
+                r[f] = sum(runtimes)
+        if 'history.query_run_count' in filters and not _match_number(
+                filters['history.query_run_count'],
+                r.get('history.query_run_count', 0)):
+            continue
+        result.append(r)
+    for s in reversed(body.get('sorts') or []):
+        f, _, direction = s.partition(' ')
+        result.sort(key=lambda r: r.get(f) or 0,
+                    reverse=(direction == 'desc'))
+    if 'history.created_date' in dimensions:
+        today = datetime.date.today()
+        for r in result:
+            r['history.created_date'] = (today - datetime.timedelta(
+                                days=r['history.created_date'])).isoformat()
+
+    pivots = body.get('pivots') or []
+    if pivots:
+        pivot = pivots[0]
+        merged = {}
+        for r in result:
+            key = tuple(r[d] for d in dimensions if d != pivot)
+            m = merged.setdefault(key, {d: r[d] for d in dimensions
+                                        if d != pivot})
+            for f in body['fields']:
+                if f in MEASURES:
+                    m.setdefault(f, {pivot: {}})[pivot][str(r[pivot])] = \
+                        r.get(f)
+        result = list(merged.values())
+    return result[:int(body.get('limit') or 5000)]
+
+
+# parses the fields parameter of a request, e.g. 'name,fields(dimensions)',
+# into a dict of the attributes selected and what is selected within each
+# of them, None meaning all of it
+def parse_fields(spec, i=0):
+    selected = {}
+    name = ''
+    while i < len(spec):
+        c = spec[i]
+        if c == '(':
+            selected[name], i = parse_fields(spec, i + 1)
+            name = ''
+        elif c == ')':
+            break
+        elif c == ',':
+            if name:
+                selected[name] = None
+            name = ''
+        else:
+            name += c
+        i += 1
+    if name:
+        selected[name] = None
+    return selected, i
+
+
+# returns payload with only the attributes in selected, as the API does
+def project(payload, selected):
+    if selected is None:
+        return payload
+    if isinstance(payload, list):
+        return [project(p, selected) for p in payload]
+    if isinstance(payload, dict):
+        return {k: project(v, selected[k]) for k, v in payload.items()
+                if k in selected}
+    return payload
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # the headers and the body are written separately, so with Nagle's
+    # algorithm on every response would wait for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, payload):
+        query = parse_qs(self.path.split('?', 1)[1] if '?' in self.path
+                         else '')
+        if status == 200 and 'fields' in query:
+            payload = project(payload, parse_fields(query['fields'][0])[0])
+        data = json.dumps(payload).encode('utf-8')
+        gzipped = self.server.compress and \
+            'gzip' in self.headers.get('Accept-Encoding', '')
+        if gzipped:
+            data = gzip.compress(data)
+        with self.server.lock:
+            self.server.bytes_sent += len(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self):
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+        path = self.path.split('?', 1)[0].split('/')[3:]
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        instance = server.instance
+
+        # every login starts an API session of its own, in production
+        if path == ['login']:
+            with server.lock:
+                server.logins += 1
+                token = '%s%d' % (TOKEN, server.logins)
+                server.sessions[token] = 'production'
+            return self._send(200, {'access_token': token,
+                                    'token_type': 'Bearer',
+                                    'expires_in': 3600})
+        # like learn.looker.com, the latest version is public
+        if path == ['versions']:
+            return self._send(200, {'looker_release_version': '6.0.1'})
+        token = self.headers.get('Authorization', '')[len('token '):]
+        if token not in server.sessions:
+            return self._send(401, {'message': 'Requires authentication.'})
+        if path == ['user']:
+            return self._send(200, {'id': 1})
+        if path[0] == 'lookml_models':
+            if server.sessions[token] != 'production':
+                with server.lock:
+                    server.dev_lookml_requests += 1
+            if len(path) == 1:
+                return self._send(200, list(instance['models'].values()))
+            if len(path) == 2:
+                model = instance['models'].get(path[1])
+                return self._send(200 if model else 404, model or {})
+            explore = instance['explores'].get((path[1], path[3]))
+            return self._send(200 if explore else 404, explore or {})
+        if path[0] == 'projects':
+            if len(path) == 1:
+                return self._send(200, list(instance['projects'].values()))
+            project = instance['projects'].get(path[1])
+            if project is None:
+                return self._send(404, {})
+            if len(path) == 2:
+                return self._send(200, project)
+            if path[2] == 'files':
+                return self._send(200, project['files'])
+            if len(path) == 3:
+                return self._send(200, [{'id': 'git'}, {'id': 'remote'}])
+            return self._send(200, {'id': path[3], 'status': 'pass'})
+        if path[0] == 'session':
+            if self.command == 'PATCH':
+                workspace = json.loads(body.decode('utf-8'))['workspace_id']
+                with server.lock:
+                    server.sessions[token] = workspace
+                    if workspace != 'production':
+                        server.switched.add(token)
+            return self._send(200, {'workspace_id': server.sessions[token]})
+        if path[0] == 'connections':
+            if len(path) == 1:
+                return self._send(200, [
+                    {'name': c,
+                     'dialect': {'connection_tests': ['connect', 'query']}}
+                    for c in instance['connections']] +
+                    [{'name': 'looker', 'dialect': {}}])
+            time.sleep(server.connection_test_delay)
+            return self._send(200, [{'name': 'connect', 'status': 'success',
+                                     'message': 'Can connect'}])
+        if path[0] == 'legacy_features':
+            return self._send(200, [{'name': 'old_feature',
+                                     'enabled': True}])
+        if path[0] == 'integrations':
+            return self._send(200, [])
+        if path[:2] == ['queries', 'run']:
+            with server.lock:
+                server.query_count += 1
+            query = json.loads(body.decode('utf-8'))
+            if query['view'] == 'scheduled_plan':
+                return self._send(200, [])
+            return self._send(200, run_query(instance, query))
+        return self._send(404, {})
+
+    do_GET = _route
+    do_POST = _route
+    do_PUT = _route
+    do_PATCH = _route
+
+
+class FakeLookerServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, instance, certfile, keyfile, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.instance = instance
+        self.request_count = 0
+        # number of queries run
+        self.query_count = 0
+        # workspace of the API session of every access token handed out,
+        # the tokens whose session left production and the number of LookML
+        # requests answered outside of production
+        self.sessions = {}
+        self.logins = 0
+        self.switched = set()
+        self.dev_lookml_requests = 0
+        # seconds each connection test takes
+        self.connection_test_delay = 0
+        # whether response bodies are gzipped for clients that accept it,
+        # and the size of the bodies sent
+        self.compress = False
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever, daemon=True)
+        t.start()
+        return self
+
+
+# creates a self-signed certificate for the server in path using openssl,
+# valid for 127.0.0.1 so that clients can trust it
+def make_certificate(path):
+    certfile = os.path.join(path, 'cert.pem')
+    keyfile = os.path.join(path, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                    '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                    '-addext', 'subjectAltName=IP:127.0.0.1,DNS:localhost',
+                    '-keyout', keyfile, '-out', certfile],
+                   check=True, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+    return certfile, keyfile
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# run.py
+# times henry commands against a fake Looker instance of a chosen scale and
+# reports the wall time, number of API requests, size of the responses and
+# peak memory of each.
+# every command runs in a fresh process with its own home directory, so
+# runs start without a metadata cache or usage store, and with settings that
+# only point the version check of pulse at the server. example:
+#
+#   python benchmarks/run.py --models 10 --explores 50 --history 100000
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from tabulate import tabulate
+from fakelooker import FakeLookerServer, build_instance, make_certificate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMANDS = ['analyze projects', 'analyze models', 'analyze explores',
+            'vacuum models', 'vacuum explores', 'pulse']
+
+
+# runs command in a child process and returns its exit code, wall time and
+# peak resident memory in MB
+def run_command(command, env):
+    start = time.perf_counter()
+    p = subprocess.Popen([sys.executable, '-m', 'henry.cli'] + command,
+                         cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.PIPE)
+    stderr = p.stderr.read()
+    _, status, usage = os.wait4(p.pid, 0)
+    wall_time = time.perf_counter() - start
+    p.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+    p.stderr.close()
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    divisor = 1024 ** 2 if sys.platform == 'darwin' else 1024
+    return p.returncode, wall_time, usage.ru_maxrss / divisor, stderr
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark henry commands '
+                                     'against a synthetic Looker instance')
+    parser.add_argument('--projects', type=int, default=2)
+    parser.add_argument('--models', type=int, default=3,
+                        help='Models per project')
+    parser.add_argument('--explores', type=int, default=5,
+                        help='Explores per model')
+    parser.add_argument('--fields', type=int, default=30,
+                        help='Fields per explore')
+    parser.add_argument('--history', type=int, default=1000,
+                        help='Number of i__looker history rows')
+    parser.add_argument('--connections', type=int, default=4)
+    parser.add_argument('--commands', nargs='+', default=COMMANDS,
+                        metavar='COMMAND', help='Commands to run, e.g. '
+                        '"analyze explores" (default: all)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Number of times to run each command')
+    parser.add_argument('--henry-args', default='',
+                        help='Extra options passed to every command, e.g. '
+                             '"--workers 8"')
+    parser.add_argument('--json', metavar='PATH',
+                        help='Save the results as JSON')
+    args = parser.parse_args()
+
+    print('Building instance: %s projects, %s models, %s explores, '
+          '%s fields, %s history rows' % (
+            args.projects, args.projects * args.models,
+            args.projects * args.models * args.explores,
+            args.projects * args.models * args.explores * args.fields,
+            args.history), file=sys.stderr)
+    instance = build_instance(args.projects, args.models, args.explores,
+                              args.fields, args.history, args.connections)
+    tmp = tempfile.mkdtemp(prefix='henry-benchmark-')
+    try:
+        certfile, keyfile = make_certificate(tmp)
+        server = FakeLookerServer(instance, certfile, keyfile).start()
+        env = dict(os.environ)
+        # henry talks to the API without verifying its certificate, but a
+        # CA bundle set in the environment overrides that. the version check
+        # of pulse verifies it, so the server's own certificate is used
+        env.pop('CURL_CA_BUNDLE', None)
+        env['REQUESTS_CA_BUNDLE'] = certfile
+        settings = {'pulse_version_url': 'https://127.0.0.1:%s/api/3.0/'
+                                         'versions' % server.port}
+        results = []
+        for command in args.commands:
+            for i in range(args.repeat):
+                env['HOME'] = tempfile.mkdtemp(dir=tmp)
+                os.mkdir(os.path.join(env['HOME'], '.henry'))
+                with open(os.path.join(env['HOME'], '.henry',
+                                       'settings.json'), 'w') as f:
+                    json.dump(settings, f)
+                requests_before = server.request_count
+                bytes_before = server.bytes_sent
+                code, wall_time, memory, stderr = run_command(
+                    command.split() + args.henry_args.split() +
+                    ['-q', '--host', '127.0.0.1', '--port', str(server.port),
+                     '--client_id', 'benchmark', '--client_secret',
+                     'benchmark'], env)
+                if code != 0:
+                    error = stderr.decode('utf-8', 'replace').strip()
+                    print('%s failed: %s' % (command,
+                                             error.splitlines()[-1]
+                                             if error else code),
+                          file=sys.stderr)
+                results.append({'command': command,
+                                'run': i + 1,
+                                'status': 'ok' if code == 0 else 'error',
+                                'wall_s': round(wall_time, 3),
+                                'requests': server.request_count -
+                                requests_before,
+                                'response_kb': round((server.bytes_sent -
+                                                      bytes_before) / 1024,
+                                                     1),
+                                'peak_mb': round(memory, 1)})
+        server.shutdown()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(tabulate(results, headers='keys', tablefmt='psql',
+                   numalign='right'))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'instance': {k: getattr(args, k) for k in
+                                    ('projects', 'models', 'explores',
+                                     'fields', 'history', 'connections')},
+                       'henry_args': args.henry_args,
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
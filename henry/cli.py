@@ -1,65 +1,172 @@
 #!/usr/bin/env python3
-from .modules.lookerapi import LookerApi
 import argparse
+import io
 import os
 import errno
 import sys
-from .modules.spinner import Spinner
-from .modules.auth import authenticate
-import logging.config
-import henry
-from pathlib import PosixPath
 import json
+import logging
+import time
 import uuid
 from . import __version__ as pkg
-LOGGING_CONFIG_PATH = os.path.join(os.path.dirname(henry.__file__),
-                                   '.support_files/logging.conf')
+from .modules.spinner import Spinner
+# the commands and the modules they depend on are imported once the
+# arguments are parsed, so that only what a command needs gets loaded
+SUPPORT_FILES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  '.support_files')
+LOGGING_CONFIG_PATH = os.path.join(SUPPORT_FILES_PATH, 'logging.conf')
 METADATA_PATH = os.path.join(os.path.expanduser('~'), '.henry')
-if not os.path.exists(METADATA_PATH):
-    os.mkdir(METADATA_PATH)
-elif os.path.exists(METADATA_PATH) and not os.path.isdir(METADATA_PATH):
-    print('Cannot create metadata directory in %s' % METADATA_PATH)
-    sys.exit(1)
-LOGGING_LOG_PATH = os.path.join(METADATA_PATH, 'log')
-if not os.path.exists(LOGGING_LOG_PATH):
-    os.mkdir(LOGGING_LOG_PATH)
-elif os.path.exists(LOGGING_LOG_PATH) and not os.path.isdir(LOGGING_LOG_PATH):
-    print('Cannot create log directory in %s' % LOGGING_LOG_PATH)
-    sys.exit(1)
-LOGGING_LOG_PATH = os.path.join(LOGGING_LOG_PATH, 'henry.log')
-logging.config.fileConfig(LOGGING_CONFIG_PATH,
-                          defaults={'logfilename': LOGGING_LOG_PATH},
-                          disable_existing_loggers=False)
-from .commands.analyze import Analyze
-from .commands.vacuum import Vacuum
-from .commands.pulse import Pulse
+LOGGING_LOG_PATH = os.path.join(METADATA_PATH, 'log', 'henry.log')
+# file extensions accepted by --output for each --format
+OUTPUT_EXTENSIONS = {'table': ('.txt',),
+                     'jsonl': ('.jsonl', '.json', '.txt'),
+                     'csv': ('.csv', '.txt')}
 
 logger = logging.getLogger('main')
 # sys.tracebacklimit = -1 # enable only on shipped release
 
 
+# creates the metadata and log directories and sets up logging to
+# ~/.henry/log/henry.log
+def configure_logging():
+    if not os.path.exists(METADATA_PATH):
+        os.mkdir(METADATA_PATH)
+    elif not os.path.isdir(METADATA_PATH):
+        print('Cannot create metadata directory in %s' % METADATA_PATH)
+        sys.exit(1)
+    log_dir = os.path.dirname(LOGGING_LOG_PATH)
+    if not os.path.exists(log_dir):
+        os.mkdir(log_dir)
+    elif not os.path.isdir(log_dir):
+        print('Cannot create log directory in %s' % log_dir)
+        sys.exit(1)
+    import logging.config
+    logging.config.fileConfig(LOGGING_CONFIG_PATH,
+                              defaults={'logfilename': LOGGING_LOG_PATH},
+                              disable_existing_loggers=False)
+
+
+# calls run with each of hosts at once, each in its own thread, and returns
+# the results and the errors by host. a host that is slow or down only holds
+# up its own thread
+def fan_out(hosts, run):
+    from concurrent.futures import ThreadPoolExecutor
+    results, errors = {}, {}
+    with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+        futures = {host: executor.submit(run, host) for host in hosts}
+        for host, future in futures.items():
+            try:
+                results[host] = future.result()
+            except SystemExit as e:
+                # the error has already been printed and logged
+                logger.error('Host %s exited with status %s', host, e.code)
+                errors[host] = 'Exited with status %s' % e.code
+            except Exception as e:
+                logger.error('Host %s failed: %s', host, e)
+                errors[host] = str(e) or type(e).__name__
+    return results, errors
+
+
+# runs henry serve on the unix socket at path. API sessions are created
+# with the given settings, with metadata kept in memory in front of the
+# disk cache and usage query results kept for usage_ttl seconds
+def serve_daemon(path, timeout, workers, cache_ttl, cache_max_size,
+                 usage_ttl, use_token_cache, use_usage_store, transport):
+    from .commands.serve import Serve
+    from .modules.auth import authenticate
+    from .modules.cache import MemoryCache, MetadataCache
+    from .modules.usagestore import UsageStore
+    cache = MemoryCache(ttl=cache_ttl,
+                        backend=MetadataCache(
+                                os.path.join(METADATA_PATH, 'cache'),
+                                ttl=cache_ttl,
+                                max_size=cache_max_size * 1024 ** 2))
+    if use_token_cache:
+        from .modules.tokencache import TokenCache
+        token_cache = TokenCache(os.path.join(METADATA_PATH, 'tokens.json'))
+    else:
+        token_cache = None
+    session_info = f'Henry v{pkg.__version__}: cmd=serve' \
+                   f', sid=#{uuid.uuid1()}'
+
+    def connect(auth_args, config_path):
+        looker = authenticate(timeout, session_info, config_path, workers,
+                              cache, None, None, token_cache, transport,
+                              **auth_args)
+        looker.usage_cache = MemoryCache(ttl=usage_ttl)
+        return looker
+
+    def usage_store():
+        return UsageStore(os.path.join(METADATA_PATH, 'usage'),
+                          max_age=usage_ttl)
+
+    try:
+        Serve(path, connect, usage_store, use_usage_store).run_forever()
+    finally:
+        logger.info('Transport: %s', transport.report())
+        transport.close()
+
+
+# opens path for writing output in format. it must be a new file with one
+# of the format's extensions
+def open_output(path, format='table'):
+    extensions = OUTPUT_EXTENSIONS[format]
+    if os.path.isdir(path):
+        error = IsADirectoryError(errno.EISDIR,
+                                  os.strerror(errno.EISDIR),
+                                  path)
+        logger.error(error)
+        raise error
+    elif not path.endswith(extensions):
+        error = ValueError('Output file must be a %s file'
+                           % ' or '.join(extensions))
+        logger.exception(error)
+        raise error
+    elif os.path.isfile(path):
+        error = FileExistsError(errno.EEXIST,
+                                os.strerror(errno.EEXIST),
+                                path)
+        logger.error(error)
+        raise error
+    try:
+        return open(path, 'w+', newline='')
+    except Exception as e:
+        logger.error(e)
+        raise(e)
+
+
+# writes rows to out in format. a reader that stops early, e.g. head,
+# ends the command
+def stream_rows(rows, out, format):
+    from .modules import styler
+    try:
+        styler.stream(rows, out, format)
+    except BrokenPipeError:
+        logger.info('Output closed by the reader')
+        # keep the interpreter from failing to flush stdout on exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), out.fileno())
+        sys.exit(1)
+
+
+# saves result to path, which must be a new .txt file
+def save_output(path, result):
+    logger.info('Saving results to file: %s', path)
+    f = open_output(path)
+    try:
+        f.write(result+'\n')
+        f.close()
+        logger.info('Results succesfully saved.')
+    except Exception as e:
+        logger.error(e)
+        raise(e)
+
+
 def main():
-    logger.info('Starting henry')
-    HELP_PATH = os.path.join(os.path.dirname(henry.__file__),
-                             '.support_files/help.rtf')
+    start_time = time.time()
+    HELP_PATH = os.path.join(SUPPORT_FILES_PATH, 'help.rtf')
     with open(HELP_PATH, 'r', encoding='unicode_escape') as myfile:
         descStr = myfile.read()
 
-    # load custom config settings if defined in ~/.henry/henry.json
-    settings_file = PosixPath(os.path.join(METADATA_PATH, 'settings.json')).expanduser()
-    timeout = 120
-    config_path = PosixPath.cwd().joinpath('config.yml')
-    if settings_file.is_file():
-        with open(settings_file, 'r') as f:
-            settings = json.load(f)
-            timeout = settings.get('api_conn_timeout', timeout)
-            if type(timeout) is list:
-                timeout = tuple(timeout)
-            config_path = settings.get('config_path', config_path)
-        logger.info(f'Loaded config settings from ~/.henry/settings.json, {settings}')
-    else:
-        logger.info('No custom config file found. Using defaults.')
-
     parser = argparse.ArgumentParser(
         description=descStr,
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -77,6 +184,33 @@ def main():
     # subparsers.required = True # works, but might do without for now.
 
     pulse = subparsers.add_parser('pulse', help='pulse help')
+    pulse.add_argument('--connection-workers',
+                       dest='connection_workers',
+                       type=int,
+                       default=None,
+                       help='Number of connections tested at a time')
+    pulse.add_argument('--connection-timeout',
+                       dest='connection_timeout',
+                       type=int,
+                       default=None,
+                       help='Seconds to wait for each connection test')
+
+    serve = subparsers.add_parser('serve', help='serve help')
+    serve.add_argument('--socket',
+                       type=str,
+                       default=None,
+                       metavar='PATH',
+                       help='Unix socket to listen on '
+                            '(default: ~/.henry/henry.sock)')
+    serve.add_argument('--workers',
+                       type=int,
+                       default=None,
+                       help='Number of concurrent API requests')
+    serve.add_argument('--usage-store',
+                       dest='usage_store',
+                       action='store_true',
+                       help='Answer usage questions from a local copy of '
+                            'i__looker history')
 
     analyze_parser = subparsers.add_parser('analyze', help='analyze help',
                                            usage='henry analyze')
@@ -216,6 +350,40 @@ def main():
                                  default=0,
                                  help='Query threshold')
 
+    for subparser in [analyze_models, analyze_explores, vacuum_models,
+                      vacuum_explores]:
+        subparser.add_argument('--usage-store',
+                               dest='usage_store',
+                               action='store_true',
+                               help='Answer usage questions from a local '
+                                    'copy of i__looker history')
+        subparser.add_argument('--dry-run',
+                               dest='dry_run',
+                               action='store_true',
+                               help='List the API calls and usage queries '
+                                    'the command would make and estimate '
+                                    'how long they would take, without '
+                                    'making them')
+
+    for subparser in [analyze_projects, analyze_models, analyze_explores,
+                      vacuum_models, vacuum_explores]:
+        subparser.add_argument('--no-daemon',
+                               dest='no_daemon',
+                               action='store_true',
+                               help='Run the command in this process even '
+                                    'if henry serve is running')
+        subparser.add_argument('--socket',
+                               type=str,
+                               default=None,
+                               metavar='PATH',
+                               help='Unix socket of henry serve '
+                                    '(default: ~/.henry/henry.sock)')
+        subparser.add_argument('--format',
+                               choices=['table', 'jsonl', 'csv'],
+                               default='table',
+                               help='Output format. jsonl and csv write '
+                                    'each row as soon as it is ready')
+
     for subparser in [analyze_projects, analyze_models, analyze_explores,
                       vacuum_models, vacuum_explores, pulse]:
         subparser.add_argument('--output',
@@ -230,6 +398,58 @@ def main():
                                action='store_true',
                                help='Show results in a table format '
                                     'without the gridlines')
+        subparser.add_argument('--workers',
+                               type=int,
+                               default=None,
+                               help='Number of concurrent API requests')
+        subparser.add_argument('--async',
+                               dest='use_async',
+                               action='store_true',
+                               help='Run concurrent API requests on an '
+                                    'asyncio event loop')
+        subparser.add_argument('--profile-http',
+                               dest='profile_http',
+                               nargs='?',
+                               const='',
+                               default=None,
+                               metavar='PATH',
+                               help='Report the cost of every API endpoint '
+                                    'and save it as JSON')
+        cache_group = subparser.add_mutually_exclusive_group()
+        cache_group.add_argument('--no-cache',
+                                 dest='no_cache',
+                                 action='store_true',
+                                 help='Do not use the LookML metadata cache')
+        cache_group.add_argument('--refresh-cache',
+                                 dest='refresh_cache',
+                                 action='store_true',
+                                 help='Refetch and recache LookML metadata')
+        cassette_group = subparser.add_mutually_exclusive_group()
+        cassette_group.add_argument('--record',
+                                    type=str,
+                                    default=None,
+                                    metavar='DIR',
+                                    help='Record all API responses to a '
+                                         'cassette in DIR')
+        cassette_group.add_argument('--replay',
+                                    type=str,
+                                    default=None,
+                                    metavar='DIR',
+                                    help='Replay API responses from the '
+                                         'cassette in DIR instead of calling '
+                                         'the API')
+        hosts_group = subparser.add_mutually_exclusive_group()
+        hosts_group.add_argument('--hosts',
+                                 type=str,
+                                 default=None,
+                                 metavar='ALIASES',
+                                 help='Run on several hosts of the config '
+                                      'file at once, e.g. --hosts dev,prod')
+        hosts_group.add_argument('--all-hosts',
+                                 dest='all_hosts',
+                                 action='store_true',
+                                 help='Run on every host of the config file '
+                                      'at once')
         subparser.add_argument_group("Authentication")
         subparser.add_argument('--host', type=str, default='looker',
                                required=any(k in sys.argv for k in
@@ -254,6 +474,59 @@ def main():
                                help=argparse.SUPPRESS)
 
     args = vars(parser.parse_args())
+    configure_logging()
+    logger.info('Starting henry')
+
+    # load custom config settings if defined in ~/.henry/henry.json
+    settings_file = os.path.join(METADATA_PATH, 'settings.json')
+    timeout = 120
+    workers = 1
+    use_async = False
+    cache_ttl = 3600
+    cache_max_size = 100
+    use_usage_store = False
+    use_token_cache = True
+    connection_workers = 10
+    connection_timeout = None
+    version_url = None
+    serve_socket = os.path.join(METADATA_PATH, 'henry.sock')
+    serve_usage_ttl = 60
+    pool_size = None
+    pool_block = False
+    compression = True
+    tcp_keepalive = 60
+    use_http2 = False
+    config_path = os.path.join(os.getcwd(), 'config.yml')
+    if os.path.isfile(settings_file):
+        with open(settings_file, 'r') as f:
+            settings = json.load(f)
+            timeout = settings.get('api_conn_timeout', timeout)
+            if type(timeout) is list:
+                timeout = tuple(timeout)
+            workers = settings.get('api_workers', workers)
+            use_async = settings.get('api_async', use_async)
+            pool_size = settings.get('api_pool_size', pool_size)
+            pool_block = settings.get('api_pool_block', pool_block)
+            compression = settings.get('api_compression', compression)
+            tcp_keepalive = settings.get('api_tcp_keepalive', tcp_keepalive)
+            use_http2 = settings.get('api_http2', use_http2)
+            cache_ttl = settings.get('cache_ttl', cache_ttl)
+            cache_max_size = settings.get('cache_max_size', cache_max_size)
+            use_usage_store = settings.get('usage_store', use_usage_store)
+            use_token_cache = settings.get('token_cache', use_token_cache)
+            connection_workers = settings.get('pulse_connection_workers',
+                                              connection_workers)
+            connection_timeout = settings.get('pulse_connection_timeout',
+                                              connection_timeout)
+            version_url = settings.get('pulse_version_url', version_url)
+            serve_socket = settings.get('serve_socket', serve_socket)
+            serve_usage_ttl = settings.get('serve_usage_ttl',
+                                           serve_usage_ttl)
+            config_path = settings.get('config_path', config_path)
+        logger.info(f'Loaded config settings from ~/.henry/settings.json, {settings}')
+    else:
+        logger.info('No custom config file found. Using defaults.')
+
     _args = {}
     for key, value in args.items():
         if key == 'client_secret':
@@ -266,10 +539,59 @@ def main():
         print('usage:', parser.usage)
         print('\nNo command specified. Try `henry --help` for help.')
         sys.exit(1)
+    if args['command'] in ('analyze', 'vacuum') and args['which'] is None:
+        parser.error("No command")
+    if args['command'] == 'serve':
+        if args['workers'] is not None:
+            workers = args['workers']
+        if workers < 1:
+            parser.error('Number of workers must be at least 1')
+        from .modules.transport import Transport
+        transport = Transport(pool_size=pool_size or max(workers, 10),
+                              pool_block=pool_block, compression=compression,
+                              keepalive=tcp_keepalive, http2=use_http2)
+        serve_daemon(args['socket'] or serve_socket, timeout, workers,
+                     cache_ttl, cache_max_size, serve_usage_ttl,
+                     use_token_cache,
+                     use_usage_store or args['usage_store'], transport)
+        return
     auth_params = ('host', 'port', 'client_id', 'client_secret', 'persist',
                    'alias', 'path')
     auth_args = {k: args[k] for k in auth_params}
 
+    output_format = args.get('format') or 'table'
+
+    # precedence: --socket, serve_socket in global config, default
+    if args.get('socket'):
+        serve_socket = args['socket']
+    # hand analyze and vacuum over to henry serve if it is running, unless
+    # the command needs something the daemon doesn't keep
+    local_only = ('no_daemon', 'record', 'replay', 'persist', 'alias',
+                  'hosts', 'all_hosts', 'no_cache', 'refresh_cache',
+                  'use_async', 'dry_run')
+    if args['command'] in ('analyze', 'vacuum') and \
+            args['profile_http'] is None and output_format == 'table' and \
+            not any(args.get(k) for k in local_only) and \
+            os.path.exists(serve_socket):
+        from .modules import daemon
+        # the daemon runs in a different directory
+        if args['path']:
+            args['path'] = auth_args['path'] = os.path.abspath(args['path'])
+        reply = daemon.forward(serve_socket, {
+                    'command': args['command'] + ' ' + args['which'],
+                    'args': args,
+                    'auth': auth_args,
+                    'config_path': os.path.abspath(config_path)})
+        if reply is not None:
+            if reply['status'] != 0:
+                print(reply['error'])
+                sys.exit(reply['status'])
+            if not args['quiet']:
+                print(reply['result'])
+            if args['output']:
+                save_output(args['output'], reply['result'])
+            return
+
     # authenticate
     if args['command'] != 'pulse':
         cmd = args['command']+' '+args['which']
@@ -277,57 +599,314 @@ def main():
         cmd = args['command']
     session_info = f'Henry v{pkg.__version__}: cmd={cmd}' \
                    f', sid=#{uuid.uuid1()}'
-    looker = authenticate(timeout, session_info, config_path, **auth_args)
+    # precedence: --workers, api_workers in global config, default
+    if args['workers'] is not None:
+        workers = args['workers']
+    if workers < 1:
+        parser.error('Number of workers must be at least 1')
+    if args['hosts'] or args['all_hosts']:
+        # every host is authenticated with its own entry of the config file
+        if args['client_id'] or args['client_secret']:
+            parser.error('--hosts and --all-hosts use the credentials in the '
+                         'config file and cannot be used with --client_id '
+                         'or --client_secret')
+        if args['persist'] or args['alias']:
+            parser.error('--hosts and --all-hosts cannot be used with '
+                         '--persist or --alias')
+        if args['record'] or args['replay']:
+            parser.error('--hosts and --all-hosts cannot be used with '
+                         '--record or --replay')
+        if args['all_hosts']:
+            from .modules.auth import list_hosts
+            hosts = list_hosts(config_path, args['path'])
+        else:
+            hosts = [h.strip() for h in args['hosts'].split(',')
+                     if h.strip()]
+        if not hosts:
+            parser.error('No hosts to run on')
+        if args.get('dry_run'):
+            parser.error('--dry-run cannot be used with --hosts or '
+                         '--all-hosts')
+    else:
+        hosts = None
+    if args.get('dry_run') and output_format != 'table':
+        parser.error('--dry-run cannot be used with --format')
+    # the version check's default endpoint is kept unless it is set
+    pulse_args = {'version_url': version_url} if version_url else {}
+    if args['command'] == 'pulse':
+        if args['connection_workers'] is not None:
+            connection_workers = args['connection_workers']
+        if args['connection_timeout'] is not None:
+            connection_timeout = args['connection_timeout']
+    if args['record'] or args['replay']:
+        # every request has to go through the cassette and the replayed
+        # results must not depend on local state, so the metadata cache,
+        # the usage store, the token cache and the async backend are not
+        # used
+        if args['use_async']:
+            parser.error('--async cannot be used with --record or --replay')
+        if args['replay'] and (args['persist'] or args['alias']):
+            parser.error('--replay cannot be used with --persist or --alias')
+        use_async = False
+        use_usage_store = False
+        use_token_cache = False
+        args['usage_store'] = False
+        from .modules.cassette import Cassette
+        cassette = Cassette(args['record'] or args['replay'],
+                            'record' if args['record'] else 'replay')
+    else:
+        cassette = None
+    if args['no_cache'] or cassette is not None:
+        cache = None
+    else:
+        from .modules.cache import MetadataCache
+        cache = MetadataCache(os.path.join(METADATA_PATH, 'cache'),
+                              ttl=cache_ttl,
+                              max_size=cache_max_size * 1024 ** 2,
+                              refresh=args['refresh_cache'])
+    if use_token_cache:
+        from .modules.tokencache import TokenCache
+        token_cache = TokenCache(os.path.join(METADATA_PATH, 'tokens.json'))
+    else:
+        token_cache = None
+    # dry runs time the calls they make to plan the rest
+    if args['profile_http'] is not None or args.get('dry_run'):
+        from .modules.profiler import HttpProfiler
+        profiler = HttpProfiler()
+    else:
+        profiler = None
+    use_async = use_async or args['use_async']
+    if use_async:
+        try:
+            from .modules.asynclookerapi import AsyncLookerApi
+        except ImportError:
+            print('The async backend requires aiohttp. Install it with '
+                  '`pip install henry[async]`.')
+            sys.exit(1)
+    use_usage_store = use_usage_store or args.get('usage_store')
+    if use_usage_store:
+        from .modules.usagestore import UsageStore
+    from .modules.auth import authenticate
+    # the pools are sized for the most requests that can be in flight at
+    # once and shared by all hosts
+    from .modules.transport import Transport
+    if pool_size is None:
+        pool_size = max(workers, 10)
+        if args['command'] == 'pulse':
+            pool_size = max(pool_size, connection_workers)
+    transport = Transport(pool_size=pool_size,
+                          pool_hosts=max(10, len(hosts or []) + 1),
+                          pool_block=pool_block, compression=compression,
+                          keepalive=tcp_keepalive, http2=use_http2)
+    if args['command'] == 'analyze':
+        from .commands.analyze import Analyze
+    elif args['command'] == 'vacuum':
+        from .commands.vacuum import Vacuum
+    else:
+        from .commands.pulse import Pulse
+
+    # runs the command against host and returns its rows, or the report
+    # for pulse. everything that holds a connection or an event loop is
+    # created here so that each host gets its own
+    def run_host(host):
+        looker = authenticate(timeout, session_info, config_path, workers,
+                              cache, profiler, None, token_cache, transport,
+                              **dict(auth_args, host=host))
+        if use_async:
+            looker.aio = AsyncLookerApi(looker, concurrency=workers)
+        try:
+            if args['command'] == 'pulse':
+                out = io.StringIO()
+                pulse = Pulse(looker, connection_workers, connection_timeout,
+                              out=out, progress=False, **pulse_args)
+                pulse.run_all()
+                return out.getvalue()
+            if use_usage_store:
+                usage = UsageStore(os.path.join(METADATA_PATH, 'usage'))
+            else:
+                usage = None
+            try:
+                if args['command'] == 'analyze':
+                    return Analyze(looker, usage).analyze_rows(**args)
+                return Vacuum(looker, usage).vacuum_rows(**args)
+            finally:
+                if usage is not None:
+                    usage.close()
+        finally:
+            logger.info('Memo for %s: %s', host, looker.memo.report())
+            if looker.aio is not None:
+                looker.aio.close()
 
-    # map subcommand to function
-    if args['command'] in ('analyze', 'vacuum'):
-        if args['which'] is None:
-            parser.error("No command")
+    # rows in jsonl or csv are written as they come, to the output file if
+    # there is one and to stdout otherwise
+    out = None
+    stdout = sys.stdout
+    if output_format != 'table':
+        if args['output']:
+            logger.info('Writing results to file: %s', args['output'])
+            out = open_output(args['output'], output_format)
+        elif args['quiet']:
+            out = open(os.devnull, 'w')
         else:
+            # messages printed along the way go to stderr so that stdout
+            # only holds rows
+            out = sys.stdout
+            sys.stdout = sys.stderr
+
+    try:
+        if hosts is None:
+            looker = authenticate(timeout, session_info, config_path, workers,
+                                  cache, profiler, cassette, token_cache,
+                                  transport, **auth_args)
+            if use_async:
+                looker.aio = AsyncLookerApi(looker, concurrency=workers)
+        else:
+            looker = None
+
+        # map subcommand to function
+        errors = {}
+        if hosts is not None:
+            from tabulate import tabulate
+            from .modules.color import color
+            logger.info('Running %s on %s', cmd, hosts)
+            with Spinner():
+                results, errors = fan_out(hosts, run_host)
+            if args['command'] == 'pulse':
+                result = '\n'.join('%s%s%s\n%s' % (color.BOLD, host,
+                                                  color.ENDC, results[host])
+                                   for host in hosts if host in results)
+            elif output_format != 'table':
+                stream_rows((dict({'host': host}, **r) for host in hosts
+                             if host in results for r in results[host]),
+                            out, output_format)
+                result = None
+            else:
+                rows = [dict({'host': host}, **r) for host in hosts
+                        if host in results for r in results[host]]
+                result = tabulate(rows,
+                                  headers='' if args['plain'] else 'keys',
+                                  tablefmt='plain' if args['plain']
+                                  else 'psql',
+                                  numalign='center')
+            if errors:
+                failed = '\n\nFailed hosts:\n' + tabulate(
+                                [{'host': host, 'error': errors[host]}
+                                 for host in hosts if host in errors],
+                                headers='keys', tablefmt='psql')
+                if result is None:
+                    print(failed.lstrip('\n'), file=sys.stderr)
+                else:
+                    result += failed
+            if not args['quiet'] and result is not None:
+                print(result)
+        elif args.get('dry_run'):
+            if use_usage_store:
+                usage = UsageStore(os.path.join(METADATA_PATH, 'usage'))
+            else:
+                usage = None
+            profile_dir = os.path.join(METADATA_PATH, 'profile')
+            try:
+                with Spinner():
+                    if args['command'] == 'analyze':
+                        plan = Analyze(looker, usage).plan(profile_dir, **args)
+                    else:
+                        plan = Vacuum(looker, usage).plan(profile_dir, **args)
+                    result = plan.report()
+            finally:
+                if usage is not None:
+                    usage.close()
+            if not args['quiet']:
+                print(result)
+        elif args['command'] in ('analyze', 'vacuum') and \
+                output_format != 'table':
+            if use_usage_store:
+                usage = UsageStore(os.path.join(METADATA_PATH, 'usage'))
+            else:
+                usage = None
+            try:
+                if args['command'] == 'analyze':
+                    rows = Analyze(looker, usage).iter_rows(**args)
+                else:
+                    rows = Vacuum(looker, usage).iter_rows(**args)
+                stream_rows(rows, out, output_format)
+            finally:
+                if usage is not None:
+                    usage.close()
+        elif args['command'] in ('analyze', 'vacuum'):
+            if use_usage_store:
+                usage = UsageStore(os.path.join(METADATA_PATH, 'usage'))
+            else:
+                usage = None
             with Spinner():
                 if args['command'] == 'analyze':
-                    analyze = Analyze(looker)
+                    analyze = Analyze(looker, usage)
                     result = analyze.analyze(**args)
                 else:
-                    vacuum = Vacuum(looker)
+                    vacuum = Vacuum(looker, usage)
                     result = vacuum.vacuum(**args)
-        # silence outout if --silence flag is used
-        if not args['quiet']:
-            print(result)
-    elif args['command'] == 'pulse':
-                pulse = Pulse(looker)
-                result = pulse.run_all()
-    else:
-        print('No command passed')
+            if usage is not None:
+                usage.close()
+            # silence outout if --silence flag is used
+            if not args['quiet']:
+                print(result)
+        elif args['command'] == 'pulse':
+            pulse = Pulse(looker, connection_workers, connection_timeout,
+                          **pulse_args)
+            result = pulse.run_all()
+        else:
+            print('No command passed')
+
+        if looker is not None and looker.aio is not None:
+            looker.aio.close()
+        if cassette is not None:
+            cassette.save()
+        if looker is not None:
+            logger.info('Memo: %s', looker.memo.report())
+        # connection stats are kept until the pools are closed
+        transport_report = transport.report()
+        transport_stats = transport.stats()
+        logger.info('Transport: %s', transport_report)
+        transport.close()
+    finally:
+        # the caller's stdout is put back, and only a file opened here is
+        # closed
+        sys.stdout = stdout
+        if out is not None and out is not stdout:
+            out.close()
 
     # save to file if --output flag is used
-    if args['output']:
-        logger.info('Saving results to file: %s', args['output'])
-        if os.path.isdir(args['output']):
-            error = IsADirectoryError(errno.EISDIR,
-                                      os.strerror(errno.EISDIR),
-                                      args['output'])
-            logger.error(error)
-            raise error
-        elif not args['output'].endswith('.txt'):
-            error = ValueError('Output file must be a .txt file')
-            logger.exception(error)
-            raise error
-        elif os.path.isfile(args['output']):
-            error = FileExistsError(errno.EEXIST,
-                                    os.strerror(errno.EEXIST),
-                                    args['output'])
-            logger.error(error)
-            raise error
-        else:
-            try:
-                f = open(args['output'], 'w+')
-                f.write(result+'\n')
-                f.close()
-                logger.info('Results succesfully saved.')
-            except Exception as e:
-                logger.error(e)
-                raise(e)
+    if output_format == 'table' and args['output']:
+        save_output(args['output'], result)
+
+    # print and save the HTTP profile if --profile-http is used
+    if args['profile_http'] is not None:
+        print(profiler.report())
+        if looker is not None:
+            print(looker.memo.report())
+        print(transport_report)
+        profile_path = args['profile_http']
+        if not profile_path:
+            profile_dir = os.path.join(METADATA_PATH, 'profile')
+            if not os.path.isdir(profile_dir):
+                os.mkdir(profile_dir)
+            profile_path = os.path.join(profile_dir, time.strftime(
+                                'http_%Y%m%d_%H%M%S.json',
+                                time.localtime(start_time)))
+        profiler.save(profile_path,
+                      henry_version=pkg.__version__,
+                      command=cmd,
+                      host=looker.host if looker is not None
+                      else ','.join(hosts),
+                      started=time.strftime('%Y-%m-%dT%H:%M:%S',
+                                            time.localtime(start_time)),
+                      wall_time=round(time.time() - start_time, 3),
+                      memo=looker.memo.stats() if looker is not None
+                      else None,
+                      transport=transport_stats)
+        print('HTTP profile saved to %s' % profile_path)
+
+    if errors:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -1,27 +1,42 @@
 import logging
 from henry.modules.fetcher import Fetcher as fetcher
+from henry.modules.planner import Plan
 from henry.modules import styler
 from tabulate import tabulate
 import json
 
 
 class Analyze(fetcher):
-    def __init__(self, looker):
-        super().__init__(looker)
+    def __init__(self, looker, usage=None):
+        super().__init__(looker, usage)
         self.analyze_logger = logging.getLogger('analyze')
 
     def analyze(self, **kwargs):
         format = 'plain' if kwargs['plain'] else 'psql'
         headers = '' if kwargs['plain'] else 'keys'
+        result = self.analyze_rows(**kwargs)
+        result = tabulate(result, headers=headers,
+                          tablefmt=format, numalign='center')
+
+        return result
+
+    # returns the results of analyze as a list of rows
+    def analyze_rows(self, **kwargs):
+        return list(self.iter_rows(**kwargs))
+
+    # yields the results of analyze one row at a time, as soon as each is
+    # ready unless they have to be sorted
+    def iter_rows(self, **kwargs):
         p = kwargs['project'] if 'project' in kwargs.keys() else None
         m = kwargs['model'] if 'model' in kwargs.keys() else None
         self.analyze_logger.info('Analyzing %s', kwargs['which'].capitalize())
+        if kwargs['which'] != 'projects':
+            # explores are left for the command to load in batches
+            self.plan(**kwargs).execute(deferred=('get_explore',))
         if kwargs['which'] == 'projects':
             params = {k: kwargs[k] for k in {'project', 'sortkey', 'limit'}}
             self.analyze_logger.info('analyze projects params=%s', params)
-            result = self._analyze_projects(project=p,
-                                            sortkey=kwargs['sortkey'],
-                                            limit=kwargs['limit'])
+            result = self._analyze_projects(project=p)
         elif kwargs['which'] == 'models':
             params = {k: kwargs[k] for k in {'project',
                                              'model',
@@ -32,8 +47,6 @@ class Analyze(fetcher):
             self.analyze_logger.info('analyze models params=%s', params)
             result = self._analyze_models(project=p,
                                           model=m,
-                                          sortkey=kwargs['sortkey'],
-                                          limit=kwargs['limit'],
                                           timeframe=kwargs['timeframe'],
                                           min_queries=kwargs['min_queries'])
         elif kwargs['which'] == 'explores':
@@ -46,20 +59,40 @@ class Analyze(fetcher):
             self.analyze_logger.info('analyze explores params=%s', )
             result = self._analyze_explores(model=m,
                                             explore=kwargs['explore'],
-                                            sortkey=kwargs['sortkey'],
-                                            limit=kwargs['limit'],
                                             timeframe=kwargs['timeframe'],
                                             min_queries=kwargs['min_queries'])
+        yield from styler.sort_limit(result, kwargs['sortkey'],
+                                     kwargs['limit'])
         self.analyze_logger.info('Analyze Complete')
 
-        result = tabulate(result, headers=headers,
-                          tablefmt=format, numalign='center')
-
-        return result
+    # returns the plan of the API calls and usage queries of analyze models
+    # or explores, without making the ones the plan does not depend on
+    def plan(self, profile_dir=None, **kwargs):
+        plan = Plan(self, profile_dir)
+        timeframe = kwargs['timeframe']
+        if kwargs['which'] == 'models':
+            fetcher.get_models(self, project=kwargs.get('project'),
+                               model=kwargs.get('model'), verbose=1)
+            plan.query(self.used_models_query(timeframe), timeframe,
+                       'used models')
+            plan.query(self.explore_usage_query(timeframe), timeframe,
+                       'explore usage')
+        elif kwargs['which'] == 'explores':
+            views = fetcher.plan_explores(self, plan, kwargs.get('model'),
+                                          kwargs['explore'])
+            plan.query(self.used_explore_fields_query(kwargs.get('model'),
+                                                      views, timeframe),
+                       timeframe, 'used fields')
+            # explore usage is always counted over the default timeframe
+            plan.query(self.explore_usage_query(), 90, 'explore usage')
+        else:
+            self.analyze_logger.error('analyze %s cannot be planned',
+                                      kwargs['which'])
+            raise Exception('analyze %s cannot be planned' % kwargs['which'])
+        return plan.done()
 
-    def _analyze_projects(self, project=None, sortkey=None, limit=None):
+    def _analyze_projects(self, project=None):
         projects = fetcher.get_project_files(self, project=project)
-        info = []
         for p in projects:
             metadata = list(map(lambda x:
                                 'model' if x['type'] == 'model' else
@@ -69,103 +102,105 @@ class Analyze(fetcher):
             model_count = metadata.count('model')
             view_count = metadata.count('view')
             git_tests = fetcher.test_git_connection(self, p['name'])
-            info.append({
+            yield {
                 'project': p['name'],
                 'model_count': model_count,
                 'view_count': view_count,
                 'git_connection_status': git_tests,
                 'pull_request_mode': p['pr_mode'],
                 'validation_required': p['validation_required']
-            })
-
-        valid_values = list(info[0].keys())
-        info = styler.sort(info, valid_values, sortkey)
-        info = styler.limit(info, limit=limit)
-
-        return info
+            }
 
-    def _analyze_models(self, project=None, model=None,
-                        sortkey=None, limit=None,
-                        timeframe=90, min_queries=0):
+    def _analyze_models(self, project=None, model=None, timeframe=90,
+                        min_queries=0):
         models = fetcher.get_models(self, project=project,
                                     model=model, verbose=1)
         used_models = fetcher.get_used_models(self, timeframe, min_queries)
-        info = []
+        explore_usage = fetcher.get_explore_usage(self, timeframe, min_queries)
         for m in models:
-            explore_count = len(m['explores'])
-            if m['name'] in used_models:
-                query_run_count = used_models[m['name']]
+            explore_count = len(m.explores)
+            if m.name in used_models:
+                query_run_count = used_models[m.name]
             else:
                 query_run_count = 0
-            unused_explores = fetcher.get_unused_explores(self, m['name'],
-                                                          timeframe,
-                                                          min_queries)
-            info.append({
-                'project': m['project_name'],
-                'model': m['name'],
+            used_explores = explore_usage.get(m.name, {})
+            all_explores = [e.name for e in m.explores]
+            unused_explores = fetcher.get_unused_explores(
+                                            self, m.name,
+                                            used_explores=used_explores,
+                                            all_explores=all_explores)
+            yield {
+                'project': m.project_name,
+                'model': m.name,
                 'explore_count': explore_count,
                 'unused_explores': len(unused_explores),
                 'query_run_count': query_run_count
-            })
-        valid_values = list(info[0].keys())
-        info = styler.sort(info, valid_values, sortkey)
-        info = styler.limit(info, limit=limit)
-        return info
+            }
 
-    def _analyze_explores(self, model=None, explore=None,
-                          sortkey=None, limit=None,
-                          min_queries=0, timeframe=90):
-        explores = fetcher.get_explores(self, model=model,
-                                        explore=explore, verbose=1)
-        explores_usage = {}
-        info = []
+    def _analyze_explores(self, model=None, explore=None, min_queries=0,
+                          timeframe=90):
+        if explore is not None:
+            explores = fetcher.get_explores(self, model=model,
+                                            explore=explore, verbose=1)
+            # don't query usage for an explore that doesn't exist
+            if not explores:
+                self.analyze_logger.error('No matching explores found')
+                raise Exception('No matching explores found')
+            views = explores[0].scopes
+        else:
+            # explores are loaded as they are analyzed
+            explores = fetcher.iter_explores(self, model=model)
+            views = None
+        # fetch usage for all explores up front rather than once per explore
+        used_fields_index = fetcher.get_used_fields_index(self, model, views,
+                                                          timeframe,
+                                                          min_queries)
+        explore_usage = fetcher.get_explore_usage(self)
+        found = False
         for e in explores:
             # in case explore does not exist (bug - #32748)
             if e is None:
                 pass
             else:
-                _used_fields = fetcher.get_used_explore_fields(self,
-                                                               e['model_name'],
-                                                               e['scopes'],
-                                                               timeframe,
-                                                               min_queries)
-                used_fields = list(_used_fields.keys())
+                # fields are handled as bitsets of the model's registry
+                registry = fetcher.field_registry(self, e.model_name)
+                used_fields = fetcher.get_explore_used_fields(
+                                                            self,
+                                                            used_fields_index,
+                                                            e.model_name,
+                                                            e.scopes)
                 exposed_fields = fetcher.get_explore_fields(self,
                                                             explore=e,
                                                             scoped_names=1)
-                unused_fields = set(exposed_fields) - set(used_fields)
+                unused_fields = registry.bitset(exposed_fields) & \
+                    ~used_fields
                 field_count = len(exposed_fields)
-                query_count = fetcher.get_used_explores(self,
-                                                        model=e['model_name'],
-                                                        explore=e['name'])
+                query_count = explore_usage.get(e.model_name, {})
 
-                all_joins = set(e['scopes'])
-                all_joins.remove(e['name'])
-                used_joins = set([i.split('.')[2] for i in used_fields])
+                all_joins = set(e.scopes)
+                all_joins.remove(e.name)
+                used_joins = registry.views_of(used_fields)
                 unused_joins = len(list(all_joins - used_joins))
 
-                has_description = 'Yes' if e['description'] else 'No'
+                has_description = 'Yes' if e.description else 'No'
 
-                if query_count.get(e['name']):
-                    query_count = query_count[e['name']]
+                if query_count.get(e.name):
+                    query_count = query_count[e.name]
                 else:
                     query_count = 0
-                info.append({
-                    'model': e['model_name'],
-                    'explore': e['name'],
-                    'is_hidden': e['hidden'],
+                found = True
+                yield {
+                    'model': e.model_name,
+                    'explore': e.name,
+                    'is_hidden': e.hidden,
                     'has_description': has_description,
                     'join_count': len(all_joins),
                     'unused_joins': unused_joins,
                     'field_count': field_count,
-                    'unused_fields': len(unused_fields),
+                    'unused_fields': registry.count(unused_fields),
                     'query_count': query_count
-                })
+                }
 
-        if not info:
+        if not found:
             self.analyze_logger.error('No matching explores found')
             raise Exception('No matching explores found')
-        valid_values = list(info[0].keys())
-        info = styler.sort(info, valid_values, sortkey)
-        info = styler.limit(info, limit=limit)
-        return info
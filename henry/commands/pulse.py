@@ -1,19 +1,38 @@
+import io
 import logging
 import re
-import requests
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from textwrap import fill
 from tqdm import tqdm
 from tabulate import tabulate
 from tqdm import trange
 from henry.modules.color import color
+from henry.modules import paginator
+
+# endpoint returning the latest Looker release, compared with the instance's
+VERSION_URL = 'https://learn.looker.com:19999/versions'
 
 
 class Pulse(object):
 
     postfix_default = [dict(value="RUNNING")]
 
-    def __init__(self, looker):
+    # results are written to out. progress bars can be turned off, e.g.
+    # when several instances are checked at once. the latest release is
+    # read from version_url
+    def __init__(self, looker, connection_workers=10,
+                 connection_timeout=None, out=None, progress=True,
+                 version_url=VERSION_URL):
         self.looker = looker
+        self.version_url = version_url
+        self.out = out if out is not None else sys.stdout
+        # tqdm writes to stderr when file is None
+        self.bar_file = None if progress else io.StringIO()
+        self.connection_workers = connection_workers
+        self.connection_timeout = connection_timeout
+        self.pending = {}
         self.pulse_logger = logging.getLogger('pulse')
         self.bar = '%s%s{postfix[0][value]}%s {desc}: ' \
                    '{percentage:3.0f}%% |{bar}|[{elapsed}<' \
@@ -24,25 +43,60 @@ class Pulse(object):
 
     def run_all(self):
         self.pulse_logger.info('Checking instance pulse')
+        # the checks following the connection tests do not depend on each
+        # other, so they are all started right away. their progress bars are
+        # still shown one after the other and only wait for the results
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            self._start(executor, 'query_type_count',
+                        self.get_query_type_count)
+            self._start(executor, 'query_stats', self.get_query_stats,
+                        'complete')
+            self._start(executor, 'scheduled_plans',
+                        self.check_scheduled_plans)
+            self._start(executor, 'legacy_features',
+                        self.check_legacy_features)
+            self._start(executor, 'version', self.check_version)
+            try:
+                self._run_all()
+            finally:
+                for future in self.pending.values():
+                    future.cancel()
+                self.pending = {}
+        return
+
+    # runs fn in the background, to be picked up later by _result
+    def _start(self, executor, name, fn, *args):
+        self.pending[name] = executor.submit(fn, *args)
+
+    # returns the result of the check started as name, or runs fn if it
+    # wasn't started in the background
+    def _result(self, name, fn, *args):
+        future = self.pending.pop(name, None)
+        if future is None:
+            return fn(*args)
+        return future.result()
+
+    def _run_all(self):
         self.pulse_logger.info('Checking Connections')
         result = self.check_connections()
-        print(result, end='\n\n')
+        print(result, end='\n\n', file=self.out)
         self.pulse_logger.info('Complete: Checking Connections')
 
         self.pulse_logger.info('Analyzing Query Stats')
         r1, r2, r3 = self.check_query_stats()
-        print(r1)
-        print(r2)
-        print(r3, end='\n\n')
+        print(r1, file=self.out)
+        print(r2, file=self.out)
+        print(r3, end='\n\n', file=self.out)
         self.pulse_logger.info('Complete: Analyzing Query Stats')
 
         # check scheduled plans
         self.pulse_logger.info('Analyzing Query Stats')
         with trange(1, desc='(3/5) Analyzing Scheduled Plans',
                     bar_format=self.bar, postfix=self.postfix_default,
-                    ncols=100, miniters=0) as t:
+                    ncols=100, miniters=0, file=self.bar_file) as t:
             for i in t:
-                result = self.check_scheduled_plans()
+                result = self._result('scheduled_plans',
+                                      self.check_scheduled_plans)
                 fail_flag = 0
                 if type(result) == list and len(result) > 0:
                     if result[0]['failure'] > 0:
@@ -51,37 +105,38 @@ class Pulse(object):
                                       tablefmt='psql', numalign='center')
                 t.postfix[0]["value"] = 'DONE'
                 t.update()
-        print(result, end='\n\n')
+        print(result, end='\n\n', file=self.out)
         if fail_flag == 1:
             print('Navigate to /admin/scheduled_jobs on your instance for '
-                  'more details', end='\n\n')
+                  'more details', end='\n\n', file=self.out)
         self.pulse_logger.info('Complete: Analyzing Scheduled Plans')
 
         # check enabled legacy features
         self.pulse_logger.info('Checking Legacy Features')
         with trange(1, desc='(4/5) Legacy Features', bar_format=self.bar,
-                    postfix=self.postfix_default, ncols=100, miniters=0) as t:
+                    postfix=self.postfix_default, ncols=100, miniters=0,
+                    file=self.bar_file) as t:
             for i in t:
-                result = self.check_legacy_features()
+                result = self._result('legacy_features',
+                                      self.check_legacy_features)
                 t.postfix[0]["value"] = 'DONE'
                 t.update()
-        print(result, end='\n\n')
+        print(result, end='\n\n', file=self.out)
         self.pulse_logger.info('Complete: Checking Legacy Features')
 
         # check looker version
         self.pulse_logger.info('Checking Version')
         t = trange(1, desc='(5/5) Version', bar_format=self.bar,
-                   postfix=self.postfix_default, ncols=100)
+                   postfix=self.postfix_default, ncols=100,
+                   file=self.bar_file)
         for i in t:
-            result = self.check_version()
+            result = self._result('version', self.check_version)
             t.postfix[0]["value"] = "DONE"
             t.update()
-        print(result, end='\n\n')
+        print(result, end='\n\n', file=self.out)
         self.pulse_logger.info('Complete: Checking Version')
         self.pulse_logger.info('Complete: Checking instance pulse')
 
-        return
-
     def check_connections(self):
         result = []
         connections = []
@@ -93,10 +148,22 @@ class Pulse(object):
 
         with tqdm(total=len(connections), desc='(1/5) Testing Connections',
                   bar_format=self.bar, postfix=self.postfix_default,
-                  ncols=100, miniters=0) as t:
-            for idx, (c, tests) in enumerate(connections):
-                tests = {'tests': tests}
-                results = self.looker.test_connection(c, tests)
+                  ncols=100, miniters=0, file=self.bar_file) as t:
+            lock = threading.Lock()
+
+            def progress():
+                with lock:
+                    if t.n == len(connections) - 1:
+                        t.postfix[0]['value'] = 'DONE'
+                    t.update()
+
+            tests = self.looker.map('test_connection',
+                                    [(c, {'tests': tests},
+                                      self.connection_timeout)
+                                     for c, tests in connections],
+                                    progress=progress,
+                                    workers=self.connection_workers)
+            for (c, _), results in zip(connections, tests):
                 formatted_results = []
                 fail_flag = 0
                 for i in results:
@@ -108,21 +175,22 @@ class Pulse(object):
                 status = '\n'.join(formatted_results)
                 result.append({'Connection': c,
                                'Status': 'OK' if fail_flag == 0 else status})
-                if idx == len(connections) - 1:
-                    t.postfix[0]['value'] = 'DONE'
-                t.update()
 
         return tabulate(result, headers="keys", tablefmt='psql')
 
     def check_query_stats(self):
         # check query stats
         with trange(3, desc='(2/5) Analyzing Query Stats', bar_format=self.bar,
-                    postfix=self.postfix_default, ncols=100, miniters=0) as t:
+                    postfix=self.postfix_default, ncols=100, miniters=0,
+                    file=self.bar_file) as t:
             for i in t:
                 if i == 0:
-                    query_count = self.get_query_type_count()
+                    query_count = self._result('query_type_count',
+                                               self.get_query_type_count)
                 if i == 1:
-                    query_runtime_stats = self.get_query_stats('complete')
+                    query_runtime_stats = self._result('query_stats',
+                                                       self.get_query_stats,
+                                                       'complete')
                 if i == 2:
                     slow_queries = self.get_slow_queries(
                                                  query_runtime_stats['avg']*5)
@@ -163,18 +231,13 @@ class Pulse(object):
             },
             "sorts": [
                 "query.id asc"
-            ],
-            "limit": "50000"
+            ]
         }
 
-        r = self.looker.run_inline_query(result_format="json", body=body,
-                                         fields={"cache": "false"})
-
-        if r:
-            ids = (', ').join([str(query['query.id']) for query in r])
-        else:
-            ids = None
-        return ids
+        r = paginator.iter_keyset(self.looker, body, 'query.id',
+                                  fields={"cache": "false"})
+        ids = (', ').join([str(query['query.id']) for query in r])
+        return ids or None
 
     # get number of queries run, killed, completed, errored, queued
     def get_query_type_count(self):
@@ -198,46 +261,44 @@ class Pulse(object):
             "sorts": [
                 "history.created_date desc",
                 "history.result_source"
-            ],
-            "limit": "50000"
+            ]
         }
 
-        r = self.looker.run_inline_query(result_format="json", body=body,
-                                         fields={"cache": "false"})
+        r = paginator.iter_date_windows(self.looker, body, 30,
+                                        fields={"cache": "false"})
         completed = 0
         errored = 0
         killed = 0
         queued = 0
-        if(len(r) > 0):
-            for entry in r:
-                e = entry['history.query_run_count']['history.status']
-                if 'complete' in e:
-                    c_i = e['complete']
-                else:
-                    c_i = 0
-                c_i = c_i if c_i is not None else 0
-                completed += c_i
-
-                if 'error' in e:
-                    e_i = e['error']
-                else:
-                    e_i = 0
-                e_i = e_i if e_i is not None else 0
-                errored += e_i
-
-                if 'killed' in e:
-                    k_i = e['killed']
-                else:
-                    k_i = 0
-                k_i = k_i if k_i is not None else 0
-                killed += k_i
-
-                if 'pending' in e:
-                    q_i = e['pending']
-                else:
-                    q_i = 0
-                q_i = q_i if q_i is not None else 0
-                queued += q_i
+        for entry in r:
+            e = entry['history.query_run_count']['history.status']
+            if 'complete' in e:
+                c_i = e['complete']
+            else:
+                c_i = 0
+            c_i = c_i if c_i is not None else 0
+            completed += c_i
+
+            if 'error' in e:
+                e_i = e['error']
+            else:
+                e_i = 0
+            e_i = e_i if e_i is not None else 0
+            errored += e_i
+
+            if 'killed' in e:
+                k_i = e['killed']
+            else:
+                k_i = 0
+            k_i = k_i if k_i is not None else 0
+            killed += k_i
+
+            if 'pending' in e:
+                q_i = e['pending']
+            else:
+                q_i = 0
+            q_i = q_i if q_i is not None else 0
+            queued += q_i
 
         response = {'total': completed + errored + killed,
                     'completed': completed,
@@ -340,8 +401,11 @@ class Pulse(object):
     def check_version(self):
         _v = self.looker.get_version()['looker_release_version']
         version = re.findall(r'(\d.\d+)', _v)[0]
-        session = requests.Session()
-        _lv = session.get('https://learn.looker.com:19999/versions').json()
+        # the shared pools are used without the API session's token, which
+        # is not meant for other hosts
+        session = self.looker.transport.session()
+        _lv = session.get(self.version_url,
+                          timeout=self.looker.timeout).json()
         _lv = _lv['looker_release_version']
         latest_version = re.findall(r'(\d.\d+)', _lv)[0]
         if version == latest_version:
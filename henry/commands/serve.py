@@ -0,0 +1,139 @@
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+from henry.modules import daemon
+from henry.modules.cache import Memo
+from henry.commands.analyze import Analyze
+from henry.commands.vacuum import Vacuum
+
+
+# an authenticated API client and the usage store used with it. commands
+# on the same session run one at a time
+class Session(object):
+    def __init__(self):
+        self.looker = None
+        self.usage = None
+        self.lock = threading.Lock()
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = daemon.receive(self.rfile)
+        if request is not None:
+            daemon.send(self.wfile, self.server.serve.run(request))
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+# runs the analyze and vacuum commands that henry forwards over the unix
+# socket at path. an API session is kept per host and set of credentials,
+# so that later commands reuse its token, its open connections and its
+# caches. connect returns a new LookerApi given a command's authentication
+# arguments and config file path, usage_store returns a new UsageStore
+class Serve(object):
+    def __init__(self, path, connect, usage_store, use_usage_store=False):
+        self.path = path
+        self.connect = connect
+        self.usage_store = usage_store
+        self.use_usage_store = use_usage_store
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.serve_logger = logging.getLogger('serve')
+
+    def run_forever(self):
+        if os.path.exists(self.path):
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                s.connect(self.path)
+            except OSError:
+                self.serve_logger.info('Removing stale socket %s', self.path)
+                os.remove(self.path)
+            else:
+                self.serve_logger.error('A daemon is already running on %s',
+                                        self.path)
+                raise Exception('A daemon is already running on %s'
+                                % self.path)
+            finally:
+                s.close()
+        # only the user may connect to the socket
+        umask = os.umask(0o177)
+        try:
+            server = Server(self.path, Handler)
+        finally:
+            os.umask(umask)
+        server.serve = self
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+        self.serve_logger.info('Serving on %s', self.path)
+        print('Serving on %s. Press Ctrl+C to stop.' % self.path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(self.path)
+            for session in self.sessions.values():
+                if session.usage is not None:
+                    session.usage.close()
+            self.serve_logger.info('Stopped serving on %s', self.path)
+
+    def session(self, auth_args, config_path):
+        key = json.dumps([auth_args, config_path], sort_keys=True)
+        with self.lock:
+            return self.sessions.setdefault(key, Session())
+
+    # runs the command in request and returns the reply to send back
+    def run(self, request):
+        args = request['args']
+        auth_args = request['auth']
+        self.serve_logger.info('Running %s %s on %s', args['command'],
+                               args['which'], auth_args['host'])
+        session = self.session(auth_args, request['config_path'])
+        try:
+            with session.lock:
+                # a command may have left the shared API session in another
+                # workspace, e.g. if analyze projects failed to switch back.
+                # sessions that cannot be switched back are replaced
+                if session.looker is not None and \
+                        session.looker.workspace != 'production':
+                    self.serve_logger.info('Switching session on %s back to '
+                                           'production', auth_args['host'])
+                    if session.looker.update_session('production') is None:
+                        session.looker = None
+                if session.looker is None:
+                    session.looker = self.connect(auth_args,
+                                                  request['config_path'])
+                # results are only shared within a command, later ones go
+                # through the caches
+                session.looker.memo = Memo()
+                if self.use_usage_store or args.get('usage_store'):
+                    if session.usage is None:
+                        session.usage = self.usage_store()
+                    usage = session.usage
+                else:
+                    usage = None
+                if args['command'] == 'analyze':
+                    result = Analyze(session.looker, usage).analyze(**args)
+                else:
+                    result = Vacuum(session.looker, usage).vacuum(**args)
+                self.serve_logger.info('Memo: %s',
+                                       session.looker.memo.report())
+        except SystemExit as e:
+            # the error was printed by the daemon and is in its log
+            status = e.code if isinstance(e.code, int) and e.code else 1
+            self.serve_logger.error('%s exited with status %s',
+                                    args['command'], status)
+            return {'status': status,
+                    'error': 'The daemon exited the command with status %s. '
+                             'See its output and log for details.' % status}
+        except Exception as e:
+            self.serve_logger.exception(e)
+            return {'status': 1, 'error': '%s: %s' % (type(e).__name__, e)}
+        return {'status': 0, 'result': result}
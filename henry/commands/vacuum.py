@@ -1,19 +1,34 @@
 import logging
 from henry.modules import styler
 from henry.modules.fetcher import Fetcher as fetcher
-import re
+from henry.modules.fetcher import MODEL_FIELDS
+from henry.modules.planner import Plan
 
 
 class Vacuum(fetcher):
-    def __init__(self, looker):
-        super().__init__(looker)
+    def __init__(self, looker, usage=None):
+        super().__init__(looker, usage)
         self.vacuum_logger = logging.getLogger('vacuum')
 
     def vacuum(self, **kwargs):
-        p = kwargs['project'] if 'project' in kwargs.keys() else None
-        m = kwargs['model'] if 'model' in kwargs.keys() else None
         format = 'plain' if kwargs['plain'] else 'psql'
         headers = '' if kwargs['plain'] else 'keys'
+        result = self.vacuum_rows(**kwargs)
+        result = styler.tabulate(result, headers=headers,
+                                 tablefmt=format, numalign='center')
+        return result
+
+    # returns the results of vacuum as a list of rows
+    def vacuum_rows(self, **kwargs):
+        return list(self.iter_rows(**kwargs))
+
+    # yields the results of vacuum one row at a time, as soon as each is
+    # ready
+    def iter_rows(self, **kwargs):
+        p = kwargs['project'] if 'project' in kwargs.keys() else None
+        m = kwargs['model'] if 'model' in kwargs.keys() else None
+        # explores are left for the command to load in batches
+        self.plan(**kwargs).execute(deferred=('get_explore',))
         if kwargs['which'] == 'models':
             self.vacuum_logger.info('Vacuuming Models')
             params = {k: kwargs[k] for k in {'project',
@@ -36,90 +51,118 @@ class Vacuum(fetcher):
                                            explore=kwargs['explore'],
                                            min_queries=kwargs['min_queries'],
                                            timeframe=kwargs['timeframe'])
+        yield from result
         self.vacuum_logger.info('Vacuum Complete')
-        result = styler.tabulate(result, headers=headers,
-                                 tablefmt=format, numalign='center')
-        return result
+
+    # returns the plan of the API calls and usage queries of vacuum, without
+    # making the ones the plan does not depend on
+    def plan(self, profile_dir=None, **kwargs):
+        plan = Plan(self, profile_dir)
+        timeframe = kwargs['timeframe']
+        model = kwargs.get('model')
+        if kwargs['which'] == 'models':
+            # listed models already hold the names of their explores
+            if model is None:
+                fetcher.get_models(self, project=kwargs.get('project'))
+            else:
+                for m in model.split():
+                    plan.api('get_model', m, MODEL_FIELDS)
+            plan.query(self.used_models_query(timeframe), timeframe,
+                       'used models')
+            plan.query(self.explore_usage_query(timeframe), timeframe,
+                       'explore usage')
+        else:
+            views = fetcher.plan_explores(self, plan, model,
+                                          kwargs['explore'])
+            plan.query(self.used_explore_fields_query(model, views,
+                                                      timeframe),
+                       timeframe, 'used fields')
+        return plan.done()
 
     def _vacuum_models(self, project=None, model=None, timeframe=90,
                        min_queries=0):
+        # only the explore names listed by the models are needed, not their
+        # definitions. listed models already hold them, so only the models
+        # passed by name are fetched again
         if model is None:
-            model = fetcher.get_models(self, project=project)
+            models = {m.name: [e.name for e in m.explores]
+                      for m in fetcher.get_models(self, project=project,
+                                                  verbose=1)}
         else:
-            model = model.split()
+            models = dict.fromkeys(model.split())
         used_models = fetcher.get_used_models(self, timeframe)
-        info = []
-        for m in model:
-            explores = [e['name'] for e in fetcher.get_explores(self, model=m,
-                                                                verbose=1)]
-            unused_explores = fetcher.get_unused_explores(self, m,
-                                                          timeframe,
-                                                          min_queries)
+        explore_usage = fetcher.get_explore_usage(self, timeframe, min_queries)
+        for m, explores in models.items():
+            unused_explores = fetcher.get_unused_explores(
+                                        self, m,
+                                        used_explores=explore_usage.get(m, {}),
+                                        all_explores=explores)
             query_run_count = used_models[m] if m in used_models.keys() else 0
             unused_explores = ('\n').join(unused_explores)
-            info.append({
-                        'model': m,
-                        'unused_explores': unused_explores or 'None',
-                        'model_query_run_count': query_run_count})
-
-        return info
+            yield {'model': m,
+                   'unused_explores': unused_explores or 'None',
+                   'model_query_run_count': query_run_count}
 
     def _vacuum_explores(self, model=None, explore=None, timeframe=90,
                          min_queries=0):
-        explores = fetcher.get_explores(self,
-                                        model=model,
-                                        explore=explore,
-                                        verbose=1)
-        info = []
+        if explore is not None:
+            explores = fetcher.get_explores(self,
+                                            model=model,
+                                            explore=explore,
+                                            verbose=1)
+            # don't query usage for an explore that doesn't exist
+            if not explores:
+                self.vacuum_logger.error('No matching explores found')
+                raise Exception('No matching explores found')
+            views = explores[0].scopes
+        else:
+            # explores are loaded as they are vacuumed
+            explores = fetcher.iter_explores(self, model=model)
+            views = None
+        # get field usage from i__looker for all explores in one go
+        used_fields_index = fetcher.get_used_fields_index(self, model, views,
+                                                          timeframe,
+                                                          min_queries)
+        found = False
         for e in explores:
-            # get field usage from i__looker using all the views inside explore
+            # look up field usage using all the views inside explore
             # returns fields in the form of model.explore.view.field
-            _used_fields = fetcher.get_used_explore_fields(self,
-                                                           e['model_name'],
-                                                           e['scopes'],
-                                                           timeframe,
-                                                           min_queries)
-            used_fields = list(_used_fields.keys())
+            # fields are handled as bitsets of the model's registry
+            registry = fetcher.field_registry(self, e.model_name)
+            used_fields = fetcher.get_explore_used_fields(self,
+                                                          used_fields_index,
+                                                          e.model_name,
+                                                          e.scopes)
             # get field picker fields in the form of model.explore.view.field
             exposed_fields = fetcher.get_explore_fields(self,
                                                         explore=e,
                                                         scoped_names=1)
-            _unused_fields = set(exposed_fields) - set(used_fields)
+            _unused_fields = registry.bitset(exposed_fields) & ~used_fields
 
             # remove scoping
-            all_joins = set(e['scopes'])
-            all_joins.remove(e['name'])
-            used_joins = set([i.split('.')[2] for i in used_fields])
+            all_joins = set(e.scopes)
+            all_joins.remove(e.name)
+            used_joins = registry.views_of(used_fields)
 
             _unused_joins = list(all_joins - used_joins)
             unused_joins = ('\n').join(_unused_joins) or 'N/A'
 
             # only keep fields that belong to used joins (unused joins fields
-            # don't matter) if there's at least one used join (including the
-            # base view). else don't match anything
-            temp = list(used_joins)
-            temp.append(e['name'])
-            pattern = ('|').join(temp) or 'ALL'
+            # don't matter), the base view included. a field belongs to a
+            # join if its view.field name starts with the join name, so the
+            # names are looked up by the prefixes of each length they have
+            joins = used_joins | {e.name}
+            lengths = sorted(set(len(j) for j in joins))
             unused_fields = []
-            if pattern != 'ALL':
-                for field in _unused_fields:
-                    f = re.match(r'^({0}).*'.format(pattern),
-                                 '.'.join(field.split('.')[2:]))
-                    if f is not None:
-                        unused_fields.append(f.group(0))
-                unused_fields = sorted(unused_fields)
-                unused_fields = ('\n').join(unused_fields)
-            else:
-                unused_fields = styler.color.format(pattern,
-                                                    'fail',
-                                                    'color')
-            info.append({
-                        'model': e['model_name'],
-                        'explore': e['name'],
-                        'unused_joins': unused_joins,
-                        'unused_fields': unused_fields
-                        })
-        if not info:
+            for name in registry.local_names_of(_unused_fields):
+                if any(name[:k] in joins for k in lengths):
+                    unused_fields.append(name)
+            unused_fields = ('\n').join(sorted(unused_fields))
+            found = True
+            yield {'model': e.model_name,
+                   'explore': e.name,
+                   'unused_joins': unused_joins,
+                   'unused_fields': unused_fields}
+        if not found:
             self.vacuum_logger.error('No matching explores found')
             raise Exception('No matching explores found')
-        return info
@@ -0,0 +1,202 @@
+# -*- coding: UTF-8 -*-
+import asyncio
+import json
+import logging
+import time
+import zlib
+import aiohttp
+from .lookerapi import cache_key
+
+
+# bodies are read as they came over the wire, so that their size can be
+# profiled, and decompressed here. the headers of gzip and zlib streams are
+# told apart from the body
+def decompress(body, encoding):
+    if encoding in ('gzip', 'deflate'):
+        return zlib.decompress(body, 32 + zlib.MAX_WBITS)
+    return body
+
+
+# coroutine based counterpart of the LookerApi methods that LookerApi.map
+# fans out. it reuses the host, credentials and cache of an authenticated
+# LookerApi and issues all requests over one pooled aiohttp session, running
+# at most concurrency requests at a time. map() gives synchronous callers a
+# way to fan out hundreds of requests on a single thread
+class AsyncLookerApi(object):
+    def __init__(self, looker, concurrency=10):
+        self.api_logger = logging.getLogger('lookerapi')
+        self.looker = looker
+        self.host = looker.host
+        self.port = looker.port
+        self.concurrency = max(1, concurrency)
+        self.loop = asyncio.new_event_loop()
+        self.session = None
+        self.semaphore = None
+
+    def _timeout(self):
+        timeout = self.looker.timeout
+        if isinstance(timeout, (tuple, list)):
+            return aiohttp.ClientTimeout(sock_connect=timeout[0],
+                                         sock_read=timeout[1])
+        return aiohttp.ClientTimeout(total=timeout)
+
+    # the session and semaphore have to be created inside the event loop
+    def _open(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.concurrency,
+                                             ssl=False)
+            session_headers = self.looker.session.headers
+            # the token is sent with each request as it may be renewed
+            headers = {'User-Agent': session_headers.get('User-Agent', ''),
+                       'Accept-Encoding': session_headers.get(
+                                                        'Accept-Encoding',
+                                                        'gzip, deflate')}
+            self.session = aiohttp.ClientSession(connector=connector,
+                                                 headers=headers,
+                                                 timeout=self._timeout(),
+                                                 auto_decompress=False)
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self.session
+
+    def close(self):
+        if self.session is not None:
+            self.loop.run_until_complete(self.session.close())
+            self.session = None
+        self.loop.close()
+
+    # runs the coroutine method once for every tuple of arguments in calls
+    # and returns the results in the same order as calls. progress, if given,
+    # is called every time a request completes. workers further limits how
+    # many of these calls run at a time
+    def map(self, method, calls, progress=None, workers=None):
+        return self.loop.run_until_complete(self.gather(method, calls,
+                                                        progress, workers))
+
+    async def gather(self, method, calls, progress=None, workers=None):
+        fn = getattr(self, method)
+        limit = asyncio.Semaphore(max(1, workers or self.concurrency))
+
+        async def call(args):
+            async with limit:
+                result = await fn(*args)
+            if progress is not None:
+                progress()
+            return result
+
+        calls = list(calls)
+        self.api_logger.info('Running %s %s times concurrently (max %s)',
+                             method, len(calls), self.concurrency)
+        return await asyncio.gather(*[call(args) for args in calls])
+
+    # issues a request and returns its status code and decoded body
+    async def _request(self, method, path, params=None, data=None,
+                       json_body=None, timeout=None):
+        url = 'https://{}:{}/api/3.0/{}'.format(self.host, self.port, path)
+        self._open()
+        params = {k: str(v) for k, v in (params or {}).items()}
+        # aiohttp only falls back to the session's timeout when none is
+        # passed, None would turn the timeout off
+        kwargs = {}
+        if timeout is not None:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+        # a request turned down with a 401, e.g. because the token expired
+        # or was revoked, is sent once more after authenticating again
+        for attempt in range(2):
+            authorization = 'token %s' % self.looker.get_access_token()
+            async with self.semaphore:
+                start = time.perf_counter()
+                async with self.session.request(
+                                method, url, params=params, data=data,
+                                json=json_body,
+                                headers={'Authorization': authorization},
+                                **kwargs) as r:
+                    body = await r.read()
+                    latency = time.perf_counter() - start
+                    status = r.status
+                    encoding = r.headers.get('Content-Encoding', '').lower()
+            profiler = self.looker.profiler
+            if profiler is not None:
+                request_body = data
+                if json_body is not None:
+                    request_body = json.dumps(json_body)
+                request_bytes = len(request_body.encode('utf-8')) \
+                    if request_body else 0
+                profile = profiler.record(method, url, status, latency,
+                                          request_bytes, len(body))
+            if status != 401 or attempt:
+                break
+            # LookerApi authenticates with a blocking request
+            await self.loop.run_in_executor(None,
+                                            self.looker.reauthenticate,
+                                            authorization)
+        if status >= 400:
+            return status, None
+        body = decompress(body, encoding)
+        start = time.perf_counter()
+        value = json.loads(body.decode('utf-8'))
+        if profiler is not None:
+            profile['decode_time'] += time.perf_counter() - start
+        return status, value
+
+    def _error(self, status, path):
+        return aiohttp.ClientResponseError(None, (), status=status,
+                                           message='Error for %s' % path)
+
+# GET /lookml_models/{{NAME}}
+    async def get_model(self, model_name=None, fields={}):
+        params = fields
+        key = cache_key('get_model', model_name, fields=params)
+        cached = self.looker._cache_get(key)
+        if cached is not None:
+            return [cached]
+        self.api_logger.info('Request to %s => GET /api/3.0/lookml_models/%s,'
+                             ' %s', self.host, model_name, params)
+        path = 'lookml_models/{}'.format(model_name)
+        status, model = await self._request('GET', path, params)
+        if model is None:
+            self.api_logger.error('Request Complete: %s', status)
+            raise self._error(status, path)
+        self.api_logger.info('Request Complete: %s', status)
+        self.looker._cache_set(key, model)
+        return [model]
+
+# GET /lookml_models/{{NAME}}/explores/{{NAME}}
+    async def get_explore(self, model_name=None, explore_name=None,
+                          fields={}):
+        params = fields
+        key = cache_key('get_explore', model_name, explore_name, params)
+        cached = self.looker._cache_get(key)
+        if cached is not None:
+            return [cached]
+        self.api_logger.info('Request to %s => GET /api/3.0/lookml_models/%s'
+                             '/explores/%s, %s', self.host, model_name,
+                             explore_name, params)
+        path = 'lookml_models/{}/explores/{}'.format(model_name, explore_name)
+        status, explore = await self._request('GET', path, params)
+        if explore is None:
+            self.api_logger.error('Request Complete: %s', status)
+            return []
+        self.api_logger.info('Request Complete: %s', status)
+        self.looker._cache_set(key, explore)
+        return [explore]
+
+# PUT /connections/{connection_name}/test
+    async def test_connection(self, connection, fields={}, timeout=None):
+        params = fields
+        self.api_logger.info('Request to %s => POST /api/3.0/connections/'
+                             '%s/test, %s', self.host, connection, params)
+        path = 'connections/{}/test'.format(connection)
+        try:
+            status, results = await self._request('PUT', path, params,
+                                                  timeout=timeout)
+        except asyncio.TimeoutError:
+            self.api_logger.warning('Connection test for %s timed out',
+                                    connection)
+            return [{'name': 'timeout', 'status': 'error',
+                     'message': 'Connection test timed out after %s seconds'
+                                % (timeout or self.looker.timeout)}]
+        if results is None:
+            self.api_logger.warning('Request Complete: %s', status)
+            return
+        self.api_logger.info('Request Complete: %s', status)
+        return results
@@ -9,7 +9,9 @@ auth_logger = logging.getLogger('auth')
 
 # returns an instanstiated Looker object using the
 # credentials supplied by the auth argument group
-def authenticate(timeout, session_info, config_path, **kwargs):
+def authenticate(timeout, session_info, config_path, workers=1, cache=None,
+                 profiler=None, cassette=None, token_cache=None,
+                 transport=None, **kwargs):
     auth_logger.info('Authenticating into Looker API')
     # precedence: --path, global config, default
     cleanpath = kwargs['path'] or config_path
@@ -32,11 +34,11 @@ def authenticate(timeout, session_info, config_path, **kwargs):
         auth_logger.info('Opening config file from %s' % cleanpath)
         try:
             f = open(cleanpath, 'r')
-            params = yaml.load(f)
+            params = yaml.safe_load(f)
             f.close()
         except FileNotFoundError as error:
             auth_logger.exception(error, exc_info=False)
-            print('ERROR: %s not found' % filepath)
+            print('ERROR: %s not found' % cleanpath)
             sys.exit(1)
 
         try:
@@ -65,6 +67,12 @@ def authenticate(timeout, session_info, config_path, **kwargs):
                        access_token=token,
                        timeout=timeout,
                        session_info=session_info,
+                       workers=workers,
+                       cache=cache,
+                       profiler=profiler,
+                       cassette=cassette,
+                       token_cache=token_cache,
+                       transport=transport,
                        )
     auth_logger.info('Authentication Successful')
 
@@ -97,3 +105,16 @@ def authenticate(timeout, session_info, config_path, **kwargs):
         os.chmod(cleanpath, 0o600)
 
     return looker
+
+
+# returns the host aliases saved in the config file
+def list_hosts(config_path, path=None):
+    cleanpath = path or config_path
+    try:
+        with open(cleanpath, 'r') as f:
+            params = yaml.safe_load(f) or {}
+    except FileNotFoundError as error:
+        auth_logger.exception(error, exc_info=False)
+        print('ERROR: %s not found' % cleanpath)
+        sys.exit(1)
+    return sorted((params.get('hosts') or {}).keys())
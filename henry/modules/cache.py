@@ -0,0 +1,224 @@
+# cache.py
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+cache_logger = logging.getLogger('cache')
+
+
+# persistent cache for LookML metadata API responses. entries are stored as
+# json files under path/host and expire after ttl seconds. once the cache
+# grows beyond max_size bytes, the oldest entries are evicted. with refresh
+# set, entries are never read but are still written so that the next run
+# starts warm
+class MetadataCache(object):
+    def __init__(self, path, ttl=3600, max_size=100 * 1024 ** 2,
+                 refresh=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.refresh = refresh
+        self.size = None
+        self.lock = threading.Lock()
+
+    def _entry(self, host, key):
+        key = json.dumps(key, sort_keys=True).encode('utf-8')
+        return os.path.join(self.path, host,
+                            hashlib.sha1(key).hexdigest() + '.json')
+
+    def get(self, host, key):
+        if self.refresh:
+            return None
+        entry = self._entry(host, key)
+        try:
+            if time.time() - os.path.getmtime(entry) > self.ttl:
+                cache_logger.info('Cache entry expired: %s', entry)
+                return None
+            with open(entry, 'r') as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            return None
+        cache_logger.info('Cache hit: %s', key)
+        return value
+
+    def set(self, host, key, value):
+        entry = self._entry(host, key)
+        os.makedirs(os.path.dirname(entry), mode=0o700, exist_ok=True)
+        tmp = '%s.%s.tmp' % (entry, threading.get_ident())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(value, f)
+            old_size = os.path.getsize(entry) if os.path.isfile(entry) else 0
+            os.replace(tmp, entry)
+            new_size = os.path.getsize(entry)
+        except OSError as e:
+            cache_logger.warning('Could not write cache entry %s: %s',
+                                 entry, e)
+            return
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _, _, size in self._entries())
+            else:
+                self.size += new_size - old_size
+            if self.size > self.max_size:
+                self.evict()
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+                entry = os.path.join(root, name)
+                try:
+                    st = os.stat(entry)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, entry, st.st_size))
+        return entries
+
+    # removes expired entries, then the oldest ones until the cache takes up
+    # no more than 90% of max_size
+    def evict(self):
+        entries = sorted(self._entries())
+        size = sum(size for _, _, size in entries)
+        now = time.time()
+        removed = 0
+        for mtime, entry, entry_size in entries:
+            if size <= self.max_size * 0.9 and now - mtime <= self.ttl:
+                continue
+            try:
+                os.remove(entry)
+            except OSError:
+                continue
+            size -= entry_size
+            removed += 1
+        cache_logger.info('Evicted %s cache entries, cache size is now %s '
+                          'bytes', removed, size)
+        self.size = size
+
+
+# in-memory cache for long running processes, optionally in front of a
+# MetadataCache. values are kept serialized so that callers changing what
+# they got back can't affect later readers
+class MemoryCache(object):
+    def __init__(self, ttl=3600, backend=None):
+        self.ttl = ttl
+        self.backend = backend
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, host, key):
+        entry_key = (host, json.dumps(key, sort_keys=True))
+        with self.lock:
+            entry = self.entries.get(entry_key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self.entries[entry_key]
+                entry = None
+        if entry is not None:
+            return json.loads(entry[1])
+        if self.backend is None:
+            return None
+        value = self.backend.get(host, key)
+        if value is not None:
+            with self.lock:
+                self.entries[entry_key] = (time.time(), json.dumps(value))
+        return value
+
+    def set(self, host, key, value):
+        with self.lock:
+            self.entries[(host, json.dumps(key, sort_keys=True))] = (
+                                                time.time(), json.dumps(value))
+        if self.backend is not None:
+            self.backend.set(host, key, value)
+
+
+# a call that is in flight, and its outcome once it completes
+class Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# results of the API calls made during a run, by key. concurrent calls with
+# the same key share a single call: the first caller makes it and the
+# others wait for its outcome. results are handed out as is, so callers
+# must not change them. errors are passed on to the callers waiting for
+# them but not kept
+class Memo(object):
+    def __init__(self):
+        self.results = {}
+        self.flights = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.results
+
+    # returns whether a result is kept for key, and the result
+    def lookup(self, key):
+        with self.lock:
+            if key in self.results:
+                self.hits += 1
+                return True, self.results[key]
+            self.misses += 1
+            return False, None
+
+    def store(self, key, result):
+        with self.lock:
+            self.results[key] = result
+
+    def call(self, key, fn):
+        with self.lock:
+            if key in self.results:
+                self.hits += 1
+                return self.results[key]
+            flight = self.flights.get(key)
+            if flight is None:
+                self.misses += 1
+                flight = self.flights[key] = Flight()
+                owner = True
+            else:
+                self.shared += 1
+                owner = False
+        if not owner:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                if flight.error is None:
+                    self.results[key] = flight.result
+                del self.flights[key]
+            flight.done.set()
+        return flight.result
+
+    def clear(self):
+        with self.lock:
+            self.results = {}
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'shared': self.shared,
+                    'misses': self.misses}
+
+    def report(self):
+        stats = self.stats()
+        calls = sum(stats.values())
+        saved = stats['hits'] + stats['shared']
+        return '%s of %s API calls answered without a request (%s from ' \
+               'memory, %s shared with a call in flight)' % (
+                    saved, calls, stats['hits'], stats['shared'])
@@ -0,0 +1,157 @@
+# cassette.py
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+from urllib.parse import urlparse, parse_qsl, urlencode
+from requests.exceptions import ConnectionError
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from .transport import PooledAdapter
+
+cassette_logger = logging.getLogger('cassette')
+
+CASSETTE_FILE = 'cassette.json.gz'
+# request parameters that are left out of recordings
+SECRETS = ('client_id', 'client_secret')
+# response fields that are redacted from recordings
+REDACTED = ('access_token',)
+
+
+# identifies a request by its method, API path, query parameters and a hash
+# of its normalized body. JSON bodies are re-serialized with sorted keys so
+# that the same query body always matches, whatever order it was built in
+def request_key(request):
+    url = urlparse(request.url)
+    params = sorted((k, v) for k, v in parse_qsl(url.query, True)
+                    if k not in SECRETS)
+    body = request.body or b''
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    body_hash = ''
+    if body:
+        try:
+            normalized = json.dumps(json.loads(body.decode('utf-8')),
+                                    sort_keys=True)
+        except ValueError:
+            normalized = urlencode(sorted(
+                    (k, v) for k, v in parse_qsl(body.decode('utf-8'), True)
+                    if k not in SECRETS))
+        body_hash = hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+    return '%s %s?%s %s' % (request.method, url.path, urlencode(params),
+                            body_hash)
+
+
+# a recording of API responses kept as gzipped JSON in path. in record mode
+# every response received is added to it; in replay mode responses are
+# served from it and nothing is sent over the network. requests made more
+# than once are replayed in the order they were recorded
+class Cassette(object):
+    def __init__(self, path, mode):
+        if mode not in ('record', 'replay'):
+            raise ValueError('Invalid cassette mode: %s' % mode)
+        self.path = path
+        self.mode = mode
+        self.interactions = {}
+        self.played = {}
+        self.lock = threading.Lock()
+        if mode == 'replay':
+            self.load()
+
+    def _file(self):
+        return os.path.join(self.path, CASSETTE_FILE)
+
+    def load(self):
+        try:
+            with gzip.open(self._file(), 'rt', encoding='utf-8') as f:
+                cassette = json.load(f)
+        except OSError as e:
+            cassette_logger.error('Could not load cassette: %s', e)
+            raise Exception('Could not load cassette from %s' % self.path)
+        for i in cassette['interactions']:
+            self.interactions.setdefault(i['request'], []).append(
+                                                            i['response'])
+        cassette_logger.info('Loaded %s recorded requests from %s',
+                             len(cassette['interactions']), self._file())
+
+    def save(self):
+        if self.mode != 'record':
+            return
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        interactions = [{'request': key, 'response': response}
+                        for key, responses in sorted(self.interactions.items())
+                        for response in responses]
+        with gzip.open(self._file(), 'wt', encoding='utf-8') as f:
+            json.dump({'version': 1, 'interactions': interactions}, f,
+                      separators=(',', ':'))
+        cassette_logger.info('Saved %s requests to %s', len(interactions),
+                             self._file())
+
+    def record(self, request, response):
+        body = response.content or b''
+        if response.headers.get('Content-Type', '').startswith(
+                                                        'application/json'):
+            body = self._redact(body)
+        entry = {'status': response.status_code,
+                 'reason': response.reason,
+                 'content_type': response.headers.get('Content-Type'),
+                 'body': body.decode('utf-8', 'replace')}
+        with self.lock:
+            self.interactions.setdefault(request_key(request),
+                                         []).append(entry)
+
+    def _redact(self, body):
+        try:
+            value = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return body
+        if isinstance(value, dict) and any(k in value for k in REDACTED):
+            for k in REDACTED:
+                if k in value:
+                    value[k] = 'REDACTED'
+            return json.dumps(value).encode('utf-8')
+        return body
+
+    def play(self, request):
+        key = request_key(request)
+        with self.lock:
+            responses = self.interactions.get(key)
+            if not responses:
+                cassette_logger.error('No recorded response for %s', key)
+                raise ConnectionError('No recorded response for %s' % key,
+                                      request=request)
+            n = self.played.get(key, 0)
+            self.played[key] = n + 1
+        entry = responses[min(n, len(responses) - 1)]
+        response = Response()
+        response.status_code = entry['status']
+        response.reason = entry['reason']
+        response.headers = CaseInsensitiveDict()
+        if entry['content_type']:
+            response.headers['Content-Type'] = entry['content_type']
+        response._content = entry['body'].encode('utf-8')
+        response._content_consumed = True
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def adapter(self, **kwargs):
+        return CassetteAdapter(self, **kwargs)
+
+
+# transport adapter that records the responses of the requests it sends or
+# replays them from the cassette
+class CassetteAdapter(PooledAdapter):
+    def __init__(self, cassette, **kwargs):
+        self.cassette = cassette
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if self.cassette.mode == 'replay':
+            return self.cassette.play(request)
+        response = super().send(request, **kwargs)
+        self.cassette.record(request, response)
+        return response
@@ -0,0 +1,42 @@
+# daemon.py
+# client side of `henry serve`. requests and replies are single lines of
+# json sent over a unix socket. this module is imported by every command
+# that may be forwarded, so it only uses the standard library
+import json
+import logging
+import socket
+
+daemon_logger = logging.getLogger('daemon')
+
+
+def send(f, message):
+    f.write(json.dumps(message).encode('utf-8') + b'\n')
+    f.flush()
+
+
+def receive(f):
+    line = f.readline()
+    if not line:
+        return None
+    return json.loads(line.decode('utf-8'))
+
+
+# sends request to the daemon listening on path and returns its reply, or
+# None if no daemon is running there
+def forward(path, request):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except OSError as e:
+        daemon_logger.info('No daemon listening on %s: %s', path, e)
+        s.close()
+        return None
+    daemon_logger.info('Forwarding %s to daemon on %s', request['command'],
+                       path)
+    with s, s.makefile('rwb') as f:
+        send(f, request)
+        reply = receive(f)
+    if reply is None:
+        daemon_logger.error('Daemon on %s closed the connection', path)
+        raise Exception('The daemon on %s stopped before replying' % path)
+    return reply
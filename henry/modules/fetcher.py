@@ -1,26 +1,52 @@
 from . import styler
-from collections import Counter
+from . import paginator
+from .fieldregistry import FieldRegistry
+from .lookml import Explore, Model
+import json
 import logging
 import re
 
+# history columns that field usage is collected from and the pattern
+# matching view.field names in them
+FIELD_COLUMNS = ('query.formatted_fields', 'query.formatted_filters',
+                 'query.formatted_pivots', 'query.sorts')
+FIELD_PATTERN = re.compile(r'(\w+\.\w+)')
+
+# attributes requested from the API by each call site, in the syntax of the
+# fields parameter, where name(a,b) selects a and b of every element of
+# name. they list everything henry reads from these payloads; the rest of
+# an explore's field definitions (sql, links, labels, ...) is left out
+PROJECT_FIELDS = {'fields': 'id,pull_request_mode,validation_required,'
+                            'git_remote_url'}
+PROJECT_FILE_FIELDS = {'fields': 'type'}
+MODEL_FIELDS = {'fields': 'name,project_name,has_content,explores(name)'}
+EXPLORE_FIELDS = {'fields': 'name,model_name,hidden,description,scopes,'
+                            'fields(dimensions(name,hidden),'
+                            'measures(name,hidden),filters(name,hidden))'}
+
 
 class Fetcher(object):
-    def __init__(self, looker):
+    def __init__(self, looker, usage=None):
         self.looker = looker
+        self.usage = usage
+        self.registries = {}
         self.fetch_logger = logging.getLogger('fetcher')
 
     def get_project_files(self, project=None):
         self.fetch_logger.info('Fetching projects, %s', locals())
         if project is None:
             self.fetch_logger.info('Fetching all project files')
-            projects = self.looker.get_projects()
+            projects = self.looker.get_projects(fields=PROJECT_FIELDS)
         else:
             self.fetch_logger.info('Fetching project files for %s', project)
-            projects = self.looker.get_project(project)
+            projects = self.looker.get_project(project,
+                                               fields=PROJECT_FIELDS)
 
         project_data = []
         for p in projects:
-            project_files = self.looker.get_project_files(project=p['id'])
+            project_files = self.looker.get_project_files(
+                                            project=p['id'],
+                                            fields=PROJECT_FILE_FIELDS)
 
             project_data.append({
                 'name': p['id'],
@@ -32,19 +58,19 @@ class Fetcher(object):
         self.fetch_logger.info('Fetch Complete :: Projects')
         return project_data
 
-    # function that returns list of model definitions or model names (with
-    # verbose 0 or 1 respectively) Allows the user to specify a project name,
+    # function that returns list of Model objects or model names (with
+    # verbose 1 or 0 respectively) Allows the user to specify a project name,
     # a model name or nothing at all. project paramater is a string while model
     # parameter is a list
     def get_models(self, project=None, model=None, verbose=0, scoped_names=0):
         if project is None and model is None:
             self.fetch_logger.info('Fetching all models, %s', locals())
-            models = self.looker.get_models()
+            models = self.looker.get_models(fields=MODEL_FIELDS)
         elif project is not None and model is None:
             # if no parameters are specified
             self.fetch_logger.info('Fetching all models in %s, %s', project,
                                    locals())
-            r = self.looker.get_models()
+            r = self.looker.get_models(fields=MODEL_FIELDS)
             models = list(filter(lambda x: x['project_name'] == project, r))
             if not models:
                 self.fetch_logger.error('Project not found')
@@ -53,36 +79,40 @@ class Fetcher(object):
             # if both project and model paramaters are specified
             self.fetch_logger.info('Warning: Project parameter ignored. \
                                    Model names are unique across projects.')
-            models = [self.looker.get_model(model)]
+            models = self.looker.get_model(model, fields=MODEL_FIELDS)
         else:
             # if project parameter wasn't passed but model was.
             self.fetch_logger.info('Fetching model %s, %s', model, locals())
-            models = self.looker.get_model(model_name=model)
+            models = self.looker.get_model(model_name=model,
+                                           fields=MODEL_FIELDS)
 
         models = list(filter(lambda x: x['has_content'] is True, models))
         if verbose == 0:
             models = [(m['project_name'] + ".") * scoped_names + m['name']
                       for m in models]
+        else:
+            models = [Model(self.looker, m, EXPLORE_FIELDS) for m in models]
         self.fetch_logger.info('Fetch Complete :: Models')
         return models
 
-    def get_used_models(self, timeframe=90, min_queries=0):
-        self.fetch_logger.info('Fetching used models from i__looker, %s',
-                               locals())
-        timeframe = str(timeframe) + ' days'
-        min_queries = '>=' + str(min_queries)
-        body = {
+    # i__looker query of get_used_models
+    def used_models_query(self, timeframe=90):
+        return {
             "model": "i__looker",
             "view": "history",
             "fields": ["query.model", "history.query_run_count"],
-            "filters": {"history.created_date": timeframe,
-                        "query.model": "-i^_^_looker",
-                        "history.query_run_count": min_queries
-                        },
-            "limit": "50000"
+            "filters": {"history.created_date": str(timeframe) + ' days',
+                        "query.model": "-i^_^_looker"
+                        }
         }
 
-        response = self.looker.run_inline_query("json", body)
+    def get_used_models(self, timeframe=90, min_queries=0):
+        self.fetch_logger.info('Fetching used models from i__looker, %s',
+                               locals())
+        body = self.used_models_query(timeframe)
+
+        response = self._run_usage_query(body, timeframe, min_queries,
+                                         exclude_models=['i__looker'])
 
         x = {}
         for r in response:
@@ -90,59 +120,90 @@ class Fetcher(object):
         self.fetch_logger.info('Used Models Fetch Complete')
         return(x)
 
-    # errors have to be handled more downstream if explore does not exist due
-    # to bug #32748
+    # returns Explore objects with their definitions loaded (verbose 1) or
+    # (model, explore) name pairs (verbose 0). explores that do not exist,
+    # e.g. due to bug #32748, are left out
     def get_explores(self, model=None, explore=None, scoped_names=0,
                      verbose=0):
-        explores = []
         if explore is not None:
             self.fetch_logger.info('Fetching explore %s, %s', explore,
                                    locals())
-            e = self.looker.get_explore(model_name=model, explore_name=explore)
-            if e:
-                explores.extend(e)
+            explores = [Explore(self.looker, model, explore, EXPLORE_FIELDS)]
         else:
             self.fetch_logger.info('Fetching all explores, %s', locals())
             models = self.get_models(model=model, verbose=1)
-            for mdl in models:
-                for e in mdl['explores']:
-                    if verbose == 1:
-                        explores.extend(self.looker.get_explore(mdl['name'],
-                                                                e['name']))
-                    else:
-                        explores.append((mdl['name'], e['name']))
+            explores = [e for mdl in models for e in mdl.explores]
+        if verbose == 1:
+            explores = self.load_explores(explores)
+        else:
+            explores = [(e.model_name, e.name) for e in explores]
         self.fetch_logger.info('Fetch Complete :: Explores')
         return explores
 
+    # fetches the definitions of explores concurrently and returns the ones
+    # that were found
+    def load_explores(self, explores):
+        calls = [(e.model_name, e.name, EXPLORE_FIELDS) for e in explores
+                 if e.found is None]
+        bodies = iter(self.looker.map('get_explore', calls))
+        for e in explores:
+            if e.found is None:
+                # explores that fail to load come back as empty lists
+                body = next(bodies)
+                e.load(body[0] if body else None)
+        return [e for e in explores if e.found]
+
+    # yields the explores get_explores returns with verbose=1 as they are
+    # loaded, a batch at a time, so that callers can handle each one without
+    # holding on to all of them. explores keep the order of get_explores
+    def iter_explores(self, model=None, explore=None):
+        if explore is not None:
+            yield from self.get_explores(model=model, explore=explore,
+                                         verbose=1)
+            return
+        explores = [e for mdl in self.get_models(model=model, verbose=1)
+                    for e in mdl.explores]
+        batch_size = max(16, self.looker.workers * 4)
+        for i in range(0, len(explores), batch_size):
+            yield from self.load_explores(explores[i:i + batch_size])
+
+    # plans loading the explores iter_explores yields and returns the views
+    # whose field usage is looked up for them. a single explore is loaded
+    # right away as its views depend on it
+    def plan_explores(self, plan, model=None, explore=None):
+        if explore is not None:
+            explores = self.get_explores(model=model, explore=explore,
+                                         verbose=1)
+            if not explores:
+                self.fetch_logger.error('No matching explores found')
+                raise Exception('No matching explores found')
+            return explores[0].scopes
+        for mdl in self.get_models(model=model, verbose=1):
+            for e in mdl.explores:
+                plan.api('get_explore', e.model_name, e.name, EXPLORE_FIELDS)
+        return None
+
     def get_explore_fields(self, explore=None, scoped_names=0):
         self.fetch_logger.info('Parsing explore body for exposed fields')
-        fields = []
-        for dimension in explore['fields']['dimensions']:
-            if dimension['hidden'] is not True:
-                fields.append((explore['model_name']+'.'
-                              + explore['name'] + '.')*scoped_names
-                              + dimension['name'])
-        for measure in explore['fields']['measures']:
-            if measure['hidden'] is not True:
-                fields.append((explore['model_name']+'.'
-                              + explore['name']+'.')*scoped_names
-                              + measure['name'])
-        for fltr in explore['fields']['filters']:
-            if fltr['hidden'] is not True:
-                fields.append((explore['model_name']+'.'
-                              + explore['name']+'.')*scoped_names
-                              + fltr['name'])
+        prefix = (explore.model_name + '.' + explore.name + '.') * scoped_names
+        fields = [prefix + f.name for f in explore.fields
+                  if f.hidden is not True]
         self.fetch_logger.info('Parsing Complete')
         return list(set(fields))
 
-    def get_unused_explores(self, model=None, timeframe=90, min_queries=0):
+    # used_explores and all_explores can be passed in when they are already
+    # known (e.g. from get_explore_usage) to avoid fetching them again
+    def get_unused_explores(self, model=None, timeframe=90, min_queries=0,
+                            used_explores=None, all_explores=None):
         self.fetch_logger.info('Fetching unused explores, %s', locals())
-        used_explores = self.get_used_explores(model=model,
-                                               timeframe=timeframe,
-                                               min_queries=min_queries)
+        if used_explores is None:
+            used_explores = self.get_used_explores(model=model,
+                                                   timeframe=timeframe,
+                                                   min_queries=min_queries)
         used_explores = used_explores.keys()
-        all_explores = self.get_explores(model=model)
-        all_explores = [i[1] for i in all_explores]
+        if all_explores is None:
+            all_explores = self.get_explores(model=model)
+            all_explores = [i[1] for i in all_explores]
         unused_explores = list(set(all_explores) - set(used_explores))
         self.fetch_logger.info('Fetch Complete:: Unused Explores')
         return unused_explores
@@ -157,12 +218,40 @@ class Fetcher(object):
     def get_used_explore_fields(self, model=None, explore=None, timeframe=90,
                                 min_queries=0):
         self.fetch_logger.info('Fetching exposed explore fields, %s', locals())
+        body = self.used_explore_fields_query(model, explore, timeframe)
+        # returns only fields used from a given explore
+        response = self._run_usage_query(
+                        body, timeframe, min_queries,
+                        models=[model] if model is not None else None,
+                        explores=explore, exclude_models=['i__looker'])
+
+        # fields are taken from every column that references them and their
+        # query run counts are summed per model, explore and field
+        c = {}
+        for row in response:
+            scope = (row['query.model'], row['query.view'])
+            run_count = int(row['history.query_run_count'])
+            for column in FIELD_COLUMNS:
+                value = row[column]
+                if value is None:
+                    continue
+                if not isinstance(value, str):
+                    value = str(value)
+                for field in FIELD_PATTERN.findall(value):
+                    key = scope + (field,)
+                    c[key] = c.get(key, 0) + run_count
+
+        c = {'.'.join(k): count for k, count in c.items()}
+        self.fetch_logger.info('Fetch Complete :: Exposed Explore Fields ')
+        return c
+
+    # i__looker query of get_used_explore_fields
+    def used_explore_fields_query(self, model=None, explore=None,
+                                  timeframe=90):
         m = model.replace('_', '^_') + ',' if model is not None else ''
         m += "-i^_^_looker"
-        e = ','.join(explore).replace('_', '^_')
-        min_queries = '>=' + str(min_queries)
-        timeframe = str(timeframe) + ' days'
-        body = {
+        e = ','.join(explore).replace('_', '^_') if explore is not None else ''
+        return {
             "model": "i__looker",
             "view": "history",
             "fields": ["query.model", "query.view",
@@ -170,70 +259,67 @@ class Fetcher(object):
                        "query.formatted_filters", "query.sorts",
                        "query.formatted_pivots",
                        "history.query_run_count"],
-            "filters": {"history.created_date": timeframe,
+            "filters": {"history.created_date": str(timeframe) + ' days',
                         "query.model": m,
-                        "query.view": e,
-                        "history.query_run_count": min_queries},
-            "limit": "50000"
+                        "query.view": e}
         }
-        # returns only fields used from a given explore
-        response = self.looker.run_inline_query("json", body)
 
-        formatted_fields = []
-        for row in response:
-            fields = []
-            explore = row['query.view']
-            model = row['query.model']
-            run_count = row['history.query_run_count']
-            fields.extend(re.findall(r'(\w+\.\w+)',
-                                     str(row['query.formatted_fields'])))
-            fields.extend(re.findall(r'(\w+\.\w+)',
-                                     str(row['query.formatted_filters'])))
-            fields.extend(re.findall(r'(\w+\.\w+)',
-                                     str(row['query.formatted_pivots'])))
-            fields.extend(re.findall(r'(\w+\.\w+)',
-                                     str(row['query.sorts'])))
-            for field in fields:
-                s = model + '.' + explore + '.' + field + '.' + str(run_count)
-                formatted_fields.extend([s])
-
-        field_name = []
-        field_use_count = []
-        for row in formatted_fields:
-            field = '.'.join(row.split('.')[:-1])  # remove the count
-            field_name.append(field)  # model.explore.view scoped
-            count = int(row.split('.')[-1])
-            field_use_count.append({
-                'field_name': field,
-                'count': count
-            })
+    # returns the registry interning the fields of model
+    def field_registry(self, model):
+        registry = self.registries.get(model)
+        if registry is None:
+            registry = self.registries[model] = FieldRegistry()
+        return registry
 
-        c = Counter()
+    # bulk version of get_used_explore_fields. runs a single i__looker query
+    # for a model (or all models if model is None) and splits the used fields
+    # by explore. returns a dict keyed on (model, explore) holding the used
+    # fields as bitsets of the model's field registry
+    def get_used_fields_index(self, model=None, explore=None, timeframe=90,
+                              min_queries=0):
+        self.fetch_logger.info('Fetching used fields index, %s', locals())
+        used_fields = self.get_used_explore_fields(model=model,
+                                                   explore=explore,
+                                                   timeframe=timeframe,
+                                                   min_queries=min_queries)
+        fields = {}
+        for field in used_fields:
+            m, e = field.split('.')[:2]
+            fields.setdefault((m, e), []).append(field)
+        index = {}
+        for (m, e), names in fields.items():
+            index[(m, e)] = self.field_registry(m).bitset(names)
+        self.fetch_logger.info('Fetch Complete :: Used Fields Index')
+        return index
 
-        for value in field_use_count:
-            c[value['field_name']] += value['count']
-        self.fetch_logger.info('Fetch Complete :: Exposed Explore Fields ')
-        return dict(c)
+    # looks up the used fields of an explore in an index built by
+    # get_used_fields_index and returns them as a bitset. like
+    # get_used_explore_fields, usage is collected from every explore named
+    # after one of the explore's scopes
+    def get_explore_used_fields(self, index, model, scopes):
+        used_fields = 0
+        for s in scopes:
+            used_fields |= index.get((model, s), 0)
+        return used_fields
 
     def get_used_explores(self, model=None, explore=None,
                           timeframe=90, min_queries=0):
         self.fetch_logger.info('Fetching used explores, %s', locals())
-        timeframe = str(timeframe) + ' days'
-        min_queries = '>=' + str(min_queries)
         m = model.replace('_', '^_') + ',' if model is not None else ''
         body = {
             "model": "i__looker",
             "view": "history",
             "fields": ["query.view", "history.query_run_count"],
-            "filters": {"history.created_date": timeframe,
+            "filters": {"history.created_date": str(timeframe) + ' days',
                         "query.model": m,
-                        "history.query_run_count": min_queries,
                         "query.view": explore
-                        },
-            "limit": "50000"
+                        }
         }
 
-        response = self.looker.run_inline_query("json", body)
+        response = self._run_usage_query(
+                        body, timeframe, min_queries,
+                        models=[model] if model is not None else None,
+                        explores=[explore] if explore is not None else None)
 
         x = {}
         for r in response:
@@ -241,21 +327,89 @@ class Fetcher(object):
         self.fetch_logger.info('Fetch Complete :: Used Explores')
         return(x)
 
+    # returns the query run count of every explore, indexed by model, using a
+    # single i__looker query
+    def get_explore_usage(self, timeframe=90, min_queries=0):
+        self.fetch_logger.info('Fetching explore usage, %s', locals())
+        body = self.explore_usage_query(timeframe)
+
+        response = self._run_usage_query(body, timeframe, min_queries)
+
+        x = {}
+        for r in response:
+            x.setdefault(r['query.model'], {})[r['query.view']] = \
+                r['history.query_run_count']
+        self.fetch_logger.info('Fetch Complete :: Explore Usage')
+        return(x)
+
+    # i__looker query of get_explore_usage
+    def explore_usage_query(self, timeframe=90):
+        return {
+            "model": "i__looker",
+            "view": "history",
+            "fields": ["query.model", "query.view",
+                       "history.query_run_count"],
+            "filters": {"history.created_date": str(timeframe) + ' days'}
+        }
+
+    # runs a usage query against i__looker history without the 50000 row
+    # limit truncating it. the query is paginated by date window, so run
+    # counts are summed per group (i.e. per combination of the query's other
+    # fields) here and the min_queries threshold is applied to the totals.
+    # returns rows in the same form as run_inline_query. when a local usage
+    # store is used, the query is answered from it instead and models,
+    # explores and exclude_models stand in for the query's filters.
+    # otherwise the rows are kept in the API client's memo for the rest of
+    # the run, and in its usage cache if it has one, e.g. when running as a
+    # daemon
+    def _run_usage_query(self, body, timeframe, min_queries, models=None,
+                         explores=None, exclude_models=None):
+        if self.usage is not None:
+            self.usage.sync(self.looker)
+            return self.usage.usage(self.looker.host, body['fields'],
+                                    timeframe, min_queries, models=models,
+                                    explores=explores,
+                                    exclude_models=exclude_models)
+        rows = self.looker.memo.call(
+                    self.usage_query_key(body, timeframe),
+                    lambda: self.fetch_usage_rows(body, timeframe))
+        return [row for row in rows
+                if row['history.query_run_count'] >= min_queries]
+
+    # memo key of the rows of a usage query
+    def usage_query_key(self, body, timeframe):
+        return json.dumps(['usage', body, timeframe], sort_keys=True)
+
+    # runs a usage query, or gets its rows from the usage cache
+    def fetch_usage_rows(self, body, timeframe):
+        cache = self.looker.usage_cache
+        key = ['usage', body, timeframe]
+        rows = cache.get(self.looker.host, key) if cache is not None else None
+        if rows is None:
+            rows = paginator.sum_date_windows(self.looker, body, timeframe)
+            if cache is not None:
+                cache.set(self.looker.host, key, rows)
+        return rows
+
     def test_git_connection(self, project):
         # enter dev mode
         self.looker.update_session(mode='dev')
-        # obtain tests available
-        tests = []
-        for test in self.looker.git_connection_tests(project_id=project):
-            tests.append(test['id'])
-        verbose_result = []
-        fail_flag = 0
-        for idx, test in enumerate(tests):
-            r = self.looker.run_git_connection_test(project_id=project,
-                                                    test_id=test)
-            verbose_result.append(r['id'] + ' (' + r['status'] + ')')
-            if r['status'] != 'pass':
-                fail_flag = 1
+        try:
+            # obtain tests available
+            tests = []
+            for test in self.looker.git_connection_tests(project_id=project):
+                tests.append(test['id'])
+            verbose_result = []
+            fail_flag = 0
+            for idx, test in enumerate(tests):
+                r = self.looker.run_git_connection_test(project_id=project,
+                                                        test_id=test)
+                verbose_result.append(r['id'] + ' (' + r['status'] + ')')
+                if r['status'] != 'pass':
+                    fail_flag = 1
+        finally:
+            # the session is shared with the rest of the run and later ones
+            self.looker.update_session(mode='production')
         verbose_result = ('\n').join(verbose_result)
         result = verbose_result if fail_flag == 1 else 'OK'
         return result
@@ -0,0 +1,54 @@
+# fieldregistry.py
+
+
+# interns fully scoped field names (model.explore.view.field) to integer ids
+# so that sets of fields can be held as bitsets, i.e. ints with the bits of
+# their fields' ids set. differences, unions and counts then run on whole
+# sets at once. field names are split once, when they are first seen. ids
+# are allocated densely, so a registry should be kept per model to keep
+# bitsets small
+class FieldRegistry(object):
+    def __init__(self):
+        self.index = {}
+        self.names = []
+        # view.field part of each name and the view it belongs to
+        self.local_names = []
+        self.views = []
+
+    def intern(self, name):
+        i = self.index.get(name)
+        if i is None:
+            i = len(self.names)
+            self.index[name] = i
+            self.names.append(name)
+            parts = name.split('.', 2)
+            local_name = parts[2] if len(parts) > 2 else ''
+            self.local_names.append(local_name)
+            self.views.append(local_name.split('.', 1)[0])
+        return i
+
+    def bitset(self, names):
+        ids = [self.intern(name) for name in names]
+        if not ids:
+            return 0
+        buf = bytearray(max(ids) // 8 + 1)
+        for i in ids:
+            buf[i >> 3] |= 1 << (i & 7)
+        return int.from_bytes(buf, 'little')
+
+    # yields the ids in bits in ascending order
+    def ids(self, bits):
+        digits = bin(bits)[:1:-1]
+        i = digits.find('1')
+        while i != -1:
+            yield i
+            i = digits.find('1', i + 1)
+
+    def count(self, bits):
+        return bin(bits).count('1')
+
+    def views_of(self, bits):
+        return set(self.views[i] for i in self.ids(bits))
+
+    def local_names_of(self, bits):
+        return [self.local_names[i] for i in self.ids(bits)]
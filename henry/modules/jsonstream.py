@@ -0,0 +1,128 @@
+# jsonstream.py
+import codecs
+import json
+import re
+
+decoder = json.JSONDecoder()
+WHITESPACE = ' \t\n\r'
+# characters that can end an element: brackets and quotes outside strings,
+# quotes and escapes inside them, and whatever follows a number or literal
+STRUCTURE = re.compile(r'["{}\[\]]')
+STRING = re.compile(r'["\\]')
+SCALAR_END = re.compile(r'[ \t\n\r,\]]')
+# whitespace between elements
+SPACE = re.compile(r'[ \t\n\r]*')
+
+
+# incrementally decodes a JSON array from an iterable of byte chunks and
+# yields its elements one at a time, as soon as each of them is complete.
+# only the element being decoded is held in memory, not the whole document.
+# elements are decoded straight from the chunk they are in. the end of one
+# that continues in later chunks is found by following its brackets and
+# strings, so each of its characters is scanned once however many chunks it
+# spans, and it is decoded once it is complete
+def iter_array(chunks):
+    text = codecs.getincrementaldecoder('utf-8')()
+    # what is expected between elements: the opening bracket, a value or
+    # the closing bracket right after it, a value after a comma, or a comma
+    # or the closing bracket after a value
+    expect = '['
+    # text of the element being scanned, None between elements
+    parts = None
+    scalar = False
+    depth = 0
+    in_string = False
+    escape = False
+    for chunk in chunks:
+        s = text.decode(chunk)
+        i = 0
+        n = len(s)
+        while i < n:
+            if parts is None:
+                c = s[i]
+                if c in WHITESPACE:
+                    i = SPACE.match(s, i).end()
+                    continue
+                if expect == '[':
+                    if c != '[':
+                        raise ValueError('Expected a JSON array')
+                    expect = 'first'
+                elif expect == ',':
+                    if c == ']':
+                        return
+                    if c != ',':
+                        raise ValueError('Expected , or ] after an array '
+                                         'element, got %r' % c)
+                    expect = 'value'
+                elif c == ']' and expect == 'first':
+                    return
+                elif c in ',]':
+                    raise ValueError('Expected an array element, got %r' % c)
+                else:
+                    scalar = c not in '{["'
+                    try:
+                        value, end = decoder.raw_decode(s, i)
+                    except ValueError:
+                        end = None
+                    # numbers and literals only end before a delimiter, as
+                    # they may continue in the next chunk
+                    if end is not None and (not scalar or
+                                            SCALAR_END.match(s, end)):
+                        yield value
+                        i = end
+                        expect = ','
+                        continue
+                    # the element doesn't end in this chunk, or is
+                    # malformed: scan for its end and decode it then
+                    parts = []
+                    depth = 0
+                    in_string = False
+                    escape = False
+                    continue
+                i += 1
+                continue
+            start = i
+            end = None
+            while end is None and i < n:
+                if scalar:
+                    m = SCALAR_END.search(s, i)
+                    if m is None:
+                        i = n
+                    else:
+                        i = end = m.start()
+                elif escape:
+                    escape = False
+                    i += 1
+                elif in_string:
+                    m = STRING.search(s, i)
+                    if m is None:
+                        i = n
+                        break
+                    i = m.end()
+                    if m.group() == '\\':
+                        escape = True
+                    else:
+                        in_string = False
+                        if depth == 0:
+                            end = i
+                else:
+                    m = STRUCTURE.search(s, i)
+                    if m is None:
+                        i = n
+                        break
+                    i = m.end()
+                    c = m.group()
+                    if c == '"':
+                        in_string = True
+                    elif c in '{[':
+                        depth += 1
+                    else:
+                        depth -= 1
+                        if depth == 0:
+                            end = i
+            parts.append(s[start:i])
+            if end is not None:
+                yield decoder.decode(''.join(parts))
+                parts = None
+                expect = ','
+    raise ValueError('Unexpected end of JSON array')
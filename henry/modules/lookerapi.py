@@ -1,17 +1,61 @@
 # -*- coding: UTF-8 -*-
 import requests
+import functools
+import inspect
 import json
 import sys
+import threading
 import logging
 import logging.config
+import time
+from concurrent.futures import ThreadPoolExecutor
+from . import jsonstream
+from .cache import Memo
+from .transport import Transport
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 
+# metadata cache key of the response of a call to get_models, get_model or
+# get_explore
+def cache_key(method, model_name=None, explore_name=None, fields={}):
+    if method == 'get_models':
+        return ['lookml_models', fields]
+    if method == 'get_model':
+        return ['lookml_models', model_name, fields]
+    return ['lookml_models', model_name, 'explores', explore_name, fields]
+
+
+# keeps the results of a GET method in the api's memo for the rest of the
+# run. calls are told apart by their method and arguments, however the
+# arguments are passed
+def memoized(method):
+    signature = inspect.signature(method)
+
+    def arguments(self, *args, **kwargs):
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        del bound.arguments['self']
+        return bound.arguments
+
+    def memo_key(self, *args, **kwargs):
+        return json.dumps([method.__name__,
+                           arguments(self, *args, **kwargs)], sort_keys=True)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return self.memo.call(memo_key(self, *args, **kwargs),
+                              lambda: method(self, *args, **kwargs))
+    wrapper.memo_key = memo_key
+    wrapper.arguments = arguments
+    return wrapper
+
+
 class LookerApi(object):
     def __init__(self, id, secret, host, port, access_token, timeout,
-                 session_info):
+                 session_info, workers=1, cache=None, profiler=None,
+                 cassette=None, token_cache=None, transport=None):
         self.api_logger = logging.getLogger('lookerapi')
         self.id = id
         self.secret = secret
@@ -19,21 +63,153 @@ class LookerApi(object):
         self.port = port
         self.access_token = access_token
         self.timeout = timeout
+        self.workers = max(1, workers)
+        self.cache = cache
+        self.profiler = profiler
+        self.token_cache = token_cache
+        # optional cache of usage query results, kept by long running
+        # processes only as usage changes all the time
+        self.usage_cache = None
+        self.auth_lock = threading.Lock()
+        # results of the GET requests made during the run
+        self.memo = Memo()
+        # workspace of the API session, changed with update_session
+        self.workspace = 'production'
+        # optional AsyncLookerApi that map() hands requests over to
+        self.aio = None
 
-        self.session = requests.Session()
+        # let every worker keep its connection alive in the pool
+        if transport is None:
+            transport = Transport(pool_size=max(self.workers, 10))
+        self.transport = transport
+        self.session = transport.session(cassette)
         self.session.verify = False
+        if profiler is not None:
+            self.session.hooks['response'].append(profiler.hook)
+
+        # a cached token is used as is while it is fresh, without checking
+        # it with the API first
+        cached_token = None
+        if token_cache is not None:
+            cached_token = token_cache.get(host, port, id)
+        if cached_token is not None:
+            self.access_token = access_token = cached_token
 
         self.session.headers.update({'Authorization': 'token %s' %
                                     access_token, 'User-Agent': session_info})
 
-        # if not valid anymore, authenticate again
-        if self.__get_me() == 401:
-            self.api_logger.warning('Existing auth token has expired')
-            self.auth()
+        if cached_token is None:
+            if not access_token:
+                self.auth()
+            # if not valid anymore, authenticate again
+            elif self.__get_me() == 401:
+                self.api_logger.warning('Existing auth token has expired')
+                self.auth()
+        self.session.hooks['response'].append(self._reauth)
 
     def get_access_token(self):
         return self.access_token
 
+    # calls method once for every tuple of arguments in calls, running up to
+    # self.workers requests concurrently over the shared session, or on the
+    # event loop of self.aio if the async backend is enabled. results are
+    # returned in the same order as calls. progress, if given, is called
+    # every time a request completes
+    def map(self, method, calls, progress=None, workers=None):
+        if self.aio is not None:
+            return self._map_async(method, calls, progress, workers)
+        workers = self.workers if workers is None else max(1, workers)
+        fn = getattr(self, method)
+
+        def call(args):
+            result = fn(*args)
+            if progress is not None:
+                progress()
+            return result
+
+        calls = list(calls)
+        if workers == 1 or len(calls) < 2:
+            return [call(args) for args in calls]
+        self.api_logger.info('Running %s %s times using %s workers', method,
+                             len(calls), min(workers, len(calls)))
+        with ThreadPoolExecutor(max_workers=min(workers,
+                                                len(calls))) as executor:
+            return list(executor.map(call, calls))
+
+    # hands the calls of memoized methods that have no result yet over to
+    # the async backend, each distinct call once
+    def _map_async(self, method, calls, progress=None, workers=None):
+        memo_key = getattr(getattr(self, method), 'memo_key', None)
+        if memo_key is None:
+            return self.aio.map(method, calls, progress, workers)
+        calls = list(calls)
+        keys = [memo_key(self, *args) for args in calls]
+        results = {}
+        pending = {}
+        for key, args in zip(keys, calls):
+            if key in results or key in pending:
+                continue
+            found, result = self.memo.lookup(key)
+            if found:
+                results[key] = result
+            else:
+                pending[key] = args
+        if pending:
+            for key, result in zip(pending, self.aio.map(
+                                            method, list(pending.values()),
+                                            progress, workers)):
+                self.memo.store(key, result)
+                results[key] = result
+        return [results[key] for key in keys]
+
+    # decodes a response body, timing it when profiling is enabled
+    def _json(self, r):
+        if self.profiler is None:
+            return r.json()
+        start = time.perf_counter()
+        value = r.json()
+        self.profiler.decoded(r, time.perf_counter() - start)
+        return value
+
+    # reads a streamed response body chunk by chunk, adding the time spent
+    # waiting for the body and its size on the wire to the request's profile
+    def _iter_content(self, r, chunk_size=65536):
+        profile = getattr(r, 'profile', None)
+        chunks = r.iter_content(chunk_size=chunk_size)
+        try:
+            while True:
+                start = time.perf_counter()
+                chunk = next(chunks, None)
+                if profile is not None:
+                    profile['latency'] += time.perf_counter() - start
+                if chunk is None:
+                    return
+                if profile is not None:
+                    self.profiler.streamed(r, len(chunk))
+                yield chunk
+        finally:
+            r.close()
+
+    # LookML metadata responses are cached per host, API user and
+    # workspace, as different users may not have access to the same models
+    # and the dev workspace holds the LookML of the user's branch
+    def _cache_get(self, key):
+        if self.cache is None:
+            return None
+        return self.cache.get(self.host, [self.id, self.workspace] + key)
+
+    def _cache_set(self, key, value):
+        if self.cache is not None:
+            self.cache.set(self.host, [self.id, self.workspace] + key, value)
+
+    # whether a call to get_models, get_model or get_explore would be
+    # answered by the metadata cache
+    def is_cached(self, method, *args):
+        if self.cache is None:
+            return False
+        arguments = getattr(self, method).arguments(self, *args)
+        return self._cache_get(cache_key(method, **arguments)) is not None
+
     def auth(self):
         self.api_logger.info('Authenticating')
         url = 'https://{}:{}/api/3.0/{}'.format(self.host, self.port, 'login')
@@ -43,13 +219,22 @@ class LookerApi(object):
         self.api_logger.info('Request to %s => POST /api/3.0/login, %s',
                              self.host, {'client_id': params['client_id'],
                                          'client_secret': "[FILTERED]"})
-        r = self.session.post(url, params=params, timeout=self.timeout)
-        access_token = r.json().get('access_token')
+        try:
+            r = self.session.post(url, params=params, timeout=self.timeout)
+        except Exception as e:
+            self.api_logger.error(e)
+            print('Connection timed out. Please confirm the hostname')
+            sys.exit(1)
+        login = self._json(r)
+        access_token = login.get('access_token')
         self.session.headers.update({'Authorization': 'token %s'
                                      % access_token})
         if r.status_code == requests.codes.ok:
             self.api_logger.info('Request Complete: %s', r.status_code)
             self.access_token = access_token
+            if self.token_cache is not None and login.get('expires_in'):
+                self.token_cache.set(self.host, self.port, self.id,
+                                     access_token, login['expires_in'])
         else:
             self.api_logger.warning('Request Complete: %s', r.status_code)
             print('Authentication Error: Check supplied credentials.')
@@ -57,6 +242,32 @@ class LookerApi(object):
 
         return
 
+    # response hook that authenticates again when a request is turned down
+    # with a 401, e.g. because the token expired or was revoked, and sends
+    # the request once more with the new token
+    def _reauth(self, r, *args, **kwargs):
+        if r.status_code != 401 or getattr(r.request, 'reauthenticated',
+                                           False):
+            return r
+        if r.request.url.split('?', 1)[0].endswith('/login'):
+            return r
+        self.reauthenticate(r.request.headers.get('Authorization'))
+        request = r.request.copy()
+        request.headers['Authorization'] = 'token %s' % self.access_token
+        request.reauthenticated = True
+        r.close()
+        return self.session.send(request, **kwargs)
+
+    # authenticates again after a request sent with the Authorization
+    # header value rejected was turned down, unless another request has
+    # done it in the meantime
+    def reauthenticate(self, rejected):
+        self.api_logger.warning('Access token was rejected, authenticating '
+                                'again')
+        with self.auth_lock:
+            if rejected == 'token %s' % self.access_token:
+                self.auth()
+
 # GET /user - meant for use by the class itself
     def __get_me(self):
         self.api_logger.info('Trying to auth in using existing auth token')
@@ -72,11 +283,15 @@ class LookerApi(object):
         return r.status_code
 
 # GET /lookml_models/
+    @memoized
     def get_models(self, fields={}):
         url = 'https://{}:{}/api/3.0/{}'.format(self.host,
                                                 self.port,
                                                 'lookml_models')
         params = fields
+        cached = self._cache_get(cache_key('get_models', fields=params))
+        if cached is not None:
+            return cached
         self.api_logger.info('Request to %s => GET /api/3.0/lookml_models, %s',
                              self.host,
                              params)
@@ -87,15 +302,22 @@ class LookerApi(object):
             self.api_logger.error('Request Complete: %s', r.status_code)
             raise(e)
         self.api_logger.info('Request Complete: %s', r.status_code)
-        return r.json()
+        models = self._json(r)
+        self._cache_set(cache_key('get_models', fields=params), models)
+        return models
 
 # GET /lookml_models/{{NAME}}
+    @memoized
     def get_model(self, model_name=None, fields={}):
         url = 'https://{}:{}/api/3.0/{}/{}'.format(self.host,
                                                    self.port,
                                                    'lookml_models',
                                                    model_name)
         params = fields
+        key = cache_key('get_model', model_name, fields=params)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return [cached]
         self.api_logger.info('Request to %s => GET /api/3.0/lookml_models/%s,'
                              ' %s', self.host, model_name, params)
         r = self.session.get(url, params=params, timeout=self.timeout)
@@ -105,9 +327,12 @@ class LookerApi(object):
             self.api_logger.error('Request Complete: %s', r.status_code)
             raise(e)
         self.api_logger.info('Request Complete: %s', r.status_code)
-        return [r.json()]
+        model = self._json(r)
+        self._cache_set(key, model)
+        return [model]
 
 # GET /lookml_models/{{NAME}}/explores/{{NAME}}
+    @memoized
     def get_explore(self, model_name=None, explore_name=None, fields={}):
         url = 'https://{}:{}/api/3.0/{}/{}/{}/{}'.format(self.host,
                                                          self.port,
@@ -116,6 +341,10 @@ class LookerApi(object):
                                                          'explores',
                                                          explore_name)
         params = fields
+        key = cache_key('get_explore', model_name, explore_name, params)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return [cached]
         self.api_logger.info('Request to %s => GET /api/3.0/lookml_models/%s'
                              '/explores/%s, %s', self.host, model_name,
                              explore_name, params)
@@ -126,9 +355,12 @@ class LookerApi(object):
             self.api_logger.error('Request Complete: %s', r.status_code)
             return []
         self.api_logger.info('Request Complete: %s', r.status_code)
-        return [r.json()]
+        explore = self._json(r)
+        self._cache_set(key, explore)
+        return [explore]
 
 # GET /projects
+    @memoized
     def get_projects(self, fields={}):
         url = 'https://{}:{}/api/3.0/{}'.format(self.host,
                                                 self.port,
@@ -144,9 +376,10 @@ class LookerApi(object):
             self.api_logger.warning('Request Complete: %s', r.status_code)
             raise(e)
         self.api_logger.info('Request Complete: %s', r.status_code)
-        return r.json()
+        return self._json(r)
 
 # GET /projects/{project_id}
+    @memoized
     def get_project(self, project_id=None, fields={}):
         url = 'https://{}:{}/api/3.0/{}/{}'.format(self.host,
                                                    self.port,
@@ -164,9 +397,10 @@ class LookerApi(object):
             self.api_logger.error('Request Complete: %s', r.status_code)
             raise e
         self.api_logger.info('Request Complete: %s', r.status_code)
-        return [r.json()]
+        return [self._json(r)]
 
 # GET /projects/{project_id}/files
+    @memoized
     def get_project_files(self, project=None, fields={}):
         url = 'https://{}:{}/api/3.0/{}/{}/{}'.format(self.host,
                                                       self.port,
@@ -184,10 +418,12 @@ class LookerApi(object):
             print('Project not found: %s', project)
             return
         self.api_logger.info('Request Complete: %s', r.status_code)
-        return r.json()
+        return self._json(r)
 
 # POST /queries/run/{result_format}
-    def run_inline_query(self, result_format, body, fields={}):
+    # with stream set, the response is read in chunks and an iterator over
+    # the decoded rows of a json result is returned instead of a list
+    def run_inline_query(self, result_format, body, fields={}, stream=False):
         url = 'https://{}:{}/api/3.0/{}/{}/{}'.format(self.host,
                                                       self.port,
                                                       'queries',
@@ -198,15 +434,18 @@ class LookerApi(object):
                              '%s', self.host, result_format, params)
         self.api_logger.info('Query params=%s', body)
         r = self.session.post(url, json.dumps(body), params=params,
-                              timeout=self.timeout)
+                              timeout=self.timeout, stream=stream)
         try:
             r.raise_for_status()
         except requests.exceptions.HTTPError as e:
             self.api_logger.warning('Request Complete: %s', r.status_code)
             print("Error: " + str(e))
+            r.close()
             return
         self.api_logger.info('Request Complete: %s', r.status_code)
-        return r.json()
+        if stream:
+            return jsonstream.iter_array(self._iter_content(r))
+        return self._json(r)
 
 # PATCH session
     def update_session(self, mode):
@@ -214,6 +453,7 @@ class LookerApi(object):
                                                 self.port,
                                                 'session')
         body = {'workspace_id': str(mode)}
+        self.own_session(mode)
         self.api_logger.info('Request to %s => PATCH /api/3.0/session, %s',
                              self.host,
                              body)
@@ -225,7 +465,27 @@ class LookerApi(object):
             print("Error: " + str(e))
             return
         self.api_logger.info('Request Complete: %s', r.status_code)
-        return r.json()
+        self.switched_workspace(mode)
+        return self._json(r)
+
+    # the API session of a token in the token cache is shared with other
+    # runs, which would be moved to another workspace along with this one.
+    # before leaving production, log in for a session of this run's own and
+    # keep it, and any later one, out of the cache
+    def own_session(self, mode):
+        if str(mode) == 'production' or self.token_cache is None:
+            return
+        self.api_logger.info('Logging in for a session of our own before '
+                             'switching to the %s workspace', mode)
+        self.token_cache = None
+        with self.auth_lock:
+            self.auth()
+
+    # keeps track of the workspace the API session was switched to
+    def switched_workspace(self, mode):
+        self.workspace = str(mode)
+        # the other workspace may hold different LookML
+        self.memo.clear()
 
 # GET session
     def get_session(self, fields={}):
@@ -244,9 +504,10 @@ class LookerApi(object):
             print("Error: " + str(e))
             return
         self.api_logger.info('Request Complete: %s', r.status_code)
-        return r.json()
+        return self._json(r)
 
 # GET /projects/{project_id}/git_connection_tests
+    @memoized
     def git_connection_tests(self, project_id, fields={}):
         url = ('https://{}:{}/api/3.0/projects/{}/'
                'git_connection_tests').format(self.host, self.port, project_id)
@@ -264,7 +525,7 @@ class LookerApi(object):
             print("Error: " + str(e))
             return
         self.api_logger.info('Request Complete: %s', r.status_code)
-        return r.json()
+        return self._json(r)
 
 # GET /projects/{project_id}/git_connection_tests/{test_id}
     def run_git_connection_test(self, project_id, test_id, fields={}):
@@ -285,9 +546,10 @@ class LookerApi(object):
             print("Error: " + str(e))
             return
         self.api_logger.info('Request Complete: %s', r.status_code)
-        return r.json()
+        return self._json(r)
 
 # GET /connections
+    @memoized
     def get_connections(self, fields={}):
         url = 'https://{}:{}/api/3.0/connections'.format(self.host, self.port)
         params = fields
@@ -301,26 +563,37 @@ class LookerApi(object):
             self.api_logger.warning('Request Complete: %s', r.status_code)
             return
         self.api_logger.info('Request Complete: %s', r.status_code)
-        return r.json()
+        return self._json(r)
 
 # PUT /connections/{connection_name}/test
-    def test_connection(self, connection, fields={}):
+    # timeout overrides the API timeout for this test only. a test that
+    # times out is reported as a failed test rather than raised
+    def test_connection(self, connection, fields={}, timeout=None):
         url = 'https://{}:{}/api/3.0/connections/{}/test'.format(self.host,
                                                                  self.port,
                                                                  connection)
         params = fields
         self.api_logger.info('Request to %s => POST /api/3.0/connections/'
                              '%s/test, %s', self.host, connection, params)
-        r = self.session.put(url, params=params, timeout=self.timeout)
+        try:
+            r = self.session.put(url, params=params,
+                                 timeout=timeout or self.timeout)
+        except requests.exceptions.Timeout:
+            self.api_logger.warning('Connection test for %s timed out',
+                                    connection)
+            return [{'name': 'timeout', 'status': 'error',
+                     'message': 'Connection test timed out after %s seconds'
+                                % (timeout or self.timeout)}]
         try:
             r.raise_for_status()
         except requests.exceptions.HTTPError as e:
             self.api_logger.warning('Request Complete: %s', r.status_code)
             return
         self.api_logger.info('Request Complete: %s', r.status_code)
-        return r.json()
+        return self._json(r)
 
 # GET /legacy_features
+    @memoized
     def get_legacy_features(self, fields={}):
         url = 'https://{}:{}/api/3.0/legacy_features'.format(self.host,
                                                              self.port)
@@ -334,9 +607,10 @@ class LookerApi(object):
             self.api_logger.warning('Request Complete: %s', r.status_code)
             return
         self.api_logger.info('Request Complete: %s', r.status_code)
-        return r.json()
+        return self._json(r)
 
 # GET /integrations
+    @memoized
     def get_integrations(self, fields={}):
         url = 'https://{}:{}/api/3.0/integrations'.format(self.host, self.port)
         params = fields
@@ -350,9 +624,10 @@ class LookerApi(object):
             self.api_logger.warning('Request Complete: %s', r.status_code)
             return
         self.api_logger.info('Request Complete: %s', r.status_code)
-        return r.json()
+        return self._json(r)
 
 # GET /versions
+    @memoized
     def get_version(self, fields={}):
         url = 'https://{}:{}/api/3.0/versions'.format(self.host, self.port)
         params = fields
@@ -367,4 +642,4 @@ class LookerApi(object):
             print("Error: " + str(e))
             return
         self.api_logger.info('Request Complete: %s', r.status_code)
-        return r.json()
+        return self._json(r)
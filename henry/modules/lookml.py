@@ -0,0 +1,98 @@
+# lookml.py
+import logging
+
+lookml_logger = logging.getLogger('lookml')
+
+# kinds of fields an explore exposes, in the order they are listed
+CATEGORIES = ('dimensions', 'measures', 'filters')
+
+
+# a dimension, measure or filter of an explore. category is one of
+# CATEGORIES
+class Field(object):
+    __slots__ = ('name', 'hidden', 'category')
+
+    def __init__(self, name, hidden, category):
+        self.name = name
+        self.hidden = hidden
+        self.category = category
+
+
+# an explore of a model. it starts out with only the names that
+# lookml_models lists and fetches its definition, requesting the attributes
+# in projection, the first time anything else is read from it. explores
+# that fail to load (bug #32748) are not found
+class Explore(object):
+    __slots__ = ('looker', 'model_name', 'name', 'projection', 'found',
+                 '_hidden', '_description', '_scopes', '_fields')
+
+    def __init__(self, looker, model_name, name, projection=None):
+        self.looker = looker
+        self.model_name = model_name
+        self.name = name
+        self.projection = projection or {}
+        # None until the definition has been fetched
+        self.found = None
+
+    # fills in the explore from its API body, or marks it as not found if
+    # body is None. returns whether it was found
+    def load(self, body):
+        if body is None:
+            self.found = False
+            return False
+        self._hidden = body['hidden']
+        self._description = body['description']
+        self._scopes = body['scopes']
+        self._fields = [Field(f['name'], f['hidden'], category)
+                        for category in CATEGORIES
+                        for f in body['fields'][category]]
+        self.found = True
+        return True
+
+    # fetches the definition unless it was fetched already
+    def hydrate(self):
+        if self.found is None:
+            lookml_logger.info('Loading explore %s.%s', self.model_name,
+                               self.name)
+            body = self.looker.get_explore(self.model_name, self.name,
+                                           self.projection)
+            self.load(body[0] if body else None)
+        if not self.found:
+            lookml_logger.error('Explore %s.%s not found', self.model_name,
+                                self.name)
+            raise Exception('Explore %s.%s not found' % (self.model_name,
+                                                         self.name))
+
+    @property
+    def hidden(self):
+        self.hydrate()
+        return self._hidden
+
+    @property
+    def description(self):
+        self.hydrate()
+        return self._description
+
+    # names of the explore's base view and joins
+    @property
+    def scopes(self):
+        self.hydrate()
+        return self._scopes
+
+    @property
+    def fields(self):
+        self.hydrate()
+        return self._fields
+
+
+# a model and the stubs of its explores, from a lookml_models body. the
+# explores fetch their definitions with explore_projection
+class Model(object):
+    __slots__ = ('name', 'project_name', 'explores')
+
+    def __init__(self, looker, body, explore_projection=None):
+        self.name = body['name']
+        self.project_name = body['project_name']
+        self.explores = [Explore(looker, self.name, e['name'],
+                                 explore_projection)
+                         for e in body['explores']]
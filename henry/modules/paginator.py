@@ -0,0 +1,118 @@
+# paginator.py
+import copy
+import logging
+
+page_logger = logging.getLogger('paginator')
+
+# maximum number of rows requested per query
+PAGE_SIZE = 50000
+
+
+# with stream set, rows are returned as an iterator decoding the response as
+# it is downloaded instead of a list
+def _run(looker, body, fields, stream=False):
+    rows = looker.run_inline_query('json', body, fields=fields, stream=stream)
+    if rows is None:
+        page_logger.error('Query failed, %s', body)
+        raise Exception('i__looker query failed')
+    return rows
+
+
+# runs an aggregate i__looker query over the last timeframe days and yields
+# its rows. body is expected to filter date_field on the same timeframe
+# (e.g. "90 days"). the whole timeframe is queried first; if that returns
+# page_size rows the result may be truncated, so the date range is split in
+# two and each half is queried separately, recursively, down to single days.
+# rows of the same group can therefore be yielded once per date window and
+# have to be aggregated by the caller. filters on measures (e.g.
+# history.query_run_count) would be applied per window, so they must be left
+# out of body and applied by the caller after aggregation instead
+def iter_date_windows(looker, body, timeframe, page_size=PAGE_SIZE,
+                      date_field='history.created_date', fields={}):
+    # "N days" covers today and the N - 1 days before it
+    windows = [(timeframe - 1, timeframe)]
+    while windows:
+        start, days = windows.pop(0)
+        b = copy.deepcopy(body)
+        if days < timeframe:
+            b['filters'][date_field] = '%s days ago for %s days' % (start,
+                                                                    days)
+        b['limit'] = str(page_size)
+        rows = _run(looker, b, fields)
+        if len(rows) >= page_size and days > 1:
+            page_logger.info('Splitting %s day window starting %s days ago',
+                             days, start)
+            half = days // 2
+            windows[:0] = [(start, half), (start - half, days - half)]
+            continue
+        if len(rows) >= page_size:
+            page_logger.warning('Results for %s days ago may be truncated at '
+                                '%s rows', start, page_size)
+        for row in rows:
+            yield row
+
+
+# runs an aggregate i__looker query over the last timeframe days like
+# iter_date_windows and returns one row per group of dimensions with measure
+# summed across date windows. each window is streamed and summed on its own,
+# so only one row per group is held in memory, and is only merged into the
+# totals once it is known not to be truncated
+def sum_date_windows(looker, body, timeframe,
+                     measure='history.query_run_count', page_size=PAGE_SIZE,
+                     date_field='history.created_date', fields={}):
+    dimensions = [f for f in body['fields'] if f != measure]
+    totals = {}
+    windows = [(timeframe - 1, timeframe)]
+    while windows:
+        start, days = windows.pop(0)
+        b = copy.deepcopy(body)
+        if days < timeframe:
+            b['filters'][date_field] = '%s days ago for %s days' % (start,
+                                                                    days)
+        b['limit'] = str(page_size)
+        window = {}
+        count = 0
+        for row in _run(looker, b, fields, stream=True):
+            count += 1
+            key = tuple(str(row[d]) for d in dimensions)
+            value = row[measure] or 0
+            if key in window:
+                window[key][measure] += value
+            else:
+                row[measure] = value
+                window[key] = row
+        if count >= page_size and days > 1:
+            page_logger.info('Splitting %s day window starting %s days ago',
+                             days, start)
+            half = days // 2
+            windows[:0] = [(start, half), (start - half, days - half)]
+            continue
+        if count >= page_size:
+            page_logger.warning('Results for %s days ago may be truncated at '
+                                '%s rows', start, page_size)
+        for key, row in window.items():
+            if key in totals:
+                totals[key][measure] += row[measure]
+            else:
+                totals[key] = row
+    return list(totals.values())
+
+
+# runs an i__looker query page by page using keyset pagination on key, which
+# has to be a unique, numeric field of the query, and yields its rows as they
+# are decoded
+def iter_keyset(looker, body, key, page_size=PAGE_SIZE, fields={}):
+    b = copy.deepcopy(body)
+    b['sorts'] = [key + ' asc']
+    b['limit'] = str(page_size)
+    while True:
+        count = 0
+        last = None
+        for row in _run(looker, b, fields, stream=True):
+            count += 1
+            last = row[key]
+            yield row
+        if count < page_size:
+            break
+        b['filters'][key] = '>' + str(last)
+        page_logger.info('Fetching next page, %s', b['filters'][key])
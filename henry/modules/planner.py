@@ -0,0 +1,213 @@
+# planner.py
+import glob
+import json
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from tabulate import tabulate
+
+plan_logger = logging.getLogger('planner')
+
+# endpoints of the calls that can be planned, as named in --profile-http
+# reports
+ENDPOINTS = {
+    'get_models': 'GET /lookml_models',
+    'get_model': 'GET /lookml_models/{model_name}',
+    'get_explore': 'GET /lookml_models/{model_name}/explores/{explore_name}',
+    'query': 'POST /queries/run/{result_format}'}
+# latencies in seconds assumed for endpoints that no profile has timed yet
+DEFAULT_LATENCY = {'query': 10.0}
+FALLBACK_LATENCY = 0.5
+# number of saved profiles looked at for latencies
+MAX_PROFILES = 50
+
+
+# a call the plan will make. kind is an API method name, 'query' for an
+# i__looker usage query or 'sync' for a usage store sync
+class Call(object):
+    __slots__ = ('kind', 'key', 'args', 'label', 'cached')
+
+    def __init__(self, kind, key, args, label, cached=False):
+        self.kind = kind
+        self.key = key
+        self.args = args
+        self.label = label
+        self.cached = cached
+
+
+# the API calls and i__looker queries a command will make, without
+# duplicates. building the plan makes the calls the rest depends on, such
+# as listing the models, through the API's memo. execute() makes the rest,
+# concurrently, so that the command then finds every result in the memo.
+# calls in deferred are left to the command, e.g. to load explores in
+# batches as they are needed
+class Plan(object):
+    def __init__(self, fetcher, profile_dir=None):
+        self.fetcher = fetcher
+        self.looker = fetcher.looker
+        self.profile_dir = profile_dir
+        self.calls = OrderedDict()
+        self.requested = {}
+        self.started = time.perf_counter()
+        self.planning_requests = self.looker.memo.stats()['misses']
+        self.planning_time = None
+
+    def _add(self, call):
+        self.requested[call.kind] = self.requested.get(call.kind, 0) + 1
+        if call.key not in self.calls:
+            self.calls[call.key] = call
+
+    # plans a call to an API method of LookerApi
+    def api(self, method, *args):
+        key = getattr(self.looker, method).memo_key(self.looker, *args)
+        if key not in self.calls:
+            cached = key in self.looker.memo or \
+                self.looker.is_cached(method, *args)
+        else:
+            cached = self.calls[key].cached
+        label = ' '.join([method] + [str(a) for a in args
+                                     if not isinstance(a, dict)])
+        self._add(Call(method, key, args, label, cached))
+
+    # plans a usage query, answered by the usage store if there is one
+    def query(self, body, timeframe, label):
+        usage = self.fetcher.usage
+        if usage is not None:
+            self._add(Call('sync', 'sync', (), 'usage store sync',
+                           usage.synced is not None))
+            return
+        key = self.fetcher.usage_query_key(body, timeframe)
+        if key not in self.calls:
+            cache = self.looker.usage_cache
+            cached = key in self.looker.memo or (
+                cache is not None and
+                cache.get(self.looker.host, ['usage', body, timeframe])
+                is not None)
+        else:
+            cached = self.calls[key].cached
+        self._add(Call('query', key, (body, timeframe), label, cached))
+
+    # marks the end of planning
+    def done(self):
+        self.planning_time = time.perf_counter() - self.started
+        self.planning_requests = self.looker.memo.stats()['misses'] - \
+            self.planning_requests
+        plan_logger.info('Planned %s calls in %.2f s, making %s requests',
+                         len(self.calls), self.planning_time,
+                         self.planning_requests)
+        for call in self.calls.values():
+            plan_logger.info('Planned %s%s', call.label,
+                             ' (cached)' if call.cached else '')
+        return self
+
+    def execute(self, deferred=()):
+        start = time.perf_counter()
+        methods = OrderedDict()
+        queries = []
+        for call in self.calls.values():
+            if call.kind in deferred:
+                continue
+            if call.kind == 'sync':
+                self.fetcher.usage.sync(self.looker)
+            elif call.kind == 'query':
+                queries.append(call)
+            else:
+                methods.setdefault(call.kind, []).append(call.args)
+        for method, calls in methods.items():
+            self.looker.map(method, calls)
+        if queries:
+            def run(call):
+                body, timeframe = call.args
+                self.looker.memo.call(
+                        call.key,
+                        lambda: self.fetcher.fetch_usage_rows(body,
+                                                              timeframe))
+            workers = min(self.looker.workers, len(queries))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(run, queries))
+        plan_logger.info('Executed plan in %.2f s',
+                         time.perf_counter() - start)
+
+    # median latency in seconds of each endpoint, taken from this run's
+    # profile if it has one, then from the latest profiles saved for the
+    # host, along with where it was taken from
+    def latencies(self):
+        latencies = {}
+        profiler = self.looker.profiler
+        if profiler is not None:
+            for e in profiler.summary():
+                latencies[e['endpoint']] = (e['p50_ms'] / 1000, 'this run')
+        if self.profile_dir is None:
+            return latencies
+        profiles = sorted(glob.glob(os.path.join(self.profile_dir,
+                                                 '*.json')),
+                          key=os.path.getmtime, reverse=True)
+        for path in profiles[:MAX_PROFILES]:
+            try:
+                with open(path, 'r') as f:
+                    profile = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if profile.get('host') != self.looker.host:
+                continue
+            for e in profile.get('endpoints', []):
+                if e['endpoint'] not in latencies:
+                    latencies[e['endpoint']] = (e['p50_ms'] / 1000,
+                                                os.path.basename(path))
+        return latencies
+
+    # the calls of the plan per kind, with the number of requests they are
+    # expected to make and how long they should take with the API's workers
+    def estimate(self):
+        latencies = self.latencies()
+        workers = self.looker.workers
+        kinds = OrderedDict()
+        for call in self.calls.values():
+            kinds.setdefault(call.kind, []).append(call)
+        steps = []
+        for kind, calls in kinds.items():
+            # a usage store sync is a usage query
+            endpoint = ENDPOINTS['query' if kind == 'sync' else kind]
+            if endpoint in latencies:
+                latency, source = latencies[endpoint]
+            else:
+                latency = DEFAULT_LATENCY.get('query' if kind == 'sync'
+                                              else kind, FALLBACK_LATENCY)
+                source = 'default'
+            requests = len([c for c in calls if not c.cached])
+            steps.append({
+                'call': kind,
+                'endpoint': endpoint,
+                'calls': self.requested[kind],
+                'unique': len(calls),
+                'cached': len(calls) - requests,
+                'requests': requests,
+                'latency_ms': round(latency * 1000, 1),
+                'latency_from': source,
+                'estimate_s': round(math.ceil(requests / workers) * latency,
+                                    2)})
+        return steps
+
+    def report(self):
+        steps = self.estimate()
+        total = {'call': 'TOTAL', 'endpoint': '',
+                 'calls': sum(s['calls'] for s in steps),
+                 'unique': sum(s['unique'] for s in steps),
+                 'cached': sum(s['cached'] for s in steps),
+                 'requests': sum(s['requests'] for s in steps),
+                 'latency_ms': '', 'latency_from': '',
+                 'estimate_s': round(sum(s['estimate_s'] for s in steps), 2)}
+        lines = ['Planning made %s requests in %.2f s. The run would make '
+                 'these calls using %s workers:' % (
+                        self.planning_requests, self.planning_time or 0,
+                        self.looker.workers),
+                 tabulate(steps + [total], headers='keys', tablefmt='psql',
+                          numalign='right'),
+                 'Usage queries are split into more requests when a date '
+                 'window returns 50000 rows or more. Cached calls are '
+                 'answered from the metadata cache, the memo or the usage '
+                 'store.']
+        return '\n'.join(lines)
@@ -0,0 +1,138 @@
+# profiler.py
+import json
+import logging
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+from tabulate import tabulate
+
+profile_logger = logging.getLogger('profiler')
+
+# API endpoints henry calls, used to group requests by endpoint template
+# rather than by url. more specific templates have to come first
+ENDPOINTS = [
+    'lookml_models/{model_name}/explores/{explore_name}',
+    'lookml_models/{model_name}',
+    'projects/{project_id}/git_connection_tests/{test_id}',
+    'projects/{project_id}/git_connection_tests',
+    'projects/{project_id}/files',
+    'projects/{project_id}',
+    'queries/run/{result_format}',
+    'connections/{connection_name}/test',
+]
+ENDPOINT_PATTERNS = [(re.compile(re.sub(r'{\w+}', '[^/]+', e) + '$'), e)
+                     for e in ENDPOINTS]
+
+
+def endpoint(method, url):
+    path = urlparse(url).path.split('/api/3.0/', 1)[-1]
+    for pattern, template in ENDPOINT_PATTERNS:
+        if pattern.match(path):
+            path = template
+            break
+    return '%s /%s' % (method, path)
+
+
+# nearest-rank percentile of an already sorted list
+def percentile(values, p):
+    return values[max(0, int(math.ceil(p / 100 * len(values))) - 1)]
+
+
+# size on the wire of the part of a response body read so far, before it
+# was decompressed. responses that weren't received, such as those replayed
+# from a cassette, count with the size decoded of their body
+def wire_bytes(r, decoded):
+    tell = getattr(r.raw, 'tell', None)
+    if tell is None:
+        return decoded
+    return tell()
+
+
+# collects timings and payload sizes of every API request made during a run
+# and aggregates them per endpoint
+class HttpProfiler(object):
+    def __init__(self):
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def record(self, method, url, status, latency, request_bytes,
+               response_bytes):
+        r = {'endpoint': endpoint(method, url),
+             'status': status,
+             'latency': latency,
+             'request_bytes': request_bytes,
+             'response_bytes': response_bytes,
+             'decode_time': 0.0}
+        with self.lock:
+            self.requests.append(r)
+        return r
+
+    # requests response hook. it runs before the body is downloaded, so
+    # latency covers the time to the headers plus the time to read the body.
+    # streamed bodies are accounted for by the caller as they are read
+    def hook(self, r, *args, **kwargs):
+        start = time.perf_counter()
+        if kwargs.get('stream'):
+            response_bytes = 0
+        else:
+            response_bytes = wire_bytes(r, len(r.content or b''))
+        latency = r.elapsed.total_seconds() + time.perf_counter() - start
+        body = r.request.body or b''
+        r.profile = self.record(r.request.method, r.url, r.status_code,
+                                latency, len(body), response_bytes)
+        return r
+
+    # adds a chunk of size decoded bytes read from a streamed response
+    def streamed(self, r, size):
+        r.profile['response_bytes'] = wire_bytes(
+            r, r.profile['response_bytes'] + size)
+
+    def decoded(self, r, seconds):
+        if hasattr(r, 'profile'):
+            r.profile['decode_time'] += seconds
+
+    def summary(self):
+        endpoints = OrderedDict()
+        with self.lock:
+            for r in self.requests:
+                endpoints.setdefault(r['endpoint'], []).append(r)
+        summary = []
+        for e, requests in endpoints.items():
+            latencies = sorted(r['latency'] for r in requests)
+            summary.append({
+                'endpoint': e,
+                'count': len(requests),
+                'errors': len([r for r in requests if r['status'] >= 400]),
+                'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+                'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+                'max_ms': round(latencies[-1] * 1000, 1),
+                'request_bytes': sum(r['request_bytes'] for r in requests),
+                'response_bytes': sum(r['response_bytes'] for r in requests),
+                'decode_ms': round(sum(r['decode_time']
+                                       for r in requests) * 1000, 1)
+            })
+        return sorted(summary, key=lambda x: x['count'], reverse=True)
+
+    def report(self):
+        summary = self.summary()
+        if not summary:
+            return 'No API requests were made'
+        total = {'endpoint': 'TOTAL',
+                 'count': sum(e['count'] for e in summary),
+                 'errors': sum(e['errors'] for e in summary),
+                 'p50_ms': '', 'p95_ms': '',
+                 'max_ms': max(e['max_ms'] for e in summary)}
+        for k in ('request_bytes', 'response_bytes', 'decode_ms'):
+            total[k] = round(sum(e[k] for e in summary), 1)
+        return tabulate(summary + [total], headers='keys', tablefmt='psql',
+                        numalign='right')
+
+    def save(self, path, **info):
+        report = dict(info)
+        report['endpoints'] = self.summary()
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        profile_logger.info('HTTP profile saved to %s', path)
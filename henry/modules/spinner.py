@@ -1,6 +1,5 @@
 import threading
 import sys
-import time
 
 
 class SpinnerThread(threading.Thread):
@@ -10,17 +9,20 @@ class SpinnerThread(threading.Thread):
         self._stopevent = threading.Event()
 
     def stop(self):
-        sys.stdout.write('\b')
         self._stopevent.set()
 
+    # waits on the stop event rather than sleeping so that stopping the
+    # spinner doesn't wait for it to finish its turn
     def _spin(self):
 
-        while not self._stopevent.isSet():
+        while not self._stopevent.is_set():
             for t in '|/-\\':
                 sys.stdout.write(t)
                 sys.stdout.flush()
-                time.sleep(0.1)
+                self._stopevent.wait(0.1)
                 sys.stdout.write('\b')
+                if self._stopevent.is_set():
+                    break
 
 
 class Spinner(object):
@@ -30,3 +32,4 @@ class Spinner(object):
 
     def __exit__(self, exc_type, exc_value, tb):
         self.spinner.stop()
+        self.spinner.join()
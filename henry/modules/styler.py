@@ -1,4 +1,7 @@
 # styler.py
+import csv
+import itertools
+import json
 import logging
 from tabulate import tabulate
 from operator import itemgetter
@@ -38,3 +41,38 @@ def sort(data, valid_values, sortkey):
             style_logger.info('Sorting data by %s %s', sk, type)
             data = sorted(data, key=itemgetter(sk), reverse=type)
     return data
+
+
+# sorts and limits rows like sort and limit, but rows can be any iterable
+# and are only collected when they have to be sorted
+def sort_limit(rows, sortkey=None, limit=None):
+    if sortkey is not None:
+        rows = list(rows)
+        if not rows:
+            return rows
+        rows = sort(rows, list(rows[0].keys()), sortkey)
+    if limit is not None:
+        style_logger.info('Limiting results to %s', limit[0])
+        rows = itertools.islice(rows, limit[0])
+    return rows
+
+
+# writes rows to f one at a time as JSON lines or CSV, flushing after each
+# so that readers get every row as soon as it is ready. CSV columns are
+# those of the first row. returns the number of rows written
+def stream(rows, f, format):
+    writer = None
+    count = 0
+    for row in rows:
+        if format == 'jsonl':
+            f.write(json.dumps(row, default=str) + '\n')
+        else:
+            if writer is None:
+                writer = csv.DictWriter(f, fieldnames=list(row.keys()),
+                                        lineterminator='\n')
+                writer.writeheader()
+            writer.writerow(row)
+        f.flush()
+        count += 1
+    style_logger.info('Wrote %s rows as %s', count, format)
+    return count
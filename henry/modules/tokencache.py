@@ -0,0 +1,83 @@
+# tokencache.py
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+token_logger = logging.getLogger('tokencache')
+
+# tokens are refreshed this many seconds before they expire
+EXPIRY_MARGIN = 60
+
+
+# keeps the API access token of every host and client id in a json file
+# that only the user can read, along with the time it expires. tokens are
+# handed out until shortly before they expire, so that runs can reuse them
+# without checking them with the API first
+class TokenCache(object):
+    def __init__(self, path, margin=EXPIRY_MARGIN):
+        self.path = path
+        self.margin = margin
+        self.lock = threading.Lock()
+
+    def _key(self, host, port, client_id):
+        key = '%s:%s:%s' % (host, port, client_id)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    # tokens in a file that others can read are not trusted
+    def _load(self):
+        try:
+            if os.stat(self.path).st_mode & 0o077:
+                token_logger.warning('Ignoring %s as others can access it',
+                                     self.path)
+                return {}
+            with open(self.path, 'r') as f:
+                tokens = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return tokens if isinstance(tokens, dict) else {}
+
+    def get(self, host, port, client_id):
+        with self.lock:
+            entry = self._load().get(self._key(host, port, client_id))
+        if not entry:
+            return None
+        if entry.get('expires_at', 0) - self.margin < time.time():
+            token_logger.info('Cached access token for %s has expired', host)
+            return None
+        token_logger.info('Using cached access token for %s', host)
+        return entry.get('access_token')
+
+    # writes tokens to the file, dropping the expired ones of any host on
+    # the way. returns whether they were saved
+    def _save(self, tokens):
+        now = time.time()
+        tokens = {k: v for k, v in tokens.items()
+                  if isinstance(v, dict) and v.get('expires_at', 0) > now}
+        tmp = '%s.%s.tmp' % (self.path, threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(self.path), mode=0o700,
+                        exist_ok=True)
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(tokens, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            token_logger.warning('Could not save access tokens to %s: %s',
+                                 self.path, e)
+            return False
+        return True
+
+    def set(self, host, port, client_id, access_token, expires_in):
+        with self.lock:
+            tokens = self._load()
+            tokens[self._key(host, port, client_id)] = {
+                'access_token': access_token,
+                'expires_at': time.time() + expires_in}
+            if not self._save(tokens):
+                return
+        token_logger.info('Saved access token for %s, expires in %s seconds',
+                          host, expires_in)
+
@@ -0,0 +1,230 @@
+# transport.py
+import logging
+import socket
+import threading
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from urllib3.connection import HTTPConnection
+
+transport_logger = logging.getLogger('transport')
+
+# value of the Accept-Encoding header with compression turned on or off
+ENCODINGS = {True: 'gzip, deflate', False: 'identity'}
+# headers that only apply to a single HTTP/1.1 connection and that HTTP/2
+# does not allow
+HOP_BY_HOP = ('connection', 'keep-alive', 'proxy-connection',
+              'transfer-encoding', 'upgrade')
+
+
+# socket options that make idle pooled connections send keepalive probes
+# after idle seconds, so that load balancers and NAT gateways don't drop
+# them while a long i__looker query runs on another connection
+def keepalive_options(idle):
+    options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        options += [(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle),
+                    (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL,
+                     max(1, idle // 4))]
+    elif hasattr(socket, 'TCP_KEEPALIVE'):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle))
+    return HTTPConnection.default_socket_options + options
+
+
+# HTTPAdapter that counts how many connections its pools opened for the
+# requests they sent
+class PooledAdapter(HTTPAdapter):
+    def __init__(self, keepalive=None, **kwargs):
+        self.keepalive = keepalive
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keepalive:
+            kwargs['socket_options'] = keepalive_options(self.keepalive)
+        super().init_poolmanager(*args, **kwargs)
+
+    def stats(self):
+        pools = self.poolmanager.pools
+        stats = {'requests': 0, 'connections': 0}
+        for key in pools.keys():
+            try:
+                pool = pools[key]
+            except KeyError:
+                continue
+            stats['requests'] += pool.num_requests
+            stats['connections'] += pool.num_connections
+        return stats
+
+
+# raw body of a response received by Http2Adapter, read the way requests
+# reads urllib3 responses. httpx has already decoded it
+class Http2Body(object):
+    def __init__(self, response, request):
+        self.response = response
+        self.request = request
+
+    def stream(self, chunk_size, decode_content=True):
+        import httpx
+        try:
+            yield from self.response.iter_bytes(chunk_size)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.ReadTimeout(e, request=self.request)
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(e,
+                                                      request=self.request)
+        finally:
+            self.response.close()
+
+    # bytes of the body received, before they were decoded
+    def tell(self):
+        return self.response.num_bytes_downloaded
+
+    def close(self):
+        self.response.close()
+
+
+# transport adapter that sends requests over HTTP/2 with httpx. concurrent
+# requests to a host are multiplexed over a single connection
+class Http2Adapter(BaseAdapter):
+    def __init__(self, pool_size=10):
+        super().__init__()
+        import httpx
+        # httpx only needs h2 once a client is created
+        import h2  # noqa: F401
+        self.httpx = httpx
+        self.limits = httpx.Limits(max_connections=pool_size,
+                                   max_keepalive_connections=pool_size)
+        # clients are created on first use, one per certificate setting
+        self.clients = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def _client(self, verify):
+        with self.lock:
+            client = self.clients.get(verify)
+            if client is None:
+                client = self.httpx.Client(http2=True, verify=verify,
+                                           limits=self.limits)
+                self.clients[verify] = client
+            self.requests += 1
+        return client
+
+    def send(self, request, stream=False, timeout=None, verify=True,
+             cert=None, proxies=None):
+        client = self._client(verify)
+        if isinstance(timeout, tuple):
+            timeout = self.httpx.Timeout(timeout[1], connect=timeout[0])
+        else:
+            timeout = self.httpx.Timeout(timeout)
+        headers = {k: v for k, v in request.headers.items()
+                   if k.lower() not in HOP_BY_HOP}
+        try:
+            r = client.send(client.build_request(request.method, request.url,
+                                                 headers=headers,
+                                                 content=request.body,
+                                                 timeout=timeout),
+                            stream=True)
+        except self.httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(e, request=request)
+        except self.httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(e, request=request)
+        response = requests.Response()
+        response.status_code = r.status_code
+        response.reason = r.reason_phrase
+        response.headers = CaseInsensitiveDict(r.headers)
+        # the body is decoded as it is read
+        response.headers.pop('Content-Encoding', None)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = Http2Body(r, request)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        with self.lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients = {}
+
+    # httpx does not say how many connections it opened
+    def stats(self):
+        return {'requests': self.requests, 'connections': None}
+
+
+# connection pools and HTTP settings shared by every API session created
+# with it. sessions on the same host, e.g. the runs of henry serve or the
+# sessions of several hosts checked at once, reuse each other's connections.
+# pool_size connections are kept per host, for up to pool_hosts hosts, and
+# with pool_block set requests wait for a free connection rather than
+# opening one that won't be kept. keepalive is the number of idle seconds
+# after which kept connections send keepalive probes
+class Transport(object):
+    def __init__(self, pool_size=10, pool_hosts=10, pool_block=False,
+                 compression=True, keepalive=60, http2=False):
+        self.pool_size = max(1, pool_size)
+        self.pool_hosts = max(1, pool_hosts)
+        self.pool_block = pool_block
+        self.compression = compression
+        self.keepalive = keepalive
+        self.http2 = http2
+        if http2:
+            try:
+                self.adapter = Http2Adapter(pool_size=self.pool_size)
+            except ImportError:
+                transport_logger.error('HTTP/2 requires httpx[http2]')
+                raise Exception('HTTP/2 requires httpx. Install it with '
+                                '`pip install henry[http2]`.')
+        else:
+            self.adapter = PooledAdapter(keepalive=keepalive,
+                                         **self.pool_args())
+        # adapters of recorded sessions, counted in the stats
+        self.adapters = []
+        transport_logger.info('Using %s transport: %s connections per host, '
+                              'compression %s', 'HTTP/2' if http2
+                              else 'HTTP/1.1', self.pool_size,
+                              'on' if compression else 'off')
+
+    def pool_args(self):
+        return {'pool_connections': self.pool_hosts,
+                'pool_maxsize': self.pool_size,
+                'pool_block': self.pool_block}
+
+    # returns a new session sending its requests over the shared pools.
+    # recorded sessions go through the cassette instead, which keeps pools
+    # of its own
+    def session(self, cassette=None):
+        session = requests.Session()
+        if cassette is not None:
+            adapter = cassette.adapter(**self.pool_args())
+            self.adapters.append(adapter)
+            session.mount('https://', adapter)
+        else:
+            session.mount('https://', self.adapter)
+        session.headers['Accept-Encoding'] = ENCODINGS[bool(self.compression)]
+        return session
+
+    # number of requests sent and of connections opened for them so far
+    def stats(self):
+        stats = self.adapter.stats()
+        for adapter in self.adapters:
+            for k, v in adapter.stats().items():
+                stats[k] = None if stats[k] is None else stats[k] + v
+        connections = stats['connections']
+        if connections is None or not stats['requests']:
+            stats['reused'] = None
+        else:
+            stats['reused'] = round(100 * (1 - connections /
+                                           stats['requests']), 1)
+        return stats
+
+    def report(self):
+        stats = self.stats()
+        if stats['connections'] is None:
+            return '%s requests sent over HTTP/2' % stats['requests']
+        return '%s requests sent over %s connections (%s%% reused)' % (
+            stats['requests'], stats['connections'], stats['reused'] or 0)
+
+    def close(self):
+        self.adapter.close()
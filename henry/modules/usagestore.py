@@ -0,0 +1,158 @@
+# usagestore.py
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import time
+from . import paginator
+
+usage_logger = logging.getLogger('usagestore')
+
+# number of days of history kept locally. usage commands look back at most
+# 90 days
+RETENTION = 90
+
+# i__looker history fields stored locally and the columns they are stored in
+COLUMNS = [('history.created_date', 'day'),
+           ('query.model', 'model'),
+           ('query.view', 'explore'),
+           ('query.formatted_fields', 'fields'),
+           ('query.formatted_filters', 'filters'),
+           ('query.sorts', 'sorts'),
+           ('query.formatted_pivots', 'pivots')]
+FIELDS = dict(COLUMNS)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS history (
+    day TEXT NOT NULL,
+    model TEXT,
+    explore TEXT,
+    fields TEXT,
+    filters TEXT,
+    sorts TEXT,
+    pivots TEXT,
+    run_count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_day ON history (day);
+CREATE INDEX IF NOT EXISTS history_explore ON history (model, explore, day);
+CREATE TABLE IF NOT EXISTS sync (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+
+# local copy of i__looker query history, aggregated per day and per query
+# (model, explore, fields, filters, sorts and pivots). it is kept in one
+# sqlite database per host under path and is brought up to date once per
+# run, or every max_age seconds if given, e.g. in the daemon: only the days
+# since the last sync are fetched again, the last synced
+# day included as it was likely incomplete back then. days are local dates,
+# which may be a day off from the instance's own time zone around midnight
+class UsageStore(object):
+    def __init__(self, path, max_age=None):
+        self.path = path
+        self.max_age = max_age
+        self.db = None
+        self.synced = None
+
+    def _open(self, host):
+        if self.db is None:
+            os.makedirs(self.path, mode=0o700, exist_ok=True)
+            # the store may be used from a thread other than the one that
+            # opened it, but never from two at a time
+            self.db = sqlite3.connect(os.path.join(self.path,
+                                                   '%s.db' % host),
+                                      check_same_thread=False)
+            self.db.executescript(SCHEMA)
+        return self.db
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def last_sync(self, host):
+        row = self._open(host).execute(
+                    "SELECT value FROM sync WHERE key = 'synced_through'"
+                    ).fetchone()
+        if row is None:
+            return None
+        return datetime.datetime.strptime(row[0], '%Y-%m-%d').date()
+
+    def sync(self, looker):
+        if self.synced is not None and (self.max_age is None or
+                                        time.time() - self.synced <
+                                        self.max_age):
+            return
+        db = self._open(looker.host)
+        today = datetime.date.today()
+        last = self.last_sync(looker.host)
+        if last is None or (today - last).days >= RETENTION:
+            days = RETENTION
+        else:
+            days = (today - last).days + 1
+        usage_logger.info('Syncing %s days of usage for %s, last synced %s',
+                          days, looker.host, last)
+        body = {
+            "model": "i__looker",
+            "view": "history",
+            "fields": [f for f, _ in COLUMNS] + ["history.query_run_count"],
+            "filters": {"history.created_date": str(days) + ' days'}
+        }
+        rows = paginator.sum_date_windows(looker, body, days)
+        start = today - datetime.timedelta(days=days - 1)
+        oldest = today - datetime.timedelta(days=RETENTION - 1)
+        with db:
+            db.execute('DELETE FROM history WHERE day >= ? OR day < ?',
+                       (start.isoformat(), oldest.isoformat()))
+            db.executemany('INSERT INTO history VALUES (%s)'
+                           % ', '.join('?' * (len(COLUMNS) + 1)),
+                           ([self._value(row[f]) for f, _ in COLUMNS]
+                            + [row['history.query_run_count']]
+                            for row in rows))
+            db.execute("INSERT OR REPLACE INTO sync VALUES "
+                       "('synced_through', ?)", (today.isoformat(),))
+        usage_logger.info('Synced %s usage rows', len(rows))
+        self.synced = time.time()
+
+    def _value(self, value):
+        if value is None or isinstance(value, str):
+            return value
+        return json.dumps(value)
+
+    # sums query run counts over the last timeframe days, grouped by the
+    # given i__looker dimensions, and returns the groups with at least
+    # min_queries runs as rows keyed like i__looker results. models and
+    # explores restrict the history to the given names, exclude_models
+    # leaves out the given ones
+    def usage(self, host, fields, timeframe=90, min_queries=0, models=None,
+              explores=None, exclude_models=None):
+        dimensions = [f for f in fields if f != 'history.query_run_count']
+        columns = [FIELDS[f] for f in dimensions]
+        start = datetime.date.today() - datetime.timedelta(days=timeframe - 1)
+        where = ['day >= ?']
+        params = [start.isoformat()]
+        # like i__looker filters, exclusions keep rows without a value
+        for column, names, condition in (
+                ('model', models, '{0} IN ({1})'),
+                ('explore', explores, '{0} IN ({1})'),
+                ('model', exclude_models,
+                 '({0} IS NULL OR {0} NOT IN ({1}))')):
+            if names is not None:
+                where.append(condition.format(column,
+                                              ', '.join('?' * len(names))))
+                params.extend(names)
+        sql = 'SELECT %s SUM(run_count) FROM history WHERE %s' % (
+                ''.join(c + ', ' for c in columns), ' AND '.join(where))
+        if columns:
+            sql += ' GROUP BY ' + ', '.join(columns)
+        sql += ' HAVING SUM(run_count) >= ?'
+        params.append(min_queries)
+        rows = []
+        for r in self._open(host).execute(sql, params):
+            row = dict(zip(dimensions, r))
+            row['history.query_run_count'] = r[-1]
+            rows.append(row)
+        return rows
@@ -22,7 +22,9 @@ REQUIRED = [
 
 # What packages are optional?
 EXTRAS = {
-    # 'fancy feature': ['django'],
+    'async': ['aiohttp'],
+    'http2': ['httpx[http2]'],
+    'test': ['pytest', 'aiohttp'],
 }
 
 here = os.path.abspath(os.path.dirname(__file__))
@@ -0,0 +1,109 @@
+# test_asynclookerapi.py
+# drives AsyncLookerApi.map against the fake Looker API server of the
+# benchmarks and checks it answers like LookerApi
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+from fakelooker import (  # noqa: E402
+    FakeLookerServer, build_instance, make_certificate)
+from henry.modules.lookerapi import LookerApi  # noqa: E402
+from henry.modules.fetcher import EXPLORE_FIELDS  # noqa: E402
+
+try:
+    import aiohttp
+    from henry.modules.asynclookerapi import AsyncLookerApi
+except ImportError:
+    aiohttp = None
+
+
+@unittest.skipUnless(aiohttp, 'requires aiohttp')
+class AsyncLookerApiTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp(prefix='henry-test-')
+        certfile, keyfile = make_certificate(cls.tmp)
+        cls.server = FakeLookerServer(build_instance(), certfile,
+                                      keyfile).start()
+        # henry doesn't verify the certificate of the API, but a CA bundle
+        # set in the environment overrides that
+        cls.environ = mock.patch.dict(os.environ,
+                                      {'REQUESTS_CA_BUNDLE': certfile})
+        cls.environ.start()
+        os.environ.pop('CURL_CA_BUNDLE', None)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.environ.stop()
+        cls.server.shutdown()
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+
+    def setUp(self):
+        self.server.connection_test_delay = 0
+        self.looker = LookerApi(id='test', secret='test', host='127.0.0.1',
+                                port=self.server.port, access_token=None,
+                                timeout=10, session_info='test', workers=4)
+        self.aio = AsyncLookerApi(self.looker, concurrency=4)
+
+    def tearDown(self):
+        self.aio.close()
+        self.looker.transport.close()
+
+    def test_map_get_explore(self):
+        calls = [(model, explore, EXPLORE_FIELDS) for model, explore
+                 in sorted(self.server.instance['explores'])]
+        calls.append(('model_0_0', 'missing', EXPLORE_FIELDS))
+        results = self.aio.map('get_explore', calls)
+        # in the order of calls, like LookerApi, and empty when not found
+        self.assertEqual(results, [self.looker.get_explore(*args)
+                                   for args in calls])
+        self.assertEqual(results[-1], [])
+        self.assertEqual(results[0][0]['name'], calls[0][1])
+
+    def test_map_get_model(self):
+        calls = [(model, {'fields': 'name,explores(name)'})
+                 for model in sorted(self.server.instance['models'])]
+        self.assertEqual(self.aio.map('get_model', calls),
+                         [self.looker.get_model(*args) for args in calls])
+
+    def test_map_progress(self):
+        done = []
+        calls = [(c,) for c in self.server.instance['connections']]
+        self.aio.map('test_connection', calls, progress=lambda: done.append(1))
+        self.assertEqual(len(done), len(calls))
+
+    def test_reauthenticates_on_401(self):
+        token = self.looker.get_access_token()
+        # the server forgets the session, e.g. as the token expired
+        del self.server.sessions[token]
+        results = self.aio.map('get_explore',
+                               [('model_0_0', 'explore_1', EXPLORE_FIELDS)])
+        self.assertEqual(results[0][0]['name'], 'explore_1')
+        self.assertNotEqual(self.looker.get_access_token(), token)
+
+    def test_connection_timeout(self):
+        self.server.connection_test_delay = 1
+        results = self.aio.map('test_connection', [('connection_0', {}, 0.2)])
+        self.assertEqual(results[0][0]['name'], 'timeout')
+
+    def test_connection_session_timeout(self):
+        # requests without a timeout of their own keep the session's
+        self.looker.timeout = 0.2
+        self.aio.close()
+        self.aio = AsyncLookerApi(self.looker, concurrency=4)
+        self.server.connection_test_delay = 1
+        results = self.aio.map('test_connection', [('connection_0',)])
+        self.assertEqual(results[0][0]['name'], 'timeout')
+        self.server.connection_test_delay = 0
+        results = self.aio.map('test_connection', [('connection_0',)])
+        self.assertEqual(results[0][0]['status'], 'success')
+
+
+if __name__ == '__main__':
+    unittest.main()
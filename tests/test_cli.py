@@ -0,0 +1,217 @@
+# test_cli.py
+# runs henry commands end to end against the fake Looker API server of the
+# benchmarks
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+from fakelooker import (  # noqa: E402
+    FakeLookerServer, build_instance, make_certificate)
+from henry import cli  # noqa: E402
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+# starts the fake server with a config file holding two hosts, dev and prod,
+# that both point at it
+class FakeLookerTest(unittest.TestCase):
+    # henry settings of the tests
+    settings = {'token_cache': False}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp(prefix='henry-test-')
+        certfile, keyfile = make_certificate(cls.tmp)
+        cls.server = FakeLookerServer(build_instance(), certfile,
+                                      keyfile).start()
+        cls.env = dict(os.environ, HOME=cls.tmp)
+        # the version check of pulse verifies the server's certificate
+        cls.env.pop('CURL_CA_BUNDLE', None)
+        cls.env['REQUESTS_CA_BUNDLE'] = certfile
+        os.mkdir(os.path.join(cls.tmp, '.henry'))
+        with open(os.path.join(cls.tmp, '.henry', 'settings.json'), 'w') as f:
+            json.dump(dict(cls.settings,
+                           pulse_version_url='https://127.0.0.1:%s/api/3.0/'
+                                             'versions' % cls.server.port),
+                      f)
+        cls.config = os.path.join(cls.tmp, 'config.yml')
+        with open(cls.config, 'w') as f:
+            f.write('hosts:\n')
+            for alias in ('dev', 'prod'):
+                f.write('  %s:\n    host: 127.0.0.1\n    id: test\n'
+                        '    secret: test\n    access_token: \'\'\n' % alias)
+        os.chmod(cls.config, 0o600)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+
+    # starts henry with args in a child process
+    def start(self, *args):
+        return subprocess.Popen([sys.executable, '-m', 'henry.cli'] +
+                                list(args) + ['--path', self.config, '--port',
+                                              str(self.server.port)],
+                                cwd=ROOT, env=self.env,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+
+    # runs henry with args and returns the finished process
+    def henry(self, *args):
+        p = self.start(*args)
+        p.stdout, p.stderr = p.communicate(timeout=120)
+        return p
+
+
+class HostsTest(FakeLookerTest):
+
+    def assertPulsedAll(self, p):
+        output = p.stdout.decode('utf-8')
+        self.assertEqual(p.returncode, 0, p.stderr.decode('utf-8'))
+        self.assertNotIn('Failed hosts', output)
+        for alias in ('dev', 'prod'):
+            self.assertIn(alias, output)
+
+    def test_pulse_hosts(self):
+        self.assertPulsedAll(self.henry('pulse', '--hosts', 'dev,prod'))
+
+    def test_pulse_all_hosts(self):
+        self.assertPulsedAll(self.henry('pulse', '--all-hosts'))
+
+
+
+class ExploresTest(FakeLookerTest):
+
+    def test_missing_explore_runs_no_query(self):
+        for command in ('analyze', 'vacuum'):
+            queries_before = self.server.query_count
+            p = self.henry(command, 'explores', '--model', 'model_0_0',
+                           '--explore', 'missing', '--host', 'dev',
+                           '--no-daemon')
+            self.assertNotEqual(p.returncode, 0)
+            self.assertIn('No matching explores found',
+                          p.stdout.decode('utf-8') +
+                          p.stderr.decode('utf-8'))
+            self.assertEqual(self.server.query_count, queries_before)
+
+
+
+class ModelsTest(FakeLookerTest):
+
+    def test_vacuum_models_uses_listed_models(self):
+        models = len(self.server.instance['models'])
+        requests_before = self.server.request_count
+        p = self.henry('vacuum', 'models', '--host', 'dev', '--no-daemon',
+                       '--no-cache')
+        self.assertEqual(p.returncode, 0, p.stderr.decode('utf-8'))
+        for m in self.server.instance['models']:
+            self.assertIn(m, p.stdout.decode('utf-8'))
+        # logging in, listing the models and two usage queries, but no
+        # request per model
+        self.assertLess(self.server.request_count - requests_before, models)
+
+
+
+class TokenCacheTest(FakeLookerTest):
+    settings = {}
+
+    def test_analyze_projects_next_to_vacuum_explores(self):
+        p = self.henry('vacuum', 'explores', '--host', 'dev', '--no-daemon',
+                       '--no-cache')
+        self.assertEqual(p.returncode, 0, p.stderr.decode('utf-8'))
+        cached = set(self.server.sessions)
+        # both runs start from the token the first one cached
+        projects = self.start('analyze', 'projects', '--host', 'dev',
+                              '--no-daemon')
+        explores = self.start('vacuum', 'explores', '--host', 'dev',
+                              '--no-daemon', '--no-cache')
+        for p in (projects, explores):
+            _, stderr = p.communicate(timeout=120)
+            self.assertEqual(p.returncode, 0, stderr.decode('utf-8'))
+        # analyze projects switched a session of its own to dev, never the
+        # one of the cached token
+        self.assertTrue(self.server.switched)
+        self.assertFalse(self.server.switched & cached)
+        self.assertEqual(self.server.dev_lookml_requests, 0)
+
+
+# runs henry in this process with sys.stdout replaced, as a test runner or a
+# program embedding it would
+class StdoutTest(FakeLookerTest):
+
+    # runs henry with args, and returns what it wrote to stdout and what
+    # sys.stdout was once it returned
+    def main(self, *args):
+        argv = ['henry'] + list(args) + ['--path', self.config, '--port',
+                                         str(self.server.port)]
+        out = io.StringIO()
+        with mock.patch.object(sys, 'argv', argv), \
+                mock.patch.object(sys, 'stdout', out), \
+                mock.patch.dict(os.environ, self.env, clear=True), \
+                mock.patch.object(cli, 'METADATA_PATH',
+                                  os.path.join(self.tmp, '.henry')), \
+                mock.patch.object(cli, 'configure_logging'):
+            try:
+                cli.main()
+            finally:
+                self.stdout = sys.stdout
+        return out
+
+    def test_rows_on_stdout(self):
+        out = self.main('analyze', 'models', '--host', 'dev', '--no-daemon',
+                        '--format', 'jsonl')
+        self.assertIs(self.stdout, out)
+        self.assertFalse(out.closed)
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(rows), len(self.server.instance['models']))
+
+    def test_stdout_restored_after_error(self):
+        with mock.patch.object(cli, 'stream_rows',
+                               side_effect=RuntimeError('failed')):
+            with self.assertRaises(RuntimeError):
+                self.main('vacuum', 'models', '--host', 'dev', '--no-daemon',
+                          '--format', 'csv')
+        self.assertIsInstance(self.stdout, io.StringIO)
+        self.assertFalse(self.stdout.closed)
+
+
+@unittest.skipUnless(aiohttp, 'requires aiohttp')
+class AsyncTest(FakeLookerTest):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # unused joins are listed in the order of a set
+        cls.env['PYTHONHASHSEED'] = '0'
+
+    def test_async_matches_threads(self):
+        for command in (['analyze', 'explores'], ['vacuum', 'explores']):
+            args = command + ['--host', 'dev', '--no-cache', '--no-daemon',
+                              '--workers', '4', '--format', 'jsonl']
+            threads = self.henry(*args)
+            self.assertEqual(threads.returncode, 0,
+                             threads.stderr.decode('utf-8'))
+            p = self.henry(*(args + ['--async']))
+            self.assertEqual(p.returncode, 0, p.stderr.decode('utf-8'))
+            self.assertEqual(p.stdout, threads.stdout)
+
+    def test_async_pulse(self):
+        p = self.henry('pulse', '--host', 'dev', '--async')
+        self.assertEqual(p.returncode, 0, p.stderr.decode('utf-8'))
+        for c in self.server.instance['connections']:
+            self.assertIn(c, p.stdout.decode('utf-8'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# test_fieldregistry.py
+# checks field sets held as bitsets of a FieldRegistry answer like the sets
+# of names they stand for
+import unittest
+from henry.modules.fieldregistry import FieldRegistry
+
+NAMES = ['model.explore.users.id',
+         'model.explore.users.created_date',
+         'model.explore.orders.count',
+         'model.explore.orders.address.city',
+         'model.orders.users.name',
+         'model.explore',
+         'model.explore.products.brand']
+
+
+class FieldRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = FieldRegistry()
+
+    def test_intern(self):
+        ids = [self.registry.intern(name) for name in NAMES]
+        self.assertEqual(ids, list(range(len(NAMES))))
+        self.assertEqual(self.registry.intern(NAMES[2]), 2)
+        self.assertEqual(self.registry.names, NAMES)
+
+    def test_bitset_round_trip(self):
+        bits = self.registry.bitset(NAMES)
+        self.assertEqual(list(self.registry.ids(bits)),
+                         list(range(len(NAMES))))
+        # only the names in a bitset come back, in the order they were
+        # interned
+        bits = self.registry.bitset([NAMES[6], NAMES[0], NAMES[3]])
+        self.assertEqual([self.registry.names[i]
+                          for i in self.registry.ids(bits)],
+                         [NAMES[0], NAMES[3], NAMES[6]])
+        self.assertEqual(self.registry.local_names_of(bits),
+                         ['users.id', 'orders.address.city',
+                          'products.brand'])
+        self.assertEqual(self.registry.bitset([]), 0)
+        self.assertEqual(list(self.registry.ids(0)), [])
+
+    def test_ids_across_bytes(self):
+        names = ['m.e.v.f%d' % i for i in range(20)]
+        self.registry.bitset(names)
+        picked = [0, 7, 8, 15, 16, 19]
+        bits = self.registry.bitset([names[i] for i in picked])
+        self.assertEqual(list(self.registry.ids(bits)), picked)
+
+    def test_set_operations(self):
+        exposed = NAMES[:4] + NAMES[6:]
+        used = [NAMES[1], NAMES[4], NAMES[6]]
+        unused = self.registry.bitset(exposed) & ~self.registry.bitset(used)
+        self.assertEqual(set(self.registry.local_names_of(unused)),
+                         set(n.split('.', 2)[2]
+                             for n in set(exposed) - set(used)))
+
+    def test_views_of(self):
+        bits = self.registry.bitset(NAMES[:5])
+        self.assertEqual(self.registry.views_of(bits), {'users', 'orders'})
+        # the view is the third part of the name, whatever follows it
+        for name in NAMES[:5] + NAMES[6:]:
+            self.assertEqual(self.registry.views_of(
+                                self.registry.bitset([name])),
+                             {name.split('.')[2]})
+        # a name with no view
+        self.assertEqual(self.registry.views_of(
+                            self.registry.bitset([NAMES[5]])), {''})
+        self.assertEqual(self.registry.views_of(0), set())
+
+    def test_count(self):
+        self.assertEqual(self.registry.count(0), 0)
+        names = ['m.e.v.f%d' % i for i in range(1000)]
+        self.assertEqual(self.registry.count(self.registry.bitset(names)),
+                         1000)
+        self.assertEqual(self.registry.count(
+                            self.registry.bitset(names[::3])), 334)
+        self.assertEqual(self.registry.count(
+                            self.registry.bitset([names[999]])), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+# test_jsonstream.py
+# decodes JSON arrays split into chunks in every possible way
+import json
+import unittest
+from henry.modules import jsonstream
+
+
+# splits data into chunks of size bytes
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class IterArrayTest(unittest.TestCase):
+
+    def assertDecodes(self, value, sizes=range(1, 12)):
+        data = json.dumps(value, ensure_ascii=False).encode('utf-8')
+        for size in list(sizes) + [len(data)]:
+            with self.subTest(size=size):
+                self.assertEqual(list(jsonstream.iter_array(chunked(data,
+                                                                    size))),
+                                 value)
+
+    def test_elements_split_across_chunks(self):
+        self.assertDecodes([{'query.model': 'model_%d' % i,
+                             'query.fields': '["a.b", "c.d"]',
+                             'nested': {'list': [1, [2, {'x': None}]]},
+                             'history.query_run_count': i}
+                            for i in range(5)])
+
+    def test_strings_with_brackets_and_escapes(self):
+        self.assertDecodes(['[{"]}', 'a\\"b', '\\', '"', 'line\nbreak',
+                            {'k]': '}{'}])
+
+    def test_numbers_at_chunk_edges(self):
+        self.assertDecodes([12345, -0.5, 1e10, 67890, 0, True, False, None,
+                            3.25])
+
+    def test_multibyte_utf8_split_across_chunks(self):
+        self.assertDecodes([{'label': 'Café ☕ 数据 😀'}, 'ü' * 7, '😀'])
+
+    def test_whitespace(self):
+        data = b' \n[ 1 ,\n\t{"a" : [ ] } ,"x" ]\n '
+        for size in range(1, len(data) + 1):
+            self.assertEqual(list(jsonstream.iter_array(chunked(data, size))),
+                             [1, {'a': []}, 'x'])
+
+    def test_empty(self):
+        self.assertDecodes([])
+        self.assertEqual(list(jsonstream.iter_array([b'[', b' ', b']'])), [])
+
+    def test_large_element_scanned_once(self):
+        # an element spanning many chunks is decoded once it is complete
+        value = [{'fields': ['view.field_%d' % i for i in range(20000)]}, 1]
+        data = json.dumps(value).encode('utf-8')
+        self.assertEqual(list(jsonstream.iter_array(chunked(data, 1024))),
+                         value)
+
+    def test_malformed(self):
+        for data in (b'[,,1]', b'[1 2]', b'[1,]', b'[,]', b'[1,,2]',
+                     b'{"a": 1}', b'[{"a": 1} {"b": 2}]', b'[tru]',
+                     b'[{"a": 1]', b'[1, 2', b'[{"a": ', b''):
+            for size in (1, 3, len(data) or 1):
+                with self.subTest(data=data, size=size):
+                    with self.assertRaises(ValueError):
+                        list(jsonstream.iter_array(chunked(data, size)))
+
+    def test_elements_yielded_as_they_complete(self):
+        rows = jsonstream.iter_array(iter([b'[{"a": 1}, {"b"', b': 2}, 3',
+                                           b']']))
+        self.assertEqual(next(rows), {'a': 1})
+        self.assertEqual(next(rows), {'b': 2})
+        self.assertEqual(list(rows), [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
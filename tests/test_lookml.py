@@ -0,0 +1,96 @@
+# test_lookml.py
+# checks Model and Explore only fetch an explore's definition once something
+# beyond its name is read from it
+import unittest
+from henry.modules.lookml import CATEGORIES, Explore, Model
+
+MODEL = {'name': 'thelook',
+         'project_name': 'ecommerce',
+         'explores': [{'name': 'orders'}, {'name': 'users'},
+                      {'name': 'broken'}]}
+EXPLORE = {'name': 'orders',
+           'hidden': False,
+           'description': 'Orders and their items',
+           'scopes': ['orders', 'users'],
+           'fields': {'dimensions': [{'name': 'orders.id', 'hidden': False},
+                                     {'name': 'users.id', 'hidden': True}],
+                      'measures': [{'name': 'orders.count',
+                                    'hidden': False}],
+                      'filters': []}}
+PROJECTION = {'fields': 'name,hidden'}
+
+
+# stands in for LookerApi.get_explore, answering with EXPLORE for every
+# explore but broken, which fails to load like those of bug #32748
+class StubLooker(object):
+    def __init__(self):
+        self.calls = []
+
+    def get_explore(self, model_name, explore_name, fields={}):
+        self.calls.append((model_name, explore_name, fields))
+        if explore_name == 'broken':
+            return []
+        return [dict(EXPLORE, name=explore_name)]
+
+
+class LazyLookmlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.looker = StubLooker()
+        self.model = Model(self.looker, MODEL, PROJECTION)
+
+    def test_model_holds_explore_stubs(self):
+        self.assertEqual(self.model.name, 'thelook')
+        self.assertEqual(self.model.project_name, 'ecommerce')
+        self.assertEqual([(e.model_name, e.name, e.found)
+                          for e in self.model.explores],
+                         [('thelook', 'orders', None),
+                          ('thelook', 'users', None),
+                          ('thelook', 'broken', None)])
+        self.assertEqual(self.looker.calls, [])
+
+    def test_hydrated_once(self):
+        explore = self.model.explores[0]
+        self.assertEqual(explore.description, 'Orders and their items')
+        self.assertEqual(self.looker.calls,
+                         [('thelook', 'orders', PROJECTION)])
+        self.assertIs(explore.found, True)
+        self.assertIs(explore.hidden, False)
+        self.assertEqual(explore.scopes, ['orders', 'users'])
+        self.assertEqual([(f.name, f.hidden, f.category)
+                          for f in explore.fields],
+                         [('orders.id', False, 'dimensions'),
+                          ('users.id', True, 'dimensions'),
+                          ('orders.count', False, 'measures')])
+        self.assertEqual(len(self.looker.calls), 1)
+
+    def test_loaded_not_fetched(self):
+        explore = Explore(self.looker, 'thelook', 'orders')
+        self.assertTrue(explore.load(EXPLORE))
+        self.assertEqual(explore.scopes, ['orders', 'users'])
+        self.assertEqual(self.looker.calls, [])
+
+    def test_not_found(self):
+        explore = self.model.explores[2]
+        with self.assertLogs('lookml', 'ERROR'):
+            with self.assertRaises(Exception):
+                explore.fields
+        self.assertIs(explore.found, False)
+        # a missing explore is not asked for again
+        with self.assertLogs('lookml', 'ERROR'):
+            with self.assertRaises(Exception):
+                explore.scopes
+        self.assertEqual(len(self.looker.calls), 1)
+        self.assertFalse(Explore(self.looker, 'thelook', 'gone').load(None))
+
+    def test_categories(self):
+        explore = Explore(self.looker, 'thelook', 'orders')
+        fields = {c: [{'name': 'v.%s' % c, 'hidden': False}]
+                  for c in CATEGORIES}
+        explore.load(dict(EXPLORE, fields=fields))
+        self.assertEqual([f.category for f in explore.fields],
+                         list(CATEGORIES))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+# test_paginator.py
+# pages i__looker queries through a stub that caps its results, and checks
+# the rows of every date window and page add up without duplicates
+import copy
+import re
+import unittest
+from collections import Counter
+from henry.modules import paginator
+
+DAY_FILTER = re.compile(r'^(\d+) days ago for (\d+) days$')
+
+
+# stands in for LookerApi.run_inline_query over a list of history rows,
+# where history.created_date is the number of days ago. rows are grouped by
+# the query's dimensions with history.query_run_count summed, and only the
+# first limit groups are returned, like i__looker does
+class StubLooker(object):
+    def __init__(self, history):
+        self.history = history
+        self.bodies = []
+
+    def _match(self, h, filters):
+        for field, value in filters.items():
+            if field == 'history.created_date':
+                m = DAY_FILTER.match(value)
+                if m:
+                    start, days = int(m.group(1)), int(m.group(2))
+                    if not start - days < h[field] <= start:
+                        return False
+                elif h[field] >= int(value.split()[0]):
+                    return False
+            elif value.startswith('>') and h[field] <= int(value[1:]):
+                return False
+        return True
+
+    def run_inline_query(self, result_format, body, fields={}, stream=False):
+        self.bodies.append(copy.deepcopy(body))
+        measure = 'history.query_run_count'
+        dimensions = [f for f in body['fields'] if f != measure]
+        groups = {}
+        for h in self.history:
+            if not self._match(h, body['filters']):
+                continue
+            key = tuple(h[d] for d in dimensions)
+            if key in groups:
+                groups[key][measure] += h[measure]
+            else:
+                groups[key] = dict({d: h[d] for d in dimensions},
+                                   **{measure: h[measure]})
+        rows = list(groups.values())
+        for sort in body.get('sorts') or []:
+            field = sort.split()[0]
+            rows.sort(key=lambda r: r[field])
+        rows = rows[:int(body['limit'])]
+        return iter(rows) if stream else rows
+
+
+# history of 30 days where each day runs 4 of 40 queries, each query coming
+# back every 10 days, run a number of times that depends on the day
+def build_history(days=30, per_day=4, queries=40):
+    history = []
+    for day in range(days):
+        for i in range(per_day):
+            history.append({'history.id': len(history) + 1,
+                            'history.created_date': day,
+                            'query.id': (day * per_day + i) % queries,
+                            'history.query_run_count': day % 5 + 1})
+    return history
+
+
+def usage_body(fields, days=30):
+    return {'model': 'i__looker',
+            'view': 'history',
+            'fields': fields,
+            'filters': {'history.created_date': '%s days' % days}}
+
+
+class DateWindowsTest(unittest.TestCase):
+
+    def test_iter_date_windows_splits_capped_windows(self):
+        history = build_history()
+        looker = StubLooker(history)
+        rows = list(paginator.iter_date_windows(
+                        looker, usage_body(['history.id',
+                                            'history.query_run_count']),
+                        30, page_size=10))
+        # every history row once, although the first windows were capped
+        self.assertEqual(sorted(r['history.id'] for r in rows),
+                         [h['history.id'] for h in history])
+        self.assertGreater(len(looker.bodies), 1)
+        self.assertEqual(looker.bodies[0]['filters']['history.created_date'],
+                         '30 days')
+
+    def test_sum_date_windows_sums_groups_across_windows(self):
+        history = build_history()
+        looker = StubLooker(history)
+        rows = paginator.sum_date_windows(
+                    looker, usage_body(['query.id',
+                                        'history.query_run_count']),
+                    30, page_size=10)
+        expected = Counter()
+        for h in history:
+            expected[h['query.id']] += h['history.query_run_count']
+        self.assertEqual(len(rows), len(expected))
+        self.assertEqual({r['query.id']: r['history.query_run_count']
+                          for r in rows}, dict(expected))
+
+    def test_sum_date_windows_uncapped(self):
+        history = build_history()
+        looker = StubLooker(history)
+        rows = paginator.sum_date_windows(
+                    looker, usage_body(['query.id',
+                                        'history.query_run_count']), 30)
+        self.assertEqual(len(looker.bodies), 1)
+        self.assertEqual(sum(r['history.query_run_count'] for r in rows),
+                         sum(h['history.query_run_count'] for h in history))
+
+    def test_single_day_over_cap_is_truncated(self):
+        looker = StubLooker(build_history(days=1, per_day=20, queries=20))
+        with self.assertLogs('paginator', 'WARNING'):
+            rows = list(paginator.iter_date_windows(
+                            looker, usage_body(['query.id',
+                                                'history.query_run_count'],
+                                               days=1),
+                            1, page_size=10))
+        self.assertEqual(len(rows), 10)
+
+
+class KeysetTest(unittest.TestCase):
+
+    def keyset(self, rows, page_size):
+        history = build_history(days=1, per_day=rows, queries=rows)
+        looker = StubLooker(history)
+        result = list(paginator.iter_keyset(
+                        looker, usage_body(['history.id', 'query.id'], 1),
+                        'history.id', page_size=page_size))
+        self.assertEqual([r['history.id'] for r in result],
+                         [h['history.id'] for h in history])
+        return looker.bodies
+
+    def test_pages(self):
+        bodies = self.keyset(25, 10)
+        self.assertEqual([b['filters'].get('history.id') for b in bodies],
+                         [None, '>10', '>20'])
+
+    def test_last_page_full(self):
+        # a full last page is followed by an empty one
+        self.assertEqual(len(self.keyset(20, 10)), 3)
+
+    def test_body_unchanged(self):
+        body = usage_body(['history.id', 'query.id'], 1)
+        looker = StubLooker(build_history(days=1, per_day=25, queries=25))
+        list(paginator.iter_keyset(looker, body, 'history.id', page_size=10))
+        self.assertEqual(body, usage_body(['history.id', 'query.id'], 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# test_profiler.py
+# profiles requests to the fake Looker API server of the benchmarks, which
+# gzips its responses, and checks the bytes recorded are those it sent
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+from fakelooker import (  # noqa: E402
+    FakeLookerServer, build_instance, make_certificate)
+from henry.modules.lookerapi import LookerApi  # noqa: E402
+from henry.modules.profiler import HttpProfiler  # noqa: E402
+from henry.modules.transport import Transport  # noqa: E402
+
+try:
+    import aiohttp
+    from henry.modules.asynclookerapi import AsyncLookerApi
+except ImportError:
+    aiohttp = None
+
+USAGE = {'model': 'i__looker',
+         'view': 'history',
+         'fields': ['query.model', 'history.query_run_count'],
+         'filters': {'history.created_date': '90 days'},
+         'limit': '50000'}
+
+
+class ProfilerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp(prefix='henry-test-')
+        certfile, keyfile = make_certificate(cls.tmp)
+        cls.server = FakeLookerServer(build_instance(history=2000), certfile,
+                                      keyfile).start()
+        cls.server.compress = True
+        # henry doesn't verify the certificate of the API, but a CA bundle
+        # set in the environment overrides that
+        cls.environ = mock.patch.dict(os.environ,
+                                      {'REQUESTS_CA_BUNDLE': certfile})
+        cls.environ.start()
+        os.environ.pop('CURL_CA_BUNDLE', None)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.environ.stop()
+        cls.server.shutdown()
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+
+    def looker(self, compression=True):
+        profiler = HttpProfiler()
+        looker = LookerApi(id='test', secret='test', host='127.0.0.1',
+                           port=self.server.port, access_token=None,
+                           timeout=10, session_info='test', workers=4,
+                           profiler=profiler,
+                           transport=Transport(compression=compression))
+        self.addCleanup(looker.transport.close)
+        # only the requests made from here on are compared
+        profiler.requests = []
+        self.server.bytes_sent = 0
+        return looker
+
+    def response_bytes(self, looker):
+        return sum(r['response_bytes'] for r in looker.profiler.requests)
+
+    def test_gzipped(self):
+        looker = self.looker()
+        looker.get_models()
+        rows = list(looker.run_inline_query('json', USAGE, stream=True))
+        decoded = len(looker.run_inline_query('json', USAGE))
+        self.assertEqual(len(rows), decoded)
+        self.assertEqual(len(looker.profiler.requests), 3)
+        self.assertEqual(self.response_bytes(looker), self.server.bytes_sent)
+
+    def test_uncompressed(self):
+        looker = self.looker(compression=False)
+        looker.get_models()
+        list(looker.run_inline_query('json', USAGE, stream=True))
+        self.assertEqual(self.response_bytes(looker), self.server.bytes_sent)
+
+    @unittest.skipUnless(aiohttp, 'requires aiohttp')
+    def test_async_gzipped(self):
+        looker = self.looker()
+        aio = AsyncLookerApi(looker, concurrency=4)
+        self.addCleanup(aio.close)
+        models = aio.map('get_model', [(m,) for m in
+                                       self.server.instance['models']])
+        self.assertEqual(models, [looker.get_model(m) for m in
+                                  self.server.instance['models']])
+        self.assertEqual(self.response_bytes(looker), self.server.bytes_sent)
@@ -0,0 +1,77 @@
+# test_startup.py
+# checks how long henry takes to import what it needs to start, using
+# python -X importtime. modules the interpreter imports on its own are left
+# out. a command fails if it imports more than the budget or loads a module
+# it shouldn't need to parse its arguments
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# milliseconds a command may spend importing modules, the fastest of REPEAT
+# runs being kept
+BUDGET = 30
+REPEAT = 5
+# commands to check and the modules they must not import
+COMMANDS = {'--help': ['requests', 'yaml', 'tabulate', 'tqdm', 'sqlite3',
+                       'concurrent.futures', 'logging.config',
+                       'henry.commands', 'henry.modules.lookerapi'],
+            'analyze --help': ['requests', 'yaml', 'tqdm', 'henry.commands'],
+            'vacuum --help': ['requests', 'yaml', 'tqdm', 'henry.commands'],
+            'pulse --help': ['requests', 'yaml', 'tqdm', 'henry.commands']}
+LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$')
+
+
+class StartupTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # --help shouldn't touch the home directory, but if it does it must
+        # not be the real one
+        cls.home = tempfile.mkdtemp(prefix='henry-startup-')
+        cls.env = dict(os.environ, HOME=cls.home)
+        cls.baseline = set(cls.import_times(['-c', 'pass']))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.home, ignore_errors=True)
+
+    # runs python -X importtime with args and returns the self time in
+    # microseconds of every module imported
+    @classmethod
+    def import_times(cls, args):
+        p = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+                           cwd=ROOT, env=cls.env, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.PIPE)
+        times = {}
+        for line in p.stderr.decode('utf-8', 'replace').splitlines():
+            m = LINE.match(line)
+            if m:
+                times[m.group(4)] = int(m.group(1))
+        return times
+
+    def test_startup(self):
+        for command, forbidden in COMMANDS.items():
+            with self.subTest(command='henry ' + command):
+                best = None
+                for i in range(REPEAT):
+                    times = self.import_times(['-m', 'henry.cli'] +
+                                              command.split())
+                    own = {k: v for k, v in times.items()
+                           if k not in self.baseline}
+                    total = sum(own.values()) / 1000
+                    if best is None or total < best[0]:
+                        best = (total, own)
+                total, own = best
+                loaded = sorted(m for m in own for f in forbidden
+                                if m == f or m.startswith(f + '.'))
+                self.assertEqual(loaded, [])
+                self.assertLessEqual(total, BUDGET)
+
+
+if __name__ == '__main__':
+    unittest.main()
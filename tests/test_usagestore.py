@@ -0,0 +1,169 @@
+# test_usagestore.py
+# syncs the usage store from the fake Looker API server of the benchmarks
+# and checks it answers usage questions like the live i__looker queries
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+from fakelooker import (  # noqa: E402
+    FakeLookerServer, build_instance, make_certificate)
+from henry.modules import paginator  # noqa: E402
+from henry.modules.fetcher import Fetcher  # noqa: E402
+from henry.modules.lookerapi import LookerApi  # noqa: E402
+from henry.modules.usagestore import RETENTION, UsageStore  # noqa: E402
+
+
+class UsageStoreTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp(prefix='henry-test-')
+        certfile, keyfile = make_certificate(cls.tmp)
+        cls.server = FakeLookerServer(build_instance(), certfile,
+                                      keyfile).start()
+        # henry doesn't verify the certificate of the API, but a CA bundle
+        # set in the environment overrides that
+        cls.environ = mock.patch.dict(os.environ,
+                                      {'REQUESTS_CA_BUNDLE': certfile})
+        cls.environ.start()
+        os.environ.pop('CURL_CA_BUNDLE', None)
+        cls.looker = LookerApi(id='test', secret='test', host='127.0.0.1',
+                               port=cls.server.port, access_token=None,
+                               timeout=10, session_info='test')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.looker.transport.close()
+        cls.environ.stop()
+        cls.server.shutdown()
+        shutil.rmtree(cls.tmp, ignore_errors=True)
+
+    def setUp(self):
+        # history spans 120 days, so some of it is older than the store keeps
+        self.server.instance = build_instance(history=2000)
+        self.store = UsageStore(tempfile.mkdtemp(dir=self.tmp))
+
+    def tearDown(self):
+        self.store.close()
+
+    # runs a new sync, as a later run would
+    def sync(self):
+        self.store.synced = None
+        queries = self.server.query_count
+        self.store.sync(self.looker)
+        return self.server.query_count - queries
+
+    # adds a history row of run_count runs, days days ago
+    def add_history(self, days, run_count):
+        history = self.server.instance['history']
+        row = dict(history[0], **{'history.id': len(history) + 1,
+                                  'history.created_date': days,
+                                  'history.query_run_count': run_count})
+        history.append(row)
+
+    # lets days go by: the instance's history gets older, and so do the
+    # store's days and the date it was last synced
+    def age(self, days):
+        for h in self.server.instance['history']:
+            h['history.created_date'] += days
+        db = self.store._open(self.looker.host)
+        with db:
+            db.execute("UPDATE history SET day = date(day, ?)",
+                       ('-%s days' % days,))
+            db.execute("UPDATE sync SET value = date(value, ?)",
+                       ('-%s days' % days,))
+
+    # run counts of the history kept in the store and in the instance
+    def stored_runs(self):
+        return self.store._open(self.looker.host).execute(
+                    'SELECT SUM(run_count) FROM history').fetchone()[0]
+
+    def live_runs(self, timeframe=RETENTION):
+        return sum(h['history.query_run_count']
+                   for h in self.server.instance['history']
+                   if h['history.created_date'] < timeframe)
+
+    # checks the store answers the usage questions of the commands like the
+    # live queries do
+    def assertUsageMatches(self):
+        live = Fetcher(self.looker)
+        local = Fetcher(self.looker, self.store)
+        for timeframe in (1, 7, 30, 90):
+            for min_queries in (0, 3, 20):
+                with self.subTest(timeframe=timeframe,
+                                  min_queries=min_queries):
+                    for method, kwargs in (
+                            ('get_used_models', {}),
+                            ('get_explore_usage', {}),
+                            ('get_used_explores', {'model': 'model_0_0'}),
+                            ('get_used_explore_fields',
+                             {'model': 'model_1_2'})):
+                        kwargs = dict(kwargs, timeframe=timeframe,
+                                      min_queries=min_queries)
+                        # answers of earlier syncs are not reused
+                        self.looker.memo.clear()
+                        expected = getattr(live, method)(**kwargs)
+                        actual = getattr(local, method)(**kwargs)
+                        if isinstance(expected, list):
+                            expected, actual = sorted(expected), \
+                                sorted(actual)
+                        self.assertEqual(actual, expected, method)
+
+    def test_first_sync(self):
+        self.assertIsNone(self.store.last_sync(self.looker.host))
+        self.assertGreater(self.sync(), 0)
+        self.assertEqual(self.store.last_sync(self.looker.host),
+                         datetime.date.today())
+        self.assertEqual(self.stored_runs(), self.live_runs())
+        self.assertUsageMatches()
+
+    def test_sync_once_per_run(self):
+        self.sync()
+        queries = self.server.query_count
+        self.store.sync(self.looker)
+        self.assertEqual(self.server.query_count, queries)
+
+    def test_second_sync_same_day(self):
+        self.sync()
+        self.add_history(0, 5)
+        self.sync()
+        # today's history is fetched again, without counting it twice
+        self.assertEqual(self.stored_runs(), self.live_runs())
+        self.assertUsageMatches()
+
+    def test_sync_after_days(self):
+        self.sync()
+        self.age(30)
+        for days in range(31):
+            self.add_history(days, days + 1)
+        with mock.patch.object(paginator, 'sum_date_windows',
+                               wraps=paginator.sum_date_windows) as \
+                sum_date_windows:
+            self.sync()
+        # the days since the last sync, that day included
+        self.assertEqual(sum_date_windows.call_args[0][2], 31)
+        self.assertEqual(self.stored_runs(), self.live_runs())
+        oldest = self.store._open(self.looker.host).execute(
+                    'SELECT MIN(day) FROM history').fetchone()[0]
+        self.assertGreaterEqual(oldest, (datetime.date.today() -
+                                         datetime.timedelta(RETENTION - 1)
+                                         ).isoformat())
+        self.assertUsageMatches()
+
+    def test_sync_after_retention(self):
+        self.sync()
+        self.age(RETENTION + 10)
+        self.add_history(0, 7)
+        self.sync()
+        self.assertEqual(self.stored_runs(), self.live_runs())
+        self.assertUsageMatches()
+
+
+if __name__ == '__main__':
+    unittest.main()